@@ -19,7 +19,9 @@ via API then you are just stuck.
 This script will use API to check to see if specific accprof and api-user
 exist.  If they do not, it will use SSH (paramiko) to SSH to the FG, login
 with admin/password and create the necessary accprof and api-user;
-and generate/retrieve an api key for the device.
+and generate/retrieve an api key for the device.  All cli commands for a device
+are sent in one batch down a single interactive SSH channel.  A device whose
+apikey in the device file still works is left alone, no SSH (see --regenerate).
 
 Note: For restoring config to FG, you must use pre-existing "super_admin" accprof.
 Thus "super_admin" is the default. If you use the default "super_admin" accprof, then
@@ -34,14 +36,31 @@ api access in other programs.
 I had hoped to assign the api key to a value that could be the same across all FGs
 in my yaml list.  However, although the cli option exists to set a key manually, 
 it always gives error when try to set it manually.  Thus must generate and record it.
+
+Devices are provisioned --workers at a time, each with its own api (--timeout) and SSH
+(--ssh_timeout) timeouts, so a device that hangs or fails doesn't hold up or stop the others.
+The keys generated are written to the device file once, after every device is done, by
+writing a new file and renaming it over the old one.  Until then each key is kept in a journal
+(".<device file>.keygen.jsonl" next to it) as soon as it is generated, so the keys of a run that
+dies part way through are not lost: the next run adds them to the device file, and with
+--resume skips the devices that already got theirs.  SSH connects to port 22 of the device ip,
+or to its "ssh_port" in the device file if defined.
 """
 
 from modules.common import *
+from modules.file_utils import AtomicFileWriter
+from modules.fortigate_api_utils import FortiGateApiUtils
+from modules.fortios_cli import FortiOSShell
+from modules.key_journal import KeyJournal, journal_file_for
+from modules.parallel_utils import run_parallel, print_result_table
+from modules.reachability import device_address
 from pyFGT.fortigate import *
 import argparse
 import paramiko
+import re
 import urllib3
 import shutil
+import time
 from str2bool import str2bool
 
 # Argument processing
@@ -56,11 +75,24 @@ parser.add_argument('--vdom', default='root', help='specify vdom for api-user if
 parser.add_argument('--skip_list', help='Path to file containing words that if match in fg name then skip that fg')
 parser.add_argument('--debug', type=str2bool, default=False, help='Enable debug output for API (pyfgt) request/response')
 parser.add_argument('--verbose', type=str2bool, default=False, help='Enable more verbose output')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of devices to provision concurrently (default 1, sequential)')
+parser.add_argument('--timeout', type=int, default=30, help='Seconds to wait for each api call to a device')
+parser.add_argument('--ssh_timeout', type=int, default=30,
+                    help='Seconds to wait for the SSH connection, login and each SSH command of a device')
+parser.add_argument('--regenerate', type=str2bool, default=False,
+                    help='Flag, generate a new apikey even for devices whose apikey in the device file still works')
+parser.add_argument('--resume', type=str2bool, default=False,
+                    help='Flag, continue an interrupted run: skip the devices which already got a key in its journal')
+parser.add_argument('--journal_file', default=None,
+                    help='Journal of the keys of a run, until they are in the device file (default '
+                         '".<device file>.keygen.jsonl" next to the device file)')
 args = parser.parse_args()
 
 # Some variables for use with API (pyfgt)
-api_timeout = 30
+api_timeout = args.timeout
 api_dis_req_warnings = True
+FortiGateApiUtils.API_TIMEOUT = args.timeout
 
 args.verbose = False # Verbosity with paramiko input/output not yet working, so overriding this argument
 
@@ -95,6 +127,173 @@ def check_vdom_mode(my_api):
     else:
         return True
 
+def apikey_still_valid(fg_info):
+    """
+    Use api with the apikey already in the device file for fg_info (its DeviceRecord).  True if it still
+    authenticates and --api_user has --accprof, then there is nothing to do via SSH.
+    """
+    fgt = FortiGateApiUtils(device={'name': fg_info.name, 'ip': fg_info.ip, 'apikey': fg_info.apikey,
+                                    'use_ssl': fg_info.use_ssl}, verbose=args.verbose, debug=args.debug)
+    try:
+        result, msg = fgt.login()
+        if not result:
+            return False
+        api_user = get_api_user(fgt.api, args.api_user)
+        return bool(api_user) and api_user['results'][0].get('accprofile') == args.accprof
+    except (FGTBaseException, FGTValueError, FGTResponseNotFormedCorrect, FGTConnectionError, FGTConnectTimeout):
+        return False
+    finally:
+        fgt.logout()
+
+def provision_device(fg):
+    """
+    Create accprof and api-user on a single FG from the device file (via SSH where needed) and generate
+    its api key, returns (result, apikey or failure reason).  inventory is only read, the caller records the key.
+    """
+    # DeviceRecord of this fg from the device file
+    fg_info = inventory.devices[fg]
+    print(f'Processing: {fg} at ip {fg_info.ip}: ')
+
+    # Check to see if name of fg contains a word we want to skip, then skip
+    if args.skip_list and any(skip_word in fg for skip_word in skip_list):
+        print(f' Skipping: {fg} appears to be non-fortigate device (skip_list)')
+        return False, 'Skipped (skip_list)'
+
+    # If the apikey from an earlier run still works there is no need for a new one
+    if fg_info.apikey and not args.regenerate:
+        # On its own line, the login prints "using apikey"
+        print('  Check existing apikey')
+        if apikey_still_valid(fg_info):
+            print('  Existing apikey is valid, skipping SSH')
+            return True, fg_info.apikey
+        print('  Existing apikey not usable, generating a new one')
+
+    # Check that the data necessary for API and SSH access exists for the device ("ip" always does)
+    for key in ('login', 'password'):
+        if getattr(fg_info, key) is None:
+            print(f'  "{key}" not defined for FG, continue to next FG if any')
+            return False, f'"{key}" not defined for FG'
+
+    # Instantiate pyfgt object
+    api = FortiGate(fg_info.ip, fg_info.login, passwd=fg_info.password, debug=args.debug,
+                    disable_request_warnings=api_dis_req_warnings, timeout=api_timeout,
+                    use_ssl=fg_info.use_ssl)
+
+    # Attempt login to FG API to check valid
+    try:
+        api.login()
+    except (FGTConnectionError, FGTConnectTimeout) as e:
+        print(f'  Login to FG failed: {e}, continue to next FG if any')
+        return False, f'Login failed: {e}'
+
+    client = paramiko.client.SSHClient()
+    try:
+        return provision_logged_in(api, client, fg_info)
+    except (FGTBaseException, FGTConnectionError, FGTConnectTimeout, paramiko.SSHException, OSError, EOFError) as e:
+        reason = f'{type(e).__name__}: {e}' if str(e) else type(e).__name__
+        print(f'  Failed: {reason}, continue to next FG if any')
+        return False, reason
+    finally:
+        # Close out connections to FG
+        try:
+            api.logout()
+        except (FGTBaseException, FGTConnectionError, FGTConnectTimeout):
+            pass
+        client.close()
+
+
+def provision_logged_in(api, client, fg_info):
+    """
+    provision_device once logged in to the api, client is a paramiko SSHClient not yet connected.
+    All cli commands go down a single interactive SSH channel in one batch.
+    """
+    # Check to see if if fg is in vdom mode
+    # If it is, then wrap the cli commands in config global and end
+    if check_vdom_mode(api):
+        print('  vdom-mode is: multi-vdom')
+        pre_cmds = ['config global']
+        post_cmds = ['end']
+    else:
+        print('  vdom-mode is: no-vdom ')
+        pre_cmds = []
+        post_cmds = []
+
+    # Only create the profile via SSH if it does not exist
+    print(f'  Check for account profile "{args.accprof}": ', end='')
+    if args.accprof == 'super_admin' or get_accprof(api, args.accprof):
+        print('Found')
+        accprof_cmds = []
+    else:
+        print('Not Found')
+        # Commands to create rw accprof
+        accprof_cmds = [f'config system accprofile', f'edit {args.accprof}'] + \
+                       [f'set {group} read-write' for group in ('secfabgrp', 'ftviewgrp', 'authgrp', 'sysgrp',
+                                                                'netgrp', 'loggrp', 'fwgrp', 'vpngrp', 'utmgrp',
+                                                                'wanoptgrp', 'wifi')] + \
+                       ['next', 'end']
+
+    # Add the api-user, or update it if it exists, and generate its api key
+    api_user_cmds = ['config system api-user', f'edit {args.api_user}', f'set accprofile {args.accprof}',
+                     f'set vdom {args.vdom}', 'next', 'end']
+    keygen_cmd = f'execute api-user generate-key {args.api_user}'
+
+    # Even if accprof and api-user exist (identified by api calls)
+    # we will need to re-generate the api key via SSH
+    host, port = device_address(fg_info, port=fg_info.ssh_port)
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(host, port=port, username=fg_info.login, password=fg_info.password,
+                   timeout=args.ssh_timeout, banner_timeout=args.ssh_timeout, auth_timeout=args.ssh_timeout)
+    commands = pre_cmds + accprof_cmds + api_user_cmds + [keygen_cmd] + post_cmds
+    print(f'  Run {len(commands)} cli commands via SSH: ', end='')
+    shell = FortiOSShell(client, timeout=args.ssh_timeout)
+    try:
+        outputs = shell.run(commands)
+    finally:
+        shell.close()
+    rejected = [(command, output) for command, output in outputs if shell.failed(output)]
+    print('Done' if not rejected else f'{len(rejected)} rejected')
+    for command, output in rejected:
+        print(f'    "{command}": {output.strip().splitlines()[-1]}')
+
+    # Check via API if accprofile now exists
+    if accprof_cmds:
+        print(f'  Create acccprofile "{args.accprof}": ', end='')
+        if get_accprof(api, args.accprof):
+            print('Success')
+        else:
+            print('Failed')
+            print('  Moving to next FG if any')
+            return False, f'Failed to create accprofile {args.accprof}'
+
+    # Check via api if api-user now exists
+    print(f'  Add/update api-user "{args.api_user}": ', end='')
+    result = get_api_user(api, args.api_user)
+    if result and result['results'][0].get('accprofile') == args.accprof:
+        print('Success')
+    else:
+        print('Failed')
+        print('  Moving to next FG, if any are left...')
+        return False, f'Failed to create api-user {args.api_user}'
+
+    # The api key is in the output of the keygen command, "New API key: <key>"
+    print(f'  Generate and retrieve API key for {args.api_user}: ', end='')
+    match = re.search(r'New API key: (\S+)', dict(outputs).get(keygen_cmd, ''))
+    if match and len(match.group(1)) == 30:
+        print(match.group(1))
+        return True, match.group(1)
+
+    print('Failed')
+    return False, 'Failed to generate api key'
+
+
+def provision_and_journal(fg):
+    """ provision_device, with the key journaled as soon as the device has it """
+    result, msg = provision_device(fg)
+    if result:
+        journal.append(fg, msg, 'kept' if msg == inventory.devices[fg].apikey else 'generated')
+    return result, msg
+
+
 #######################
 # Main
 #######################
@@ -109,8 +308,8 @@ if __name__ == '__main__':
             raise SystemExit
 
     # Read device details from file
-    fgs = read_device_file(args.device_file)
-    if not fgs:
+    inventory = read_device_file(args.device_file)
+    if not inventory:
         print("!!! Failed to read device file.  Aborting")
         raise SystemExit
 
@@ -123,156 +322,46 @@ if __name__ == '__main__':
             print(f'Error reading skip list, aborting: {e}')
             raise SystemExit
 
-    # Process each entry under fortigates in yaml file
-    for fg in fgs['fortigates']:
-        print(f'Processing: {fg} at ip {fgs["fortigates"][fg]["ip"]}: ')
-
-        # Check to see if name of fg contains a word we want to skip, then skip
-        if args.skip_list and any(skip_word in fg for skip_word in skip_list):
-            print(f' Skipping: {fg} appears to be non-fortigate device (skip_list)')
-            continue
-
-        # Just to make it easier later, add the details of this fg to fg_info
-        # Allows to not have to reference keys/values with long fgs['fortigates'][fg]['key']
-        fg_info = fgs['fortigates'][fg]
-
-        # Check that the data necessary for API and SSH access exists in the fg_info dict()
-        if not 'ip' in fg_info :
-            raise ValueError('"ip" not defined for FG')
-        if not 'login' in fg_info:
-            raise ValueError('"login" not defined for FG')
-        if not 'password' in fg_info:
-            raise ValueError('"password" not defined for FG')
-
-        # Instantiate pyfgt object
-        api = FortiGate(fg_info['ip'], fg_info['login'], passwd=fg_info['password'], debug=args.debug,
-                        disable_request_warnings=api_dis_req_warnings, timeout=api_timeout)
-
-        # Attempt login to FG API to check valid
-        try:
-            api.login()
-        except (FGTConnectionError, FGTConnectTimeout) as e:
-            print(f'  Login to FG failed: {e}, continue to next FG if any')
-            continue
-
-        # Check to see if if fg is in vdom mode
-        # If it is, then add config global and end to pre/post cmds
-        if check_vdom_mode(api):
-            vdom_mode = True
-            print('  vdom-mode is: multi-vdom')
-            pre_cmd = 'config global\n'
-            post_cmd = 'end\n'
-        else:
-            vdom_mode = False
-            print('  vdom-mode is: no-vdom ')
-            pre_cmd = ''
-            post_cmd = ''
-
-        # Create Paramiko SSH connection
-        # Even if accprof and api-user exist (identified by api calls)
-        # we will need to re-generate the api key via SSH
-        client = paramiko.client.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(fg_info['ip'], username=fg_info['login'], password=fg_info['password'])
-        
-        # If the profile does not exist then create it via SSH
-        print(f'  Check for account profile "{args.accprof}": ', end='')
-        if args.accprof == 'super_admin':
-            print('Found')
-        else:
-            if get_accprof(api, args.accprof):
-                print('Found')
-            else:
-                print('Not Found')
-                print(f'    Create acccprofile "{args.accprof}" via SSH:', end='')
-                # Command to create rw accprof
-                cmd = f"""
-                    config system accprof
-                    edit {args.accprof}
-                    set secfabgrp read-write
-                    set ftviewgrp read-write
-                    set authgrp read-write
-                    set sysgrp read-write
-                    set netgrp read-write
-                    set loggrp read-write
-                    set fwgrp read-write
-                    set vpngrp read-write
-                    set utmgrp read-write
-                    set wanoptgrp read-write
-                    set wifi read-write
-                    next
-                    end
-                    
-                """
-                # SSH execute create accprof cmd
-                _stdin, _stdout, _stderr = client.exec_command(pre_cmd + cmd + post_cmd)
-
-                # Check via API if accprofile now exists
-                if get_accprof(api, args.accprof):
-                    print('Success')    
-                else:
-                    print('Failed')
-                    print('  Moving to next FG if any')
-                    continue
-
-        # Check existence of, and, if needed, add api-user
-        print(f'  Add/update api-user "{args.api_user}": ', end='')
-        cmd = f"""
-            config system api-user
-            edit {args.api_user}
-            set accprofile {args.accprof}
-            set vdom {args.vdom}
-            next
-            end
-
-        """
-
-        # SSH execute create accprof cmd
-        _stdin, _stdout, _stderr = client.exec_command(pre_cmd + cmd + post_cmd)
-
-        # Check via api if api-user now exists
-        result = get_api_user(api, args.api_user)
+    # Keys from an interrupted run are already in use by their devices, add them before anything else
+    journal = KeyJournal(args.journal_file or journal_file_for(args.device_file))
+    journaled = {fg: record for fg, record in journal.replay().items() if fg in inventory.devices}
+    if journaled:
+        print(f'Adding {len(journaled)} api key(s) from the journal of an interrupted run ({journal.path})')
+        for fg, record in journaled.items():
+            inventory.set_apikey(fg, record['apikey'])
+
+    # Process each entry under fortigates in yaml file, --workers of them at a time
+    run_start = time.monotonic()
+    fg_names = list(inventory.devices)
+    todo = [fg for fg in fg_names if not (args.resume and fg in journaled)]
+    if len(todo) < len(fg_names):
+        print(f'Resuming, skipping {len(fg_names) - len(todo)} device(s) which already got a key')
+    device_results = dict(zip(todo, run_parallel(provision_and_journal, todo, workers=args.workers)))
+    results = [device_results.get(fg, ((True, inventory.devices[fg].apikey), 0.0)) for fg in fg_names]
+
+    # Record the new apikeys, only here in the main thread once every device is done
+    existing_keys = {fg_info.apikey for fg_info in inventory.devices.values()} - {None}
+    for fg, ((result, msg), elapsed) in zip(fg_names, results):
         if result:
-            if result['results'][0].get('accprofile') == args.accprof:
-                print('Success')    
+            inventory.set_apikey(fg, msg)
+
+    # Summary of results, in the same order as the device file
+    if args.workers > 1:
+        print()
+        rows = []
+        for fg, ((result, msg), elapsed) in zip(fg_names, results):
+            if not result:
+                detail = str(msg)[:80]
+            elif fg not in device_results:
+                detail = 'Key from journal'
             else:
-                print('Failed')
-                print('  Moving to next FG, if any are left...')
-        else:
-            print('Failed')
-            print('  Moving to next FG, if any are left...')
-            continue
-
-        # Execute api keygen via SSH
-        print(f'  Generate and retrieve API key for {args.api_user} via SSH: ', end='')
-        cmd = f'execute api-user generate-key {args.api_user}\n'
-        _stdin, _stdout, _stderr = client.exec_command(pre_cmd + cmd + post_cmd)
-        result = _stdout.read().decode()
-
-        if 'New API key:' in result:
-            # SSH command causes multiple lines of response, need to pull out the api key from it.
-            # The response is on a different line when vdom mode vs no vdom.
-            if vdom_mode:
-                apikey = result.splitlines()[2].rsplit(' ', 1)[1]
-            else:
-                apikey = result.splitlines()[1].rsplit(' ', 1)[1]
-
-            if len(apikey) == 30:
-                print(f'{apikey}')
-
-                # Update the fg device info dictionary with the new apikey
-                fgs['fortigates'][fg]['apikey'] = apikey
-
-            else:
-                print("Failed")
-
-        else:
-            print('Failed')
-
-        # Close out connections to FG
-        api.logout()
-        client.close()
-
+                detail = 'Existing apikey valid' if msg in existing_keys else 'New apikey'
+            rows.append([fg, inventory.devices[fg].ip, 'Success' if result else 'Failed',
+                         f'{elapsed:.1f}', detail])
+        print_result_table(rows, ['Device', 'IP', 'Result', 'Time(s)', 'Detail'])
+    succeeded = sum(1 for (result, msg), elapsed in results if result)
+    print(f'Generated api keys for {succeeded} of {len(fg_names)} devices in {time.monotonic() - run_start:.1f}s '
+          f'using {args.workers} worker(s)')
 
     print('########################################')
 
@@ -283,13 +372,20 @@ if __name__ == '__main__':
     except (shutil.Error):
         print('Could not copy device file for safe keeping')
 
-    # Overwrite device file with same details plus new apikeys
+    # Overwrite device file with same details plus new apikeys, by renaming a complete new file over it
     print('Overwite device file with new details to include apikey')
     try:
-        with open(args.device_file, 'w') as f:
-            yaml.dump(fgs, f)
-    except (FileNotFoundError, FileExistsError) as e:
-        print(f'!!! ERROR Writing File {e}')
+        # The new file keeps the permissions of the one it replaces, such as owner only for a file of secrets
+        mode = os.stat(args.device_file).st_mode & 0o777
+        with AtomicFileWriter(args.device_file, mode=mode) as writer:
+            writer.write(yaml.dump(inventory.data).encode())
+            writer.commit()
+    except OSError as e:
+        journal.close()
+        print(f'!!! ERROR Writing File {e}, the api keys are kept in {journal.path} for the next run')
+    else:
+        # All keys are in the device file now
+        journal.remove()
 
     print('########################################')
 
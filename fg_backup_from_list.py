@@ -46,13 +46,24 @@ lab_name: "this_is_my_lab_name"
 """
 
 from modules.fortigate_api_utils import *
+from modules.fortigate_async_api_utils import FortiGateAsyncApiUtils
+from modules import instrumentation
 from modules.common import *
+from modules.backup_store import BackupStore, MANIFEST_FILE
+from modules.backup_archive import BackupArchive, ARCHIVE_EXTENSION
+from modules.backup_state import BackupState
+from modules.parallel_utils import run_parallel, run_parallel_async, print_result_table
+from modules.session_pool import MAX_SESSIONS
+from modules.reachability import DeviceHealth, check_reachability, PROBE_TIMEOUT
 import argparse
+import asyncio
 from str2bool import str2bool
 import os
+import shutil
 import sys
 import datetime
 import json
+import time
 
 
 # Arguments
@@ -74,12 +85,234 @@ parser.add_argument('--skip_list', type=str, default=None,
                        help='Optionally, provide path to file with list of words in which if the word is in the name '
                             'of any of the device\'s names in yaml file, backups for that device will be skipped. '
                             'If not defined, no name checks will be performed')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of devices to back up concurrently (default 1, sequential)')
+parser.add_argument('--timeout', type=int, default=FortiGateApiUtils.API_TIMEOUT,
+                    help='API timeout in seconds per request until a device has answered, after that the '
+                         'timeouts of a device follow its observed response times (up to 4 times this)')
+parser.add_argument('--async_api', type=str2bool, default=False,
+                    help='Flag, use the asyncio api client, allows many more concurrent --workers per process')
+parser.add_argument('--connection_limit', type=int, default=FortiGateAsyncApiUtils.CONNECTION_LIMIT,
+                    help='Max concurrent http connections shared by all devices when using --async_api')
+parser.add_argument('--max_sessions', type=int, default=MAX_SESSIONS,
+                    help='Max keep-alive sessions (one per device) kept open for reuse by later api calls to the same '
+                         'device, raised to --workers if lower')
+parser.add_argument('--retries', type=int, default=FortiGateApiUtils.API_RETRIES,
+                    help='Times an idempotent api call (status check, backup) is retried, after a random backoff, '
+                         'on a connection error or timeout.  Upgrade and restore requests are never retried')
+parser.add_argument('--connect_timeout', type=float, default=FortiGateApiUtils.CONNECT_TIMEOUT,
+                    help='Seconds to wait for a connection to a device, lower values fail unreachable devices faster')
+parser.add_argument('--trace_file', type=str, default=None,
+                    help='Append a json line per api call and file operation (duration, bytes in/out, status) to '
+                         'this file')
+parser.add_argument('--metrics_file', type=str, default=None,
+                    help='Write a Prometheus textfile summary (duration percentiles, bytes, errors per operation) '
+                         'to this file at the end of the run, such as into the node_exporter textfile directory')
+parser.add_argument('--reachability_check', type=str2bool, default=False,
+                    help='Flag, before any api call try a TCP connection to every device at once and skip the devices '
+                         'not accepting one within --probe_timeout.  Only the api port is tried: the port in the '
+                         'device\'s ip, otherwise 443 (80 with use_ssl false)')
+parser.add_argument('--probe_timeout', type=float, default=PROBE_TIMEOUT,
+                    help='Seconds to wait for a connection in the reachability check')
+parser.add_argument('--health_file', type=str, default=None,
+                    help='With --reachability_check, file recording failed checks between runs, devices failing '
+                         'repeatedly are skipped without a check until their cooldown passes.  Without it every '
+                         'device is checked on every run')
+parser.add_argument('--recheck_unreachable', type=str2bool, default=False,
+                    help='Flag, check devices known to be unreachable from --health_file anyway')
+parser.add_argument('--output_format', type=str, choices=['flat', 'store', 'archive'], default='flat',
+                    help='flat="one plain .conf file per device (default)", '
+                         'store="content addressed store in <backup_dir>/.store, each distinct config is kept '
+                         'once and run directories hold hard links plus a manifest.json", '
+                         'archive="one compressed <date>-<lab_name>.fgz archive per run in <backup_dir> '
+                         'with an .index.json of each device\'s config"')
+parser.add_argument('--skip_unchanged', type=str2bool, default=False,
+                    help='Flag, first check the config checksum of each device (cheap api call) and only download '
+                         'the full config if it changed since the last backup recorded in '
+                         '<backup_dir>/.backup_state.json, otherwise the previous backup is reused for this run')
 args = parser.parse_args()
 
+
+def get_device_details(fg):
+    """
+    Print the device header and return the device dict for the api clients for fg,
+    or None if the device should be skipped (skip_list).
+    """
+    device = inventory.devices[fg]
+    print(f'Backup: {fg} at IP {device.ip}: ', end='')
+
+    # Check to see if name of fg contains a word we want to skip, then skip
+    if args.skip_list:
+        if any(skip_word in fg for skip_word in skip_list):
+            print(f' Skipping, {fg} appears to be non-fortigate device')
+            return None
+
+    if fg in unreachable:
+        print(f' Skipping, {unreachable[fg]}')
+        return None
+
+    if device.login is None and device.apikey is None:
+        raise ValueError("Neither \"login\" no \"apikey\" provided")
+
+    # Backups are named by the device's own "name" in the device file, if it has one
+    return dict(device.as_device(), name=device.file_name)
+
+
+def store_backup(fg, backup_file, fingerprint=None, facts=None):
+    """
+    Apply --output_format to a completed backup_file.  For store, move it into the store
+    and record it for the run manifest.  For archive, compress it into the run archive
+    and remove it.  With --skip_unchanged the backup state of the device is also updated.
+    facts (model, version, serial, ... from the login) are recorded in the manifest/archive index.
+    Returns the location of the backup to report.
+    """
+    location = backup_file
+    if args.output_format == 'store':
+        with instrumentation.recorder.span('file store', fg) as span:
+            entry = store.add_file(backup_file)
+            span.bytes_in = entry['size']
+        entry['file'] = os.path.basename(backup_file)
+        entry['facts'] = facts
+        store_entries[fg] = entry
+        # Stored objects outlive run directories, so remember the object for reuse next run
+        state_path, in_archive = store.object_path(entry['sha256']), False
+    elif args.output_format == 'archive':
+        with instrumentation.recorder.span('file archive', fg) as span:
+            entry = archive.add(fg, backup_file)
+            span.bytes_in, span.bytes_out = entry['raw_size'], entry['size']
+        entry['facts'] = facts
+        os.unlink(backup_file)
+        location = f'{archive.archive_path} [{fg}]'
+        state_path, in_archive = archive.archive_path, True
+    else:
+        state_path, in_archive = backup_file, False
+
+    if args.skip_unchanged:
+        state.update(fg, fingerprint, state_path, archive=in_archive)
+    return location
+
+
+def reuse_unchanged_backup(fg, fingerprint):
+    """
+    With --skip_unchanged, if fingerprint shows the config of fg is unchanged since its last backup,
+    recreate that backup for this run and return the file path.  Otherwise return None.
+    """
+    if not args.skip_unchanged or not state.unchanged(fg, fingerprint):
+        return None
+    unchanged.add(fg)
+    if args.verbose:
+        print('Unchanged, reusing previous backup ', end='')
+    return state.reuse_backup(fg, f'{backup_dir}/{date_tag}{inventory.devices[fg].file_name}{backup_tag}.conf')
+
+
+def print_backup_result(result, msg):
+    if result:
+        print('Success')
+        if args.verbose:
+            print(f'  file-> {msg}')
+    else:
+        print(f'Failed {msg}')
+
+
+def backup_device(fg):
+    """
+    Login, backup and logout of a single FG from the device file.
+    Returns tuple of (result, msg) where msg is the backup file path on success.
+    """
+    device_details = get_device_details(fg)
+    if device_details is None:
+        return False, unreachable.get(fg, 'Skipped (skip_list)')
+
+    # Create instances of fg_api_utils with device details
+    fgt = FortiGateApiUtils(device=device_details, verbose=args.verbose, debug=args.debug)
+    try:
+        r, msg = fgt.login()
+    except Exception as e:
+        print(f'Failed to login to FGT: \n  {e}')
+        return False, 'Failed to login'
+
+    if r is False:
+        print(f'Failed {msg}')
+        return False, msg
+
+    # Execute backup using fortigate_api_utils.backup_to_file, unless a cheap config
+    # checksum check (--skip_unchanged) shows the last backup of this device is still current
+    fingerprint = None
+    try:
+        if args.skip_unchanged:
+            fingerprint = fgt.get_config_fingerprint()
+        msg = reuse_unchanged_backup(fg, fingerprint)
+        if msg:
+            result = True
+        else:
+            result, msg = fgt.backup_to_file(backup_dir=backup_dir, date=date_tag, file_tag=backup_tag)
+    except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
+        print(f'Error initiating backup API call to FG: \n  {e}')
+        return False, 'Error initiating backup API call'
+    finally:
+        fgt.logout()
+
+    if fgt.facts is not None:
+        device_facts[fg] = fgt.facts.as_dict()
+    if result:
+        msg = store_backup(fg, msg, fingerprint, device_facts.get(fg))
+    print_backup_result(result, msg)
+    return result, msg
+
+
+async def backup_device_async(fg):
+    """ Same as backup_device, using the asyncio api client (--async_api true) """
+    device_details = get_device_details(fg)
+    if device_details is None:
+        return False, unreachable.get(fg, 'Skipped (skip_list)')
+
+    fgt = FortiGateAsyncApiUtils(device=device_details, verbose=args.verbose, debug=args.debug)
+    try:
+        r, msg = await fgt.login()
+    except Exception as e:
+        print(f'Failed to login to FGT: \n  {e}')
+        return False, 'Failed to login'
+
+    if r is False:
+        print(f'Failed {msg}')
+        return False, msg
+
+    fingerprint = None
+    try:
+        if args.skip_unchanged:
+            fingerprint = await fgt.get_config_fingerprint()
+        msg = await asyncio.to_thread(reuse_unchanged_backup, fg, fingerprint)
+        if msg:
+            result = True
+        else:
+            result, msg = await fgt.backup_to_file(backup_dir=backup_dir, date=date_tag, file_tag=backup_tag)
+    except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
+        print(f'Error initiating backup API call to FG: \n  {e}')
+        return False, 'Error initiating backup API call'
+    finally:
+        await fgt.logout()
+
+    if fgt.facts is not None:
+        device_facts[fg] = fgt.facts.as_dict()
+    if result:
+        msg = await asyncio.to_thread(store_backup, fg, msg, fingerprint, device_facts.get(fg))
+    print_backup_result(result, msg)
+    return result, msg
+
+
 #######################
 # Main
 #######################
 if __name__ == '__main__':
+    # Keep-alive session per device, reused by every api call to it during the run
+    FortiGateApiUtils.configure_sessions(max_sessions=max(args.max_sessions, args.workers))
+    # Retries and connect timeout of the per device timeout policy
+    FortiGateApiUtils.API_RETRIES = args.retries
+    FortiGateApiUtils.CONNECT_TIMEOUT = args.connect_timeout
+
+    # Timing of every api call and file operation, for --trace_file/--metrics_file
+    instrumentation.configure(args.trace_file, args.metrics_file, script='fg_backup_from_list')
+
     # Check if --device_file or --yaml_dir parameters passed
     if not args.device_file:
         if args.yaml_dir:
@@ -101,8 +334,8 @@ if __name__ == '__main__':
 
     # Read device details from file
     # From modules/common call read_device_file
-    fgs = read_device_file(args.device_file)
-    if not fgs:
+    inventory = read_device_file(args.device_file)
+    if not inventory:
         print("!!! Failed to read device file.  Aborting")
         raise SystemExit
 
@@ -115,9 +348,14 @@ if __name__ == '__main__':
             print(f'Error reading skip list, aborting: {e}')
             sys.exit()
 
+    # Apply API timeout for all devices in this run
+    FortiGateApiUtils.API_TIMEOUT = args.timeout
+    FortiGateAsyncApiUtils.API_TIMEOUT = args.timeout
+
     # Some logic for some file tagging options that can be derived from the yaml file
-    if args.lab_name_from == 'yaml' and 'lab_name' in fgs:
-            lab_name = fgs['lab_name']
+    lab_name = ''
+    if args.lab_name_from == 'yaml' and 'lab_name' in inventory.data:
+            lab_name = inventory.data['lab_name']
 
     if args.lab_name_from == 'prompt':
         print('Enter lab name for use in file naming (concise)')
@@ -131,7 +369,14 @@ if __name__ == '__main__':
     else:
         backup_tag = ''
 
-    if args.create_new_dir:
+    if args.output_format == 'archive':
+        # Backups are staged in a hidden directory then compressed into a single archive for the run
+        archive = BackupArchive(f'{args.backup_dir}/{date_tag}{backup_tag}{ARCHIVE_EXTENSION}')
+        backup_dir = f'{args.backup_dir}/.staging-{date_tag}{backup_tag}'
+        date_tag = ''
+        backup_tag = ''
+        os.makedirs(backup_dir, exist_ok=True)
+    elif args.create_new_dir:
         backup_dir = f'{args.backup_dir}/{date_tag}{backup_tag}'
         # date tag and backup tag used in dir name, so don't need in file name, reset these vars
         date_tag = ''
@@ -145,50 +390,69 @@ if __name__ == '__main__':
     else:
         backup_dir = args.backup_dir
 
-    # Process each entry under fortigates in yaml file
-    for fg in fgs['fortigates']:
-        print(f'Backup: {fg} at IP {fgs["fortigates"][fg]["ip"]}: ', end='')
+    # Persisted per-device config fingerprints from previous runs, for --skip_unchanged
+    unchanged = set()
+    if args.skip_unchanged:
+        state = BackupState(args.backup_dir)
 
-        # Check to see if name of fg contains a word we want to skip, then skip
-        if args.skip_list:
-            if any(skip_word in fg for skip_word in skip_list):
-                print(f' Skipping, {fg} appears to be non-fortigate device')
-                continue
+    # Content addressed store, needs a directory per run to hold the run manifest
+    store_entries = {}
+    if args.output_format == 'store':
+        if not args.create_new_dir:
+            print('--output_format store requires --create_new_dir true, aborting')
+            sys.exit()
+        store = BackupStore(args.backup_dir)
 
-        # Create a dictionary of details for the current fg
-        device_details = fgs['fortigates'][fg]
-        if 'name' not in device_details:
-            device_details['name'] = fg
+    # Skip devices which don't accept a connection (or are known to be down) rather than waiting on each login
+    unreachable = {}
+    if args.reachability_check:
+        health = DeviceHealth(args.health_file) if args.health_file else None
+        unreachable = check_reachability(inventory.devices, list(inventory.devices), timeout=args.probe_timeout,
+                                         health=health, recheck=args.recheck_unreachable)
 
-        if 'login' not in device_details:
-            if 'apikey' in device_details:
-                device_details['login'] = 'apiadmin'
-            else:
-                raise ValueError("Neither \"login\" no \"apikey\" provided")
+    # Model, version, serial, ... of each device, from its login status check
+    device_facts = {}
 
+    # Process each entry under fortigates in yaml file, --workers of them at a time
+    run_start = time.monotonic()
+    fg_names = list(inventory.devices)
+    if args.async_api:
+        results = run_parallel_async(backup_device_async, fg_names, workers=args.workers,
+                                     setup=lambda: FortiGateAsyncApiUtils.open_session(args.connection_limit),
+                                     teardown=FortiGateAsyncApiUtils.close_session)
+    else:
+        results = run_parallel(backup_device, fg_names, workers=args.workers)
 
-        # Create instances of fg_api_utils with device details
-        fgt = FortiGateApiUtils(device=device_details, verbose=args.verbose, debug=args.debug)
-        try:
-            r, msg = fgt.login()
-        except Exception as e:
-            print(f'Failed to login to FGT: \n  {e}')
-            continue
+    # Summary of results, in the same order as the device file
+    if args.workers > 1 or args.verbose:
+        print()
+        rows = []
+        for fg, ((result, msg), elapsed) in zip(fg_names, results):
+            facts = device_facts.get(fg, {})
+            rows.append([fg, inventory.devices[fg].ip, facts.get('model') or '',
+                         facts.get('version') or '', 'Success' if result else 'Failed', f'{elapsed:.1f}', msg])
+        print_result_table(rows, ['Device', 'IP', 'Model', 'Version', 'Result', 'Time(s)', 'Detail'])
 
-        if r is False:
-            print(f'Failed {msg}')
-            continue
+    if args.output_format == 'store':
+        # Manifest lists devices in the same order as the device file
+        store.write_manifest(backup_dir, {fg: store_entries[fg] for fg in fg_names if fg in store_entries})
+        new_configs = sum(1 for entry in store_entries.values() if entry['new'])
+        print(f'Store: {new_configs} new config(s) stored, {len(store_entries) - new_configs} unchanged '
+              f'config(s) deduplicated, manifest-> {backup_dir}/{MANIFEST_FILE}')
 
-        # Execute backup using fortigate_api_utils.backup_to_file
-        try:
-            result, msg = fgt.backup_to_file(backup_dir=backup_dir, date=date_tag, file_tag=backup_tag)
-        except (FGTBaseException, FGTValueError) as e:
-            print(f'Error initiating backup API call to FG: \n  {e}')
-            continue
-
-        if result:
-            print('Success')
-            if args.verbose:
-                print(f'  file-> {msg}')
-        else:
-            print(f'Failed {msg}')
+    if args.output_format == 'archive':
+        index = archive.close(device_order=fg_names)
+        # Only the staging dir of the archived files, anything left in it (such as a failed device's temp file) goes too
+        shutil.rmtree(backup_dir, ignore_errors=True)
+        raw_size = sum(entry['raw_size'] for entry in index['devices'].values())
+        size = sum(entry['size'] for entry in index['devices'].values())
+        print(f'Archive: {len(index["devices"])} config(s), {raw_size} bytes compressed to {size} bytes, '
+              f'archive-> {archive.archive_path}')
+
+    if args.skip_unchanged:
+        state.save()
+        print(f'Unchanged: {len(unchanged)} device(s) reused their previous backup without downloading the config')
+
+    succeeded = sum(1 for (result, msg), elapsed in results if result)
+    print(f'Backed up {succeeded} of {len(fg_names)} devices in {time.monotonic() - run_start:.1f}s '
+          f'using {args.workers} worker(s)')
@@ -0,0 +1,137 @@
+"""
+Compare two backup runs made by fg_backup_from_list.py and report which devices' configs changed
+and what changed, such as before and after a change window.
+
+Each run may be a run directory of .conf files, a store run directory (--output_format store) or
+a run archive (--output_format archive).  Configs are paired by device name across the two runs.
+Identical configs are skipped by hash first (ignoring volatile header fields like the backup user),
+using the hashes already recorded in store manifests and archive indexes where available.
+Changed configs are parsed and diffed in parallel across --workers processes.
+
+The diff is section aware, changes are grouped by config section (such as "system interface" or
+"vdom/root/firewall policy") as settings added, removed or changed, and added/removed entries
+(such as a whole new firewall policy) are reported once rather than setting by setting.
+A summary table is printed, --verbose true also prints each change, and --json_file writes the
+full structured report.
+"""
+
+from modules.backup_diff import diff_device
+from modules.backup_index import load_run
+from modules.file_utils import AtomicFileWriter
+from modules.parallel_utils import run_parallel_processes, print_result_table
+import argparse
+import datetime
+import json
+import os
+import time
+from str2bool import str2bool
+
+
+# Arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('--old_run', type=str, required=True,
+                    help='Earlier backup run, directory of .conf files, store run directory or .fgz archive')
+parser.add_argument('--new_run', type=str, required=True, help='Later backup run to compare against --old_run')
+parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                    help='Number of processes used to parse and diff changed configs (default: number of cpus)')
+parser.add_argument('--json_file', type=str, default=None, help='Write the full diff report as json to this file')
+parser.add_argument('--max_changes', type=int, default=50,
+                    help='With --verbose, max changes printed per device (the json report always has all)')
+parser.add_argument('--verbose', type=str2bool, default=False, help='Flag, print each change of each device')
+args = parser.parse_args()
+
+
+def count_changes(sections: dict):
+    return sum(len(items) for changes in sections.values() for items in changes.values())
+
+
+def section_summary(sections: dict):
+    """ Such as "system interface (+1 -0 ~2), firewall policy (+3 -0 ~0)" """
+    return ', '.join(f'{section} (+{len(c["added"])} -{len(c["removed"])} ~{len(c["changed"])})'
+                     for section, c in sections.items())
+
+
+def print_changes(report: dict):
+    print(f'{report["device"]}:')
+    if 'version' in report:
+        print(f'  version {report["version"]["old"]} -> {report["version"]["new"]}')
+    printed = 0
+    for section, changes in report['sections'].items():
+        print(f'  [{section}]')
+        lines = [f'    + {item["path"]} {item.get("value") or item.get("block")}' for item in changes['added']]
+        lines += [f'    - {item["path"]} {item.get("value") or item.get("block")}' for item in changes['removed']]
+        lines += [f'    ~ {item["path"]} {item["old"]} -> {item["new"]}' for item in changes['changed']]
+        for line in lines:
+            if printed == args.max_changes:
+                print(f'    ... {count_changes(report["sections"]) - printed} more, see --json_file for all changes')
+                return
+            print(line)
+            printed += 1
+
+
+#######################
+# Main
+#######################
+if __name__ == '__main__':
+    try:
+        old_sources = load_run(args.old_run)
+        new_sources = load_run(args.new_run)
+    except (OSError, KeyError, ValueError) as e:
+        print(f'Error reading backup runs, aborting: {e}')
+        raise SystemExit
+
+    # Pair devices by name, in the order of the new run
+    devices = [d for d in new_sources if d in old_sources]
+    only_old = [d for d in old_sources if d not in new_sources]
+    only_new = [d for d in new_sources if d not in old_sources]
+
+    run_start = time.monotonic()
+    # Larger chunks cut inter process overhead when most devices are identical and only need hashing
+    chunksize = max(1, len(devices) // (args.workers * 8))
+    results = run_parallel_processes(diff_device, [(d, old_sources[d], new_sources[d]) for d in devices],
+                                     workers=args.workers, chunksize=chunksize)
+
+    reports = {}
+    rows = []
+    errors = 0
+    for device_name, ((result, report), elapsed) in zip(devices, results):
+        if not result:
+            errors += 1
+            rows.append([device_name, 'Error', '', report])
+            continue
+        reports[device_name] = report
+        if report['status'] == 'changed':
+            rows.append([device_name, 'Changed', count_changes(report['sections']),
+                         section_summary(report['sections']) or 'header only'])
+    for device_name in only_old:
+        rows.append([device_name, 'Missing', '', f'only in {args.old_run}'])
+    for device_name in only_new:
+        rows.append([device_name, 'New', '', f'only in {args.new_run}'])
+
+    changed = [r for r in reports.values() if r['status'] == 'changed']
+    if rows:
+        print_result_table(rows, ['Device', 'Status', 'Changes', 'Sections'])
+    if args.verbose:
+        for report in changed:
+            print()
+            print_changes(report)
+
+    summary = {'compared': len(devices), 'identical': len(reports) - len(changed), 'changed': len(changed),
+               'only_old': only_old, 'only_new': only_new, 'errors': errors}
+    if args.json_file:
+        output = {'old_run': args.old_run, 'new_run': args.new_run,
+                  'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                  'summary': summary, 'devices': reports}
+        try:
+            with AtomicFileWriter(args.json_file) as writer:
+                writer.write(json.dumps(output, indent=2).encode())
+                writer.commit()
+        except OSError as e:
+            print(f'Error writing json report {args.json_file}: {e}')
+
+    print()
+    print(f'Compared {len(devices)} devices: {summary["identical"]} identical, {len(changed)} changed, '
+          f'{errors} error(s), {len(only_old)} only in old run, {len(only_new)} only in new run '
+          f'in {time.monotonic() - run_start:.1f}s using {args.workers} worker(s)')
+    if args.json_file:
+        print(f'  report-> {args.json_file}')
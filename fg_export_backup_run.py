@@ -0,0 +1,46 @@
+"""
+Export a backup run created by fg_backup_from_list.py with "--output_format store" or
+"--output_format archive" to the plain flat layout, one independent <device>.conf copy per
+device in --dest_dir.
+
+Store run directories (--run_dir) hold hard links into <backup_dir>/.store plus a manifest.json.
+This script only needs the manifest, so it also rebuilds runs where hard links were not possible.
+Archives (--archive) are extracted one device at a time using the archive's .index.json.
+"""
+
+from modules.backup_store import export_run
+from modules.backup_archive import read_archive_index, extract_config
+import argparse
+import os
+
+
+# Arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('--run_dir', type=str, default=None, help='Store run directory (contains manifest.json)')
+parser.add_argument('--archive', type=str, default=None, help='Run archive (.fgz) to extract, instead of --run_dir')
+parser.add_argument('--dest_dir', type=str, required=True, help='Directory to write the flat .conf files to')
+args = parser.parse_args()
+
+#######################
+# Main
+#######################
+if __name__ == '__main__':
+    if not args.run_dir and not args.archive:
+        print('Must provide one of following parameters --run_dir or --archive, Aborting')
+        raise SystemExit
+
+    try:
+        if args.archive:
+            index = read_archive_index(args.archive)
+            os.makedirs(args.dest_dir, exist_ok=True)
+            written = [extract_config(args.archive, device_name, os.path.join(args.dest_dir, entry['file']), index)
+                       for device_name, entry in index['devices'].items()]
+        else:
+            written = export_run(args.run_dir, args.dest_dir)
+    except (OSError, KeyError, ValueError) as e:
+        print(f'Error exporting {args.run_dir or args.archive}, aborting: {e}')
+        raise SystemExit
+
+    for f in written:
+        print(f'  file-> {f}')
+    print(f'Exported {len(written)} config(s) to {args.dest_dir}')
@@ -8,7 +8,17 @@ a system restore.  For this an "api user" defined on FG must be created with rea
 as a result, this script first checks that an apikey was provided (not just admin/passwd).
 
 For each fortigate in the list look for possible matching configurations in the defined
-backup directory (--backup_dir).
+backup directory (--backup_dir).  --backup_dir may be a single run directory or the top level
+backup directory holding many runs (run directories, store runs and .fgz archives).  All backups
+under it are indexed by device name (persisted in <backup_dir>/.backup_index.json so later runs
+only rescan new or changed runs) and by default the newest backup of each device is restored.
+Use --backup_run to restore every device from one specific run instead.  Backup files are matched
+to devices by exact name (or <name>-<lab_name>), so "fg1" never picks up the backup of "fg10".
+
+Devices are restored --workers at a time, or with --waves in waves of increasing size, such as
+"--waves 1,10,50" to restore 1 canary device, then 10 devices concurrently, then 50 at a time for
+the rest.  If more than --max_failure_rate of the devices in a wave fail, no further waves are
+started and the remaining devices are reported as not attempted.
 
 The device yaml file needs to support format like:
 ----------------
@@ -34,11 +44,20 @@ be ignored.
 """
 
 from modules.fortigate_api_utils import *
+from modules.fortigate_async_api_utils import FortiGateAsyncApiUtils
+from modules import instrumentation
 from modules.common import *
+from modules.backup_index import BackupIndex, load_run, match_devices, source_file
+from modules.parallel_utils import run_parallel, run_parallel_async, plan_waves, print_result_table
+from modules.session_pool import MAX_SESSIONS
+from modules.reachability import DeviceHealth, check_reachability, PROBE_TIMEOUT
 import argparse
 from str2bool import str2bool
 import os
+import shutil
 import sys
+import tempfile
+import time
 
 
 # Arguments
@@ -53,15 +72,200 @@ parser.add_argument('--skip_list', type=str, default=None,
                     help='Optionally, provide path to file with list of words which if the word is in the name '
                          'of any of the devices names in yaml file, backups for that device will be skipped. '
                          'If not defined, no name checks will be performed')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of devices to restore concurrently (default 1, sequential)')
+parser.add_argument('--async_api', type=str2bool, default=False,
+                    help='Flag, use the asyncio api client instead of pyFGT')
+parser.add_argument('--connection_limit', type=int, default=FortiGateAsyncApiUtils.CONNECTION_LIMIT,
+                    help='Max concurrent http connections shared by all devices when using --async_api')
+parser.add_argument('--max_sessions', type=int, default=MAX_SESSIONS,
+                    help='Max keep-alive sessions (one per device) kept open for reuse by later api calls to the same '
+                         'device, raised to --workers if lower')
+parser.add_argument('--retries', type=int, default=FortiGateApiUtils.API_RETRIES,
+                    help='Times an idempotent api call (status check, backup) is retried, after a random backoff, '
+                         'on a connection error or timeout.  Upgrade and restore requests are never retried')
+parser.add_argument('--connect_timeout', type=float, default=FortiGateApiUtils.CONNECT_TIMEOUT,
+                    help='Seconds to wait for a connection to a device, lower values fail unreachable devices faster')
+parser.add_argument('--trace_file', type=str, default=None,
+                    help='Append a json line per api call and file operation (duration, bytes in/out, status) to '
+                         'this file')
+parser.add_argument('--metrics_file', type=str, default=None,
+                    help='Write a Prometheus textfile summary (duration percentiles, bytes, errors per operation) '
+                         'to this file at the end of the run, such as into the node_exporter textfile directory')
+parser.add_argument('--reachability_check', type=str2bool, default=False,
+                    help='Flag, before any api call try a TCP connection to every device at once and skip the devices '
+                         'not accepting one within --probe_timeout.  Only the api port is tried: the port in the '
+                         'device\'s ip, otherwise 443 (80 with use_ssl false)')
+parser.add_argument('--probe_timeout', type=float, default=PROBE_TIMEOUT,
+                    help='Seconds to wait for a connection in the reachability check')
+parser.add_argument('--health_file', type=str, default=None,
+                    help='With --reachability_check, file recording failed checks between runs, devices failing '
+                         'repeatedly are skipped without a check until their cooldown passes.  Without it every '
+                         'device is checked on every run')
+parser.add_argument('--recheck_unreachable', type=str2bool, default=False,
+                    help='Flag, check devices known to be unreachable from --health_file anyway')
+parser.add_argument('--backup_archive', type=str, default=None,
+                    help='Instead of --backup_dir, path to a .fgz run archive created by fg_backup_from_list.py '
+                         '"--output_format archive" to get configs for restore from')
+parser.add_argument('--backup_run', type=str, default=None,
+                    help='Name of a run under --backup_dir (run directory or .fgz archive name) to restore all '
+                         'devices from.  By default the newest backup of each device in --backup_dir is used')
+parser.add_argument('--rebuild_index', type=str2bool, default=False,
+                    help='Flag, ignore the persisted backup index and rescan every run in --backup_dir')
+parser.add_argument('--waves', type=str, default=None,
+                    help='Comma separated wave sizes such as "1,10,50", restore that many devices concurrently per '
+                         'wave, the last size is repeated for the remaining devices.  Overrides --workers')
+parser.add_argument('--max_failure_rate', type=float, default=0.0,
+                    help='With --waves, stop before the next wave if more than this fraction (0-1) of the devices '
+                         'in a wave failed (default 0.0, any failure stops the restore)')
 args = parser.parse_args()
 
-# Initialize vars
-config_file = False
+
+def get_device_details(fg):
+    """
+    Print the device header, run the pre-checks and return (device_details, config_file) for fg.
+    If the device can not be restored, device_details is None and config_file is the reason.
+    """
+    device = inventory.devices[fg]
+    print(f'Processing {fg} at IP: {device.ip}')
+
+    # Check if apikey is defined and is a string.  If not, stop processing
+    # this fortigate as cannot do restore unless using apikey for auth.
+    if device.apikey is None:
+        print('  Error: no apikey defined.  Restore of config requires apikey login on FG')
+        return None, 'No apikey defined'
+
+    # Check to see if name of fg contains a word we want to skip, then skip
+    if args.skip_list and any(skip_word in fg for skip_word in skip_list):
+        print(f' Skipping: {fg} appears to be non-fortigate device (skip_list)')
+        return None, 'Skipped (skip_list)'
+
+    if fg in unreachable:
+        print(f'  Skipping: {unreachable[fg]}')
+        return None, unreachable[fg]
+
+    # Device details for the api clients
+    device_details = device.as_device()
+
+    # Backup selected for this device from the index, configs in archives are extracted for just this device
+    version = selected.get(fg)
+    if version is None:
+        print('  Error: No Config file match found.')
+        return None, 'No Config file match found'
+    try:
+        config_file = source_file(version, extract_dir, f'{fg}.conf')
+    except (OSError, KeyError, ValueError) as e:
+        print(f'  Error: Unable to read config from {version["archive"]}: {e}')
+        return None, 'Unable to read config from archive'
+
+    if 'archive' in version:
+        print(f'  Restore Config:   {version["archive"]} [{version["device"]}]')
+    else:
+        print(f'  Restore Config:   {config_file}')
+    if args.verbose and 'time' in version:
+        print(f'  Backup Time:      {version["time"]}')
+
+    return device_details, config_file
+
+
+def restore_precheck(fg):
+    """ Reason fg will not be restored (checked before any waves start), or None if it can be """
+    if inventory.devices[fg].apikey is None:
+        return 'No apikey defined'
+    if args.skip_list and any(skip_word in fg for skip_word in skip_list):
+        return 'Skipped (skip_list)'
+    if fg in unreachable:
+        return unreachable[fg]
+    if fg not in selected:
+        return 'No Config file match found'
+    return None
+
+
+def run_restores(devices: list, workers: int):
+    """ Restore devices, workers at a time, returns list of ((result, msg), elapsed) in devices order """
+    if args.async_api:
+        return run_parallel_async(restore_device_async, devices, workers=workers,
+                                  setup=lambda: FortiGateAsyncApiUtils.open_session(args.connection_limit),
+                                  teardown=FortiGateAsyncApiUtils.close_session)
+    return run_parallel(restore_device, devices, workers=workers)
+
+
+def print_restore_result(result, msg):
+    if result:
+        print(f'  Success')
+    else:
+        print(f'  Failed: {msg}')
+
+
+def restore_device(fg):
+    """ Login and restore config to a single FG from the device file, returns (result, msg) """
+    device_details, config_file = get_device_details(fg)
+    if device_details is None:
+        return False, config_file
+
+    """ Create instances of fg_api_utils with device details """
+    fgt = FortiGateApiUtils(device=device_details, verbose=args.verbose, debug=args.debug)
+    try:
+        r, msg = fgt.login()
+    except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
+        print(f'  Connection/Login Failed: {e}')
+        return False, 'Connection/Login Failed'
+
+    # If login appears to have worked then continue to request restore
+    if r is not True:
+        print(f'  Failed: {msg}')
+        return False, msg
+
+    try:
+        result, msg = fgt.restore_config_from_file(config_file=config_file)
+    except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
+        print(f'  API Call to FGT Failed: {e}')
+        return False, 'API Call to FGT Failed'
+
+    print_restore_result(result, msg)
+    return result, msg
+
+
+async def restore_device_async(fg):
+    """ Same as restore_device, using the asyncio api client (--async_api true) """
+    device_details, config_file = get_device_details(fg)
+    if device_details is None:
+        return False, config_file
+
+    fgt = FortiGateAsyncApiUtils(device=device_details, verbose=args.verbose, debug=args.debug)
+    try:
+        r, msg = await fgt.login()
+    except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
+        print(f'  Connection/Login Failed: {e}')
+        return False, 'Connection/Login Failed'
+
+    if r is not True:
+        print(f'  Failed: {msg}')
+        return False, msg
+
+    try:
+        result, msg = await fgt.restore_config_from_file(config_file=config_file)
+    except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
+        print(f'  API Call to FGT Failed: {e}')
+        return False, 'API Call to FGT Failed'
+
+    print_restore_result(result, msg)
+    return result, msg
+
 
 #######################
 # Main
 #######################
 if __name__ == '__main__':
+    # Keep-alive session per device, reused by every api call to it during the run
+    FortiGateApiUtils.configure_sessions(max_sessions=max(args.max_sessions, args.workers))
+    # Retries and connect timeout of the per device timeout policy
+    FortiGateApiUtils.API_RETRIES = args.retries
+    FortiGateApiUtils.CONNECT_TIMEOUT = args.connect_timeout
+
+    # Timing of every api call and file operation, for --trace_file/--metrics_file
+    instrumentation.configure(args.trace_file, args.metrics_file, script='fg_restore_from_list')
+
     # Check if --device_file or --yaml_dir parameters passed
     if not args.device_file:
         if args.yaml_dir:
@@ -71,29 +275,46 @@ if __name__ == '__main__':
             print("Must provide one of following parameters --device_file or --yaml_dir, Aborting")
             raise SystemExit
 
-    if args.backup_dir:
+    if args.backup_dir and not args.backup_archive:
     # Make sure the target backup folder path exists, if provided. 
         if not os.path.exists(args.backup_dir):
             print(f"Error backup (restore from) directory path {args.backup_dir} is not valid, Aborting")
-    else:
+    elif not args.backup_archive:
         # If --backup_dir not provided as parmeter then prompt user for the path, validate it, then move on
         # From modules/common call get_user_dir_path
         args.backup_dir = get_user_dir_path('Backup/Restore')
 
     # Read device details from file, read_device_file from "common" module
-    fgs = read_device_file(args.device_file)
-    if not fgs:
+    inventory = read_device_file(args.device_file)
+    if not inventory:
         print("!!! Failed to read device file.  Aborting")
         raise SystemExit 
 
-    # Get list of files in backup_dir
-    try:
-        restore_files = os.listdir(args.backup_dir)
-    except OSError as e:
-        print(f'Error opening config file directory {args.backup_dir}, aborting: {e}')
-        raise SystemExit
-    if args.verbose:
-        print(f'Configurations List: {restore_files}')
+    # Select the backup to restore for each device, from the archive or the index of backup_dir
+    fg_names = list(inventory.devices)
+    if args.backup_archive:
+        # Read the archive index, configs are extracted from the archive one device at a time
+        try:
+            sources = load_run(args.backup_archive)
+        except (OSError, KeyError, ValueError) as e:
+            print(f'Error reading index for archive {args.backup_archive}, aborting: {e}')
+            raise SystemExit
+        selected = {device: sources[key] for key, device in match_devices(sources, fg_names).items()}
+    else:
+        try:
+            index = BackupIndex(args.backup_dir, rebuild=args.rebuild_index).refresh()
+        except OSError as e:
+            print(f'Error opening config file directory {args.backup_dir}, aborting: {e}')
+            raise SystemExit
+        index.save()
+        if args.backup_run is not None and args.backup_run not in index.runs:
+            print(f'Backup run {args.backup_run} not found in {args.backup_dir}, available runs: '
+                  f'{", ".join(r for r in index.run_names() if r) or "none"}')
+            raise SystemExit
+        selected = index.select(fg_names, run=args.backup_run)
+        if args.verbose:
+            print(f'Backup index: {len(index.devices)} backup name(s) in {len(index.runs)} run(s), '
+                  f'{len(selected)} of {len(fg_names)} devices have a backup to restore')
 
     # list of words that if in name of fg device then we will skip that device
     if args.skip_list:
@@ -104,61 +325,73 @@ if __name__ == '__main__':
             print(f'Error reading skip list, aborting: {e}')
             raise SystemExit
 
-    # Process each entry under fortigates in yaml file
-    for fg in fgs['fortigates']:
-        print(f'Processing {fg} at IP: {fgs["fortigates"][fg]["ip"]}')
-
-        # Check if apikey is defined and is a string.  If not, stop processing
-        # this fortigate as cannot do restore unless using apikey for auth.
-        if 'apikey' not in fgs['fortigates'][fg]:
-            print('  Error: no apikey defined.  Restore of config requires apikey login on FG')
-            continue
-
-        # Check to see if name of fg contains a word we want to skip, then skip
-        if args.skip_list and any(skip_word in fg for skip_word in skip_list):
-            print(f' Skipping: {fg} appears to be non-fortigate device (skip_list)')
-            continue
-
-        # Create a dictionary of details for the current fg
-        device_details = fgs['fortigates'][fg]
-        device_details['name'] = fg
-
-        # If we can find a config file containing the device's name, then select that file
-        for cfile in restore_files:
-            if args.verbose:
-              print('  Comparing:')
-              print(f'    {fg} --> {cfile}')
-
-            if fg in cfile:
-                config_file = f'{args.backup_dir}/{cfile}'
-                print(f'  Restore Config:   {config_file}')
-                break
-            else:
-                config_file = None
-
-        if config_file:
-            """ Create instances of fg_api_utils with device details """
-            fgt = FortiGateApiUtils(device=device_details, verbose=args.verbose, debug=args.debug)
+    # Skip devices which don't accept a connection (or are known to be down) rather than waiting on each login
+    unreachable = {}
+    if args.reachability_check:
+        health = DeviceHealth(args.health_file) if args.health_file else None
+        unreachable = check_reachability(inventory.devices, list(inventory.devices), timeout=args.probe_timeout,
+                                         health=health, recheck=args.recheck_unreachable)
+
+    run_start = time.monotonic()
+    # Where backups in archives are extracted to for the restore, removed however the run ends
+    extract_dir = tempfile.mkdtemp(prefix='fg_restore_')
+    try:
+        if args.waves:
             try:
-                r, msg = fgt.login()
-            except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
-                print(f'  Connection/Login Failed: {e}')
-                continue
-
-            # If login appears to have worked then continue to request restore
-            if r is True:
-                try:
-                    result, msg = fgt.restore_config_from_file(config_file=config_file)
-                except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
-                    print(f'  API Call to FGT Failed: {e}')
-                    continue
-
-                if result:
-                    print(f'  Success')
-                else:
-                    print(f'  Failed: {msg}')
-
-            else:
-                print(f'  Failed: {msg}')
+                wave_sizes = [int(size) for size in args.waves.split(',')]
+            except ValueError:
+                wave_sizes = []
+            if not wave_sizes or min(wave_sizes) < 1:
+                print(f'Invalid --waves {args.waves}, must be comma separated sizes of 1 or more, such as "1,10,50"')
+                raise SystemExit
+
+            # Devices which can't be restored are reported first and are not counted in any wave
+            device_results = {}
+            device_wave = {}
+            not_restorable = [fg for fg in fg_names if restore_precheck(fg)]
+            for fg, result in zip(not_restorable, run_parallel(restore_device, not_restorable)):
+                device_results[fg] = result
+            waves = plan_waves([fg for fg in fg_names if fg not in device_results], wave_sizes)
+
+            for wave_num, wave in enumerate(waves, 1):
+                print()
+                print(f'Wave {wave_num} of {len(waves)}: restoring {len(wave)} device(s)')
+                wave_start = time.monotonic()
+                for fg, result in zip(wave, run_restores(wave, workers=len(wave))):
+                    device_results[fg] = result
+                    device_wave[fg] = wave_num
+                failed = sum(1 for fg in wave if not device_results[fg][0][0])
+                print(f'Wave {wave_num} complete in {time.monotonic() - wave_start:.1f}s: '
+                      f'{len(wave) - failed} succeeded, {failed} failed ({failed / len(wave):.0%})')
+
+                if failed / len(wave) > args.max_failure_rate and wave_num < len(waves):
+                    print(f'Failure rate above --max_failure_rate {args.max_failure_rate:.0%}, '
+                          f'stopping before wave {wave_num + 1}')
+                    for later_num, later_wave in enumerate(waves[wave_num:], wave_num + 1):
+                        for fg in later_wave:
+                            device_results[fg] = ((False, f'Not attempted, stopped after wave {wave_num}'), 0.0)
+                            device_wave[fg] = later_num
+                    break
+            results = [device_results[fg] for fg in fg_names]
         else:
-            print('  Error: No Config file match found.')
+            # Process each entry under fortigates in yaml file, --workers of them at a time
+            results = run_restores(fg_names, workers=args.workers)
+    finally:
+        shutil.rmtree(extract_dir, ignore_errors=True)
+
+    # Summary of results, in the same order as the device file
+    if args.workers > 1 or args.waves:
+        print()
+        rows = []
+        for fg, ((result, msg), elapsed) in zip(fg_names, results):
+            row = [fg, inventory.devices[fg].ip, 'Success' if result else 'Failed',
+                   f'{elapsed:.1f}', str(msg)[:80]]
+            if args.waves:
+                row.insert(2, device_wave.get(fg, '-'))
+            rows.append(row)
+        headers = ['Device', 'IP', 'Result', 'Time(s)', 'Detail']
+        if args.waves:
+            headers.insert(2, 'Wave')
+        print_result_table(rows, headers)
+        succeeded = sum(1 for (result, msg), elapsed in results if result)
+        print(f'Restored {succeeded} of {len(fg_names)} devices in {time.monotonic() - run_start:.1f}s')
@@ -23,15 +23,45 @@ fortigates:
 Image upgrade via API on the FortiGate requires that you must login with apikey.  It will not allow upgrade if logged
 in via login/password even if logged in with super_admin profile user. In the above example, only fg-1 and fg-3 would
 be possible to be upgraded via this script.
+
+With --rolling true the upgrade is run as a rolling upgrade which follows each device through the reboot:
+devices are upgraded in --waves (such as "1,10,50", 1 canary device, then 10, then 50 at a time for the rest),
+at most --workers devices at a time.  Each device goes through the states queued, uploading, rebooting
+(monitor/system/status is polled with backoff until the device answers again) and verifying (it reports the
+requested version) to done or failed.  State changes are printed as they happen and a table of the final state
+and time spent uploading and rebooting of each device is printed at the end.  If more than --max_failure_rate of
+a wave failed, no further waves are started.
+
+Before any upgrade starts a pre-flight check queries the status of every device, --preflight_workers at a time,
+and prints the plan for each: up to date, needs upgrade, no image (not offered by FortiGuard), unreachable, no apikey
+or skipped.  Only the devices that need upgrading are upgraded (--preflight false upgrades every device as before).
+With --upgrade_source file the requested version is taken from the image file name, when named by its version.
+
+With --upgrade_source file and --firmware_repo <dir>, --img_ver_rev is a version and each device is upgraded with the
+image for its model from the repository directory (images named as downloaded from Fortinet, such as
+FGT_100F-v7.2.6.F-build1575-FORTINET.out), so a fleet of mixed models is upgraded in one run.  The checksums of the
+images are kept in <dir>/.firmware_index.json and each distinct image is encoded once per run.
+
+With --upgrade_source fortiguard the images FortiGuard offers are fetched from the first device of each platform (model)
+and cached for --catalog_ttl seconds, rather than from every device.
 """
 
 from modules.fortigate_api_utils import *
+from modules.fortigate_async_api_utils import FortiGateAsyncApiUtils
+from modules import instrumentation
 from modules.common import *
+from modules.parallel_utils import run_parallel, run_parallel_async, print_result_table
+from modules.session_pool import MAX_SESSIONS
+from modules.reachability import DeviceHealth, check_reachability, PROBE_TIMEOUT
+from modules.firmware_catalog import catalog, parse_version, DEFAULT_TTL
+from modules.firmware_repo import FirmwareRepository
+from modules.upload_utils import shared_encoded_file
+from modules.upgrade_scheduler import RollingUpgradeScheduler, UPLOADING, REBOOTING, DONE
 from str2bool import str2bool
 import argparse
-import yaml
 import os
 import sys
+import time
 
 
 # Arguments
@@ -46,18 +76,384 @@ parser.add_argument('--img_ver_rev', type=str, default=None,
                          'should be a filesystem path to an FOS image file.   If --upgrade_source is set to "fortiguard'
                          'then this attribute should be set to a value containing an FOS image versions such as'
                          '"7.2.6".')
+parser.add_argument('--firmware_repo', type=str, default=None,
+                    help='With --upgrade_source file, directory of FOS image files (named as downloaded, such as '
+                         'FGT_VM64-v7.2.6.F-build1575-FORTINET.out) to pick each device\'s image from by its model.  '
+                         '--img_ver_rev is then the version to upgrade to, such as "7.2.6"')
 parser.add_argument('--debug', type=str2bool, default=False, help='Flag, enable debug output for API calls')
 parser.add_argument('--verbose', type=str2bool, default=False, help='Flag, output operational details')
 parser.add_argument('--skip_list', type=str, default=None,
                     help='Optionally, provide path to file with list of words which if the word is in the name '
                          'of any of the devices names in yaml file, backups for that device will be skipped. '
                          'If not defined, no name checks will be performed')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of devices to upgrade concurrently (default 1, sequential)')
+parser.add_argument('--async_api', type=str2bool, default=False,
+                    help='Flag, use the asyncio api client instead of pyFGT')
+parser.add_argument('--connection_limit', type=int, default=FortiGateAsyncApiUtils.CONNECTION_LIMIT,
+                    help='Max concurrent http connections shared by all devices when using --async_api')
+parser.add_argument('--max_sessions', type=int, default=MAX_SESSIONS,
+                    help='Max keep-alive sessions (one per device) kept open for reuse by later api calls to the same '
+                         'device, raised to --workers if lower')
+parser.add_argument('--retries', type=int, default=FortiGateApiUtils.API_RETRIES,
+                    help='Times an idempotent api call (status check, backup) is retried, after a random backoff, '
+                         'on a connection error or timeout.  Upgrade and restore requests are never retried')
+parser.add_argument('--connect_timeout', type=float, default=FortiGateApiUtils.CONNECT_TIMEOUT,
+                    help='Seconds to wait for a connection to a device, lower values fail unreachable devices faster')
+parser.add_argument('--trace_file', type=str, default=None,
+                    help='Append a json line per api call and file operation (duration, bytes in/out, status) to '
+                         'this file')
+parser.add_argument('--metrics_file', type=str, default=None,
+                    help='Write a Prometheus textfile summary (duration percentiles, bytes, errors per operation) '
+                         'to this file at the end of the run, such as into the node_exporter textfile directory')
+parser.add_argument('--reachability_check', type=str2bool, default=False,
+                    help='Flag, before any api call try a TCP connection to every device at once and skip the devices '
+                         'not accepting one within --probe_timeout.  Only the api port is tried: the port in the '
+                         'device\'s ip, otherwise 443 (80 with use_ssl false)')
+parser.add_argument('--probe_timeout', type=float, default=PROBE_TIMEOUT,
+                    help='Seconds to wait for a connection in the reachability check')
+parser.add_argument('--health_file', type=str, default=None,
+                    help='With --reachability_check, file recording failed checks between runs, devices failing '
+                         'repeatedly are skipped without a check until their cooldown passes.  Without it every '
+                         'device is checked on every run')
+parser.add_argument('--recheck_unreachable', type=str2bool, default=False,
+                    help='Flag, check devices known to be unreachable from --health_file anyway')
+parser.add_argument('--rolling', type=str2bool, default=False,
+                    help='Flag, rolling upgrade: upgrade in --waves and wait for each device to reboot into the '
+                         'requested version (uses the asyncio api client)')
+parser.add_argument('--waves', type=str, default=None,
+                    help='With --rolling, comma separated wave sizes such as "1,10,50", the last size is repeated for '
+                         'the remaining devices.  Default is a single wave of all devices')
+parser.add_argument('--max_failure_rate', type=float, default=0.0,
+                    help='With --rolling, stop before the next wave if more than this fraction (0-1) of the devices '
+                         'in a wave failed (default 0.0, any failure stops the upgrade)')
+parser.add_argument('--reboot_timeout', type=int, default=900,
+                    help='With --rolling, seconds to wait for a device to come back with the new version')
+parser.add_argument('--poll_interval', type=float, default=15,
+                    help='With --rolling, seconds before the first status poll of a rebooting device, doubling '
+                         'for each later poll up to 60 seconds')
+parser.add_argument('--preflight', type=str2bool, default=True,
+                    help='Flag, check the version of all devices before starting any upgrade and only upgrade those '
+                         'that need it (default true)')
+parser.add_argument('--catalog_ttl', type=int, default=DEFAULT_TTL,
+                    help='Seconds the FortiGuard image list of a platform is cached (fetched from the first device '
+                         'of each model) before it is fetched again')
+parser.add_argument('--preflight_workers', type=int, default=50,
+                    help='Number of devices checked concurrently by the pre-flight check (default 50)')
 args = parser.parse_args()
 
+# Pre-flight plan of each device
+NEEDS_UPGRADE = 'needs upgrade'
+UP_TO_DATE = 'up to date'
+NO_IMAGE = 'no image'
+UNREACHABLE = 'unreachable'
+NO_APIKEY = 'no apikey'
+SKIPPED = 'skipped'
+ERROR = 'error'
+
+
+def get_device_details(fg):
+    """
+    Print the device header, run the pre-checks and return the device dict for the api clients
+    for fg, or None if the device can not be upgraded.
+    """
+    device = inventory.devices[fg]
+    print(f'Upgrade {fg} at IP {device.ip}')
+
+    # Check to see if name of fg contains a word we want to skip, then skip
+    if args.skip_list and any(skip_word in fg for skip_word in skip_list):
+        print(f' SKIPPING: {fg} appears to be non-fortigate device')
+        return None
+
+    if fg in unreachable:
+        print(f' SKIPPING: {unreachable[fg]}')
+        return None
+
+    # Check if apikey is defined and is a string.  If not, stop processing
+    # this fortigate as cannot do restore unless using apikey for auth.
+    if device.apikey is None:
+        print('Error: no apikey defined.  Upgrading of image on FG requires apikey login (not user/pass)')
+        return None
+
+    return device.as_device()
+
+
+def upgrade_precheck(fg):
+    """ Reason fg will not be upgraded (checked before a rolling upgrade starts), or None if it can be """
+    if args.skip_list and any(skip_word in fg for skip_word in skip_list):
+        return 'Skipped (skip_list)'
+    if inventory.devices[fg].apikey is None:
+        return 'No apikey defined'
+    if fg in unreachable:
+        return unreachable[fg]
+    return None
+
+
+def is_up_to_date(version: str):
+    return target is not None and parse_version(version) == target
+
+
+def preflight_plan(platform: str, version: str, image: dict):
+    """
+    Plan entry of a device reporting platform and version, image is the FortiGuard image offered to it
+    or its image in the firmware repository (None if there is none)
+    """
+    if is_up_to_date(version):
+        return UP_TO_DATE, (platform, version, 'Already running requested version')
+    if args.upgrade_source == 'fortiguard':
+        if image is None:
+            return NO_IMAGE, (platform, version, f'No image for {args.img_ver_rev} offered by FortiGuard')
+        return NEEDS_UPGRADE, (platform, version, f'Image {image["version"]} build {image.get("build", "")} available')
+    if firmware_repo is not None:
+        if image is None:
+            return NO_IMAGE, (platform, version, f'No image for {args.img_ver_rev} in {args.firmware_repo}')
+        return NEEDS_UPGRADE, (platform, version, f'Image {os.path.basename(image["path"])}')
+    return NEEDS_UPGRADE, (platform, version, '')
+
+
+def preflight_device(fg):
+    """ Pre-flight check of fg, returns (plan, (platform, version, detail)) """
+    fgt = FortiGateApiUtils(device=inventory.devices[fg].as_device(), verbose=False, debug=args.debug)
+    try:
+        r, msg = fgt.login()
+        if r is not True:
+            return ERROR, ('', '', msg)
+        platform, version = fgt.get_platform_version()
+        image = None
+        if args.upgrade_source == 'fortiguard' and not is_up_to_date(version):
+            image = fgt.available_firmware(platform).get(target)
+        elif firmware_repo is not None and not is_up_to_date(version):
+            image = firmware_repo.select(platform, target)
+        # The upgrade reuses the status queried here (see upgrade_device)
+        preflight_facts[fg] = fgt.facts
+        fgt.logout()
+    except FGTConnectionError as e:
+        return UNREACHABLE, ('', '', str(e))
+    except (FGTBaseException, FGTValueError) as e:
+        return ERROR, ('', '', f'Pre-flight failed: {e}')
+    return preflight_plan(platform, version, image)
+
+
+async def preflight_device_async(fg):
+    """ Same as preflight_device, using the asyncio api client """
+    fgt = FortiGateAsyncApiUtils(device=inventory.devices[fg].as_device(), verbose=False, debug=args.debug)
+    try:
+        # The status call verifies the apikey, no separate login needed
+        platform, version = await fgt.get_platform_version()
+        image = None
+        if args.upgrade_source == 'fortiguard' and not is_up_to_date(version):
+            image = (await fgt.available_firmware(platform)).get(target)
+        elif firmware_repo is not None and not is_up_to_date(version):
+            image = firmware_repo.select(platform, target)
+        preflight_facts[fg] = fgt.facts
+    except FGTConnectionError as e:
+        return UNREACHABLE, ('', '', str(e))
+    except (FGTBaseException, FGTValueError) as e:
+        return ERROR, ('', '', f'Pre-flight failed: {e}')
+    return preflight_plan(platform, version, image)
+
+
+def firmware_preflight(fg_names: list):
+    """
+    Pre-flight check of all devices at once (--preflight_workers at a time) before any upgrade,
+    prints the plan and returns the devices that need upgrading
+    """
+    plan = {}
+    for fg in fg_names:
+        reason = upgrade_precheck(fg)
+        if reason:
+            if fg in unreachable:
+                plan[fg] = (UNREACHABLE, ('', '', reason))
+            else:
+                plan[fg] = (NO_APIKEY if 'apikey' in reason else SKIPPED, ('', '', reason))
+    candidates = [fg for fg in fg_names if fg not in plan]
+
+    print(f'Pre-flight check of {len(candidates)} device(s)')
+    preflight_start = time.monotonic()
+    if args.async_api or args.rolling:
+        results = run_parallel_async(preflight_device_async, candidates, workers=args.preflight_workers,
+                                     setup=lambda: FortiGateAsyncApiUtils.open_session(args.connection_limit),
+                                     teardown=FortiGateAsyncApiUtils.close_session)
+    else:
+        results = run_parallel(preflight_device, candidates, workers=args.preflight_workers)
+    for fg, ((state, info), elapsed) in zip(candidates, results):
+        # An unhandled error comes back as (False, msg)
+        plan[fg] = (ERROR, ('', '', info)) if state is False else (state, info)
+
+    rows = []
+    for fg in fg_names:
+        state, (platform, version, detail) = plan[fg]
+        rows.append([fg, inventory.devices[fg].ip, platform, version, state, str(detail)[:80]])
+    print_result_table(rows, ['Device', 'IP', 'Platform', 'Version', 'Plan', 'Detail'])
+    counts = {}
+    for state, info in plan.values():
+        counts[state] = counts.get(state, 0) + 1
+    print(f'Pre-flight plan in {time.monotonic() - preflight_start:.1f}s: ' +
+          ', '.join(f'{count} {state}' for state, count in counts.items()))
+    ready = [fg for fg in fg_names if plan[fg][0] == NEEDS_UPGRADE]
+
+    if firmware_repo is not None and ready:
+        # Encode each distinct image once, before the uploads start, rather than in the first upload of each image
+        images = {}
+        for fg in ready:
+            image = firmware_repo.select(plan[fg][1][0], target)
+            images[image['path']] = image
+        encode_start = time.monotonic()
+        for image_file, image in sorted(images.items()):
+            try:
+                if shared_encoded_file(image_file).sha256 != image['sha256']:
+                    # upgrade_image fails the devices of this image rather than uploading it
+                    print(f'Warning, image file {image_file} does not match its sha256 in the firmware index')
+            except OSError as e:
+                print(f'Warning, unable to read image file {image_file}: {e}')
+        print(f'Encoded {len(images)} image(s) for {len(ready)} device(s) in {time.monotonic() - encode_start:.1f}s')
+    print()
+    return ready
+
+
+def rolling_upgrade(fg_names: list):
+    """ Rolling upgrade of fg_names (--rolling true), prints the state of each device at the end """
+    if args.waves:
+        try:
+            wave_sizes = [int(size) for size in args.waves.split(',')]
+        except ValueError:
+            wave_sizes = []
+        if not wave_sizes or min(wave_sizes) < 1:
+            print(f'Invalid --waves {args.waves}, must be comma separated sizes of 1 or more, such as "1,10,50"')
+            raise SystemExit
+    else:
+        wave_sizes = None
+
+    skipped = {}
+    for fg in fg_names:
+        reason = upgrade_precheck(fg)
+        if reason:
+            skipped[fg] = reason
+    devices = {fg: inventory.devices[fg].as_device() for fg in fg_names if fg not in skipped}
+    scheduler = RollingUpgradeScheduler(devices, args.upgrade_source, args.img_ver_rev, wave_sizes=wave_sizes,
+                                        workers=args.workers, max_failure_rate=args.max_failure_rate,
+                                        reboot_timeout=args.reboot_timeout, poll_interval=args.poll_interval,
+                                        connection_limit=args.connection_limit, firmware_repo=firmware_repo,
+                                        facts=preflight_facts, verbose=args.verbose, debug=args.debug)
+    run_start = time.monotonic()
+    upgrades = {upgrade.name: upgrade for upgrade in scheduler.run()}
+
+    def seconds(value):
+        return '' if value is None else f'{value:.1f}'
+
+    print()
+    rows = []
+    for fg in fg_names:
+        if fg in skipped:
+            rows.append([fg, inventory.devices[fg].ip, '-', 'skipped', '', '', '', '', '', skipped[fg]])
+            continue
+        upgrade = upgrades[fg]
+        rows.append([fg, upgrade.device.get('ip', ''), upgrade.wave, upgrade.state, upgrade.from_version or '',
+                     upgrade.to_version or '', seconds(upgrade.seconds_in(UPLOADING)),
+                     seconds(upgrade.seconds_in(REBOOTING)), seconds(upgrade.elapsed), upgrade.detail[:80]])
+    print_result_table(rows, ['Device', 'IP', 'Wave', 'State', 'From', 'To', 'Upload(s)', 'Reboot(s)', 'Total(s)',
+                              'Detail'])
+    done = sum(1 for upgrade in upgrades.values() if upgrade.state == DONE)
+    print(f'Upgraded {done} of {len(fg_names)} devices in {time.monotonic() - run_start:.1f}s')
+
+
+def upgrade_device(fg):
+    """ Login and request firmware upgrade of a single FG from the device file, returns (code, msg) """
+    device_details = get_device_details(fg)
+    if device_details is None:
+        return False, unreachable.get(fg, 'Skipped')
+
+    """ Create instance of fg_api_utils with device details """
+    fgt = FortiGateApiUtils(device=device_details, verbose=args.verbose, debug=args.debug)
+    try:
+        # A device checked by the pre-flight check already had its apikey verified and status queried
+        r, msg = fgt.login(facts=preflight_facts.get(fg))
+    except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
+        print(f'  Connection/Login Failed: {e}')
+        return False, 'Connection/Login Failed'
+
+    # If login appears to have worked then continue to request upgrade
+    if r is not True:
+        return False, msg
+
+    try:
+        code, msg = fgt.upgrade_image(image_source=args.upgrade_source, img_ver_rev=args.img_ver_rev,
+                                      firmware_repo=firmware_repo)
+        print('#############')
+        print(code)
+        print(msg)
+    except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
+        print(f'  API Call to FGT Failed: {e}')
+        return False, 'API Call to FGT Failed'
+
+    return code, msg
+
+
+async def upgrade_device_async(fg):
+    """ Same as upgrade_device, using the asyncio api client (--async_api true) """
+    device_details = get_device_details(fg)
+    if device_details is None:
+        return False, unreachable.get(fg, 'Skipped')
+
+    fgt = FortiGateAsyncApiUtils(device=device_details, verbose=args.verbose, debug=args.debug)
+    try:
+        r, msg = await fgt.login(facts=preflight_facts.get(fg))
+    except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
+        print(f'  Connection/Login Failed: {e}')
+        return False, 'Connection/Login Failed'
+
+    if r is not True:
+        return False, msg
+
+    try:
+        code, msg = await fgt.upgrade_image(image_source=args.upgrade_source, img_ver_rev=args.img_ver_rev,
+                                            firmware_repo=firmware_repo)
+        print('#############')
+        print(code)
+        print(msg)
+    except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
+        print(f'  API Call to FGT Failed: {e}')
+        return False, 'API Call to FGT Failed'
+
+    return code, msg
+
+
+def upgrade(fg_names: list):
+    """ Request the upgrade of fg_names, --workers at a time, prints the result of each device at the end """
+    run_start = time.monotonic()
+    if args.async_api:
+        results = run_parallel_async(upgrade_device_async, fg_names, workers=args.workers,
+                                     setup=lambda: FortiGateAsyncApiUtils.open_session(args.connection_limit),
+                                     teardown=FortiGateAsyncApiUtils.close_session)
+    else:
+        results = run_parallel(upgrade_device, fg_names, workers=args.workers)
+
+    # Summary of results, in the same order as the device file
+    print()
+    rows = []
+    upgraded = 0
+    for fg, ((code, msg), elapsed) in zip(fg_names, results):
+        result = upgrade_succeeded(code)
+        upgraded += result
+        rows.append([fg, inventory.devices[fg].ip, 'Success' if result else 'Failed', f'{elapsed:.1f}',
+                     str(msg)[:80]])
+    print_result_table(rows, ['Device', 'IP', 'Result', 'Time(s)', 'Detail'])
+    print(f'Upgrade requested on {upgraded} of {len(fg_names)} devices in {time.monotonic() - run_start:.1f}s')
+
+
 #######################
 # Main
 #######################
 if __name__ == '__main__':
+    # Keep-alive session per device, reused by every api call to it during the run
+    FortiGateApiUtils.configure_sessions(max_sessions=max(args.max_sessions, args.workers))
+    # Retries and connect timeout of the per device timeout policy
+    FortiGateApiUtils.API_RETRIES = args.retries
+    FortiGateApiUtils.CONNECT_TIMEOUT = args.connect_timeout
+
+    # Timing of every api call and file operation, for --trace_file/--metrics_file
+    instrumentation.configure(args.trace_file, args.metrics_file, script='fg_update_firmware_from_list')
+
       # Check if --device_file or --yaml_dir parameters passed
     if not args.device_file:
         if args.yaml_dir:
@@ -67,21 +463,26 @@ if __name__ == '__main__':
             print("Must provide one of following parameters --device_file or --yaml_dir, Aborting")
             raise SystemExit
 
-    try:
-        # Open device file for reading
-        with open(args.device_file) as file:
-            try:
-                # read yaml file to python dict()
-                fgs = yaml.safe_load(file)
-            except yaml.YAMLError as e:
-                print(f'Error processing device yaml file {e}, aborting')
-                sys.exit()
-    except IOError as e:
-        print(f'Error reading device yaml file, aborting: {e}')
+    # Read device details from file, read_device_file from "common" module
+    inventory = read_device_file(args.device_file)
+    if not inventory:
+        print('Failed to read device file, aborting')
         sys.exit()
 
     # Check upgrade_source and img arguments to verify they correlate as expected
-    if args.upgrade_source == 'file':
+    firmware_repo = None
+    if args.upgrade_source == 'file' and args.firmware_repo:
+        if not args.img_ver_rev or not parse_version(args.img_ver_rev):
+            print(f'Error, with --firmware_repo --img_ver_rev must be a version such as "7.2.6", aborting')
+            sys.exit()
+        if not os.path.isdir(args.firmware_repo):
+            print(f'Error, cannot access firmware repository {args.firmware_repo}, aborting')
+            sys.exit()
+        firmware_repo = FirmwareRepository(args.firmware_repo).refresh()
+        firmware_repo.save()
+        print(f'Firmware repository {args.firmware_repo}: {len(firmware_repo.images)} image(s) for platform(s) '
+              f'{", ".join(firmware_repo.platforms())}')
+    elif args.upgrade_source == 'file':
         if args.img_ver_rev:
             # Check if image file is accessible
             if not os.path.exists(args.img_ver_rev):
@@ -118,49 +519,27 @@ if __name__ == '__main__':
             print(f'Error reading skip list, aborting: {e}')
             sys.exit()
 
-    # Process each entry under fortigates in yaml file
-    for fg in fgs['fortigates']:
-        print(f'Upgrade {fg} at IP {fgs["fortigates"][fg]["ip"]}')
-
-        # Check to see if name of fg contains a word we want to skip, then skip
-        if args.skip_list and any(skip_word in fg for skip_word in skip_list):
-            print(f' SKIPPING: {fg} appears to be non-fortigate device')
-            continue
-
-        # Create a dictionary of details for the current fg
-        device_details = fgs['fortigates'][fg]
-        device_details['name'] = fg
-
-        # Check if apikey is defined and is a string.  If not, stop processing
-        # this fortigate as cannot do restore unless using apikey for auth.
-        if 'apikey' not in device_details:
-            print('Error: no apikey defined.  Upgrading of image on FG requires apikey login (not user/pass)')
-            continue
-
-        """ Create instance of fg_api_utils with device details """
-        fgt = FortiGateApiUtils(device=device_details, verbose=args.verbose, debug=args.debug)
-        try:
-            r, msg = fgt.login()
-        except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
-            print(f'  Connection/Login Failed: {e}')
-            continue
-
-        # If login appears to have worked then continue to request restore
-        if r is True:
-            try:
-                code, msg = fgt.upgrade_image(image_source=args.upgrade_source, img_ver_rev=args.img_ver_rev)
-                print('#############')
-                print(code)
-                print(msg)
-            except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
-                print(f'  API Call to FGT Failed: {e}')
-                continue
-
-
-
-
-
-
-
+    catalog.ttl = args.catalog_ttl
+    # Version devices are upgraded to, None if not known (image file not named by its version)
+    if args.upgrade_source == 'fortiguard' or firmware_repo is not None:
+        target = parse_version(args.img_ver_rev)
+    else:
+        target = parse_version(os.path.basename(args.img_ver_rev))
 
+    # Skip devices which don't accept a connection (or are known to be down) rather than waiting on each login
+    unreachable = {}
+    if args.reachability_check:
+        health = DeviceHealth(args.health_file) if args.health_file else None
+        unreachable = check_reachability(inventory.devices, list(inventory.devices), timeout=args.probe_timeout,
+                                         health=health, recheck=args.recheck_unreachable)
 
+    # Process each entry under fortigates in yaml file, --workers of them at a time
+    fg_names = list(inventory.devices)
+    # DeviceFacts of each device from the pre-flight check, so the upgrade doesn't query them again
+    preflight_facts = {}
+    if args.preflight:
+        fg_names = firmware_preflight(fg_names)
+    if args.rolling:
+        rolling_upgrade(fg_names)
+    else:
+        upgrade(fg_names)
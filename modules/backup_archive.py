@@ -0,0 +1,105 @@
+from modules.backup_store import config_hash
+from modules.file_utils import AtomicFileWriter
+import datetime
+import gzip
+import json
+import os
+import threading
+
+ARCHIVE_EXTENSION = '.fgz'
+INDEX_EXTENSION = '.index.json'
+COMPRESS_LEVEL = 6
+
+
+def index_path(archive_path: str):
+    """ Path of the index file that goes with archive_path """
+    return f'{archive_path}{INDEX_EXTENSION}'
+
+
+class BackupArchive:
+    """
+    Compressed archive of all config backups from one run.
+
+    Each config is compressed as its own gzip member and appended to a single archive file,
+    so any one config can be read back by seeking to its offset and decompressing only that
+    member (the whole file is also a valid multi-member gzip file for "gunzip -c").
+    A json index (<archive>.index.json) records offset, compressed size, raw size, hash and
+    time of each device's config.
+
+    The archive is written to a temp file and only renamed into place by close(), after
+    which the index is written.  add() may be called from multiple threads at the same time.
+    """
+    def __init__(self, archive_path: str):
+        self.archive_path = archive_path
+        self.writer = AtomicFileWriter(archive_path)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def add(self, device_name: str, config_file: str):
+        """ Compress config_file into the archive for device_name, returns the index entry """
+        with open(config_file, 'rb') as f:
+            config = f.read()
+        member = gzip.compress(config, compresslevel=COMPRESS_LEVEL, mtime=0)
+        entry = {'file': os.path.basename(config_file), 'size': len(member), 'raw_size': len(config),
+                 'sha256': config_hash(config_file),
+                 'time': datetime.datetime.now().isoformat(timespec='seconds')}
+
+        # Only the append itself needs to be serialized
+        with self.lock:
+            entry['offset'] = self.writer.bytes_written
+            self.writer.write(member)
+            self.entries[device_name] = entry
+        return entry
+
+    def close(self, device_order: list = None):
+        """
+        Commit the archive and write its index.  device_order optionally gives the order of
+        devices in the index (such as device file order), otherwise order added.
+        """
+        if device_order:
+            entries = {d: self.entries[d] for d in device_order if d in self.entries}
+        else:
+            entries = self.entries
+        self.writer.commit()
+
+        index = {'archive': os.path.basename(self.archive_path), 'format': 'gzip-members',
+                 'created': datetime.datetime.now().isoformat(timespec='seconds'), 'devices': entries}
+        with AtomicFileWriter(index_path(self.archive_path)) as writer:
+            writer.write(json.dumps(index, indent=2).encode())
+            writer.commit()
+        return index
+
+    def abort(self):
+        self.writer.abort()
+
+
+def read_archive_index(archive_path: str):
+    """ Return the index dict for archive_path """
+    with open(index_path(archive_path)) as f:
+        return json.load(f)
+
+
+def read_archived_config(archive_path: str, device_name: str, index: dict = None):
+    """
+    Return the config bytes for device_name from archive_path, only that device's
+    member of the archive is read and decompressed.
+    """
+    if index is None:
+        index = read_archive_index(archive_path)
+    entry = index['devices'][device_name]
+    with open(archive_path, 'rb') as f:
+        f.seek(entry['offset'])
+        member = f.read(entry['size'])
+    config = gzip.decompress(member)
+    if len(config) != entry['raw_size']:
+        raise ValueError(f'Archive entry for {device_name} in {archive_path} is corrupt, size mismatch')
+    return config
+
+
+def extract_config(archive_path: str, device_name: str, dest_file: str, index: dict = None):
+    """ Write the config for device_name from archive_path to dest_file, returns dest_file """
+    config = read_archived_config(archive_path, device_name, index)
+    with AtomicFileWriter(dest_file) as writer:
+        writer.write(config)
+        writer.commit()
+    return dest_file
@@ -0,0 +1,108 @@
+from modules.backup_index import load_run, source_file
+from modules.backup_store import config_hash
+from modules.fos_config_parser import FortiOSConfig, SET, UNSET
+import tempfile
+
+
+def source_hash(source: dict):
+    """ config_hash of a source, using the hash recorded by the run where there is one """
+    if source.get('sha256'):
+        return source['sha256']
+    return config_hash(source['path'])
+
+
+def config_section(path: tuple):
+    """
+    The section a setting belongs to, the first "config" level below the VDOM/global wrapper
+    of multi-VDOM configs, such as ('system interface',), ('vdom', 'root', 'firewall policy')
+    """
+    if path[0] == 'vdom' and len(path) >= 3:
+        return path[:3]
+    if path[0] == 'global' and len(path) >= 2:
+        return path[:2]
+    return path[:1]
+
+
+def diff_configs(old: FortiOSConfig, new: FortiOSConfig):
+    """
+    Section aware diff of two parsed configs.  Returns dict of section -> {"added": [...],
+    "removed": [...], "changed": [...]}.  Added/removed entries (a whole "edit" or "config"
+    block) are reported once with the path of the block rather than every setting in it.
+    Each item is a dict with "path" (relative to the section) and "value" or "old"/"new".
+    """
+    sections = {}
+
+    def record(path, change, item):
+        section = config_section(path)
+        changes = sections.setdefault('/'.join(section), {'added': [], 'removed': [], 'changed': []})
+        changes[change].append({'path': '/'.join(path[len(section):]), **item})
+
+    def describe(config, node):
+        kind = config.kind[node]
+        if kind == SET:
+            return {'value': config.node_value(node)}
+        if kind == UNSET:
+            return {'value': None}
+        return {'block': config.node_kind(node)}
+
+    def walk(old_node, new_node, path):
+        old_children = {old.node_name(child): child for child in old.children(old_node)}
+        for new_child in new.children(new_node):
+            name = new.node_name(new_child)
+            child_path = path + (name,)
+            old_child = old_children.pop(name, None)
+            if old_child is None:
+                record(child_path, 'added', describe(new, new_child))
+                continue
+
+            old_kind = old.kind[old_child]
+            new_kind = new.kind[new_child]
+            if old_kind in (SET, UNSET) or new_kind in (SET, UNSET):
+                old_value = old.node_value(old_child)
+                new_value = new.node_value(new_child)
+                if old_kind != new_kind or old_value != new_value:
+                    record(child_path, 'changed', {'old': old_value, 'new': new_value})
+            else:
+                walk(old_child, new_child, child_path)
+
+        for name, old_child in old_children.items():
+            record(path + (name,), 'removed', describe(old, old_child))
+
+    walk(0, 0, ())
+    return sections
+
+
+def config_version(config: FortiOSConfig):
+    """ Firmware version/build from the #config-version header, such as FGVM64-7.2.5-FW-build1517-230606 """
+    for line in config.header:
+        if line.startswith('#config-version='):
+            return line[len('#config-version='):].split(':')[0]
+    return None
+
+
+def diff_device(task: tuple):
+    """
+    Compare the configs of one device, task is (device name, old source, new source) from load_run().
+    Identical configs (by hash) are not parsed.  Returns tuple of (result, report dict or error msg).
+    """
+    device_name, old_source, new_source = task
+    try:
+        old_hash = source_hash(old_source)
+        new_hash = source_hash(new_source)
+        report = {'device': device_name, 'old_sha256': old_hash, 'new_sha256': new_hash}
+        if old_hash == new_hash:
+            report['status'] = 'identical'
+            return True, report
+
+        with tempfile.TemporaryDirectory(prefix='fg-diff-') as tmp_dir:
+            with FortiOSConfig(source_file(old_source, tmp_dir, 'old.conf')) as old, \
+                    FortiOSConfig(source_file(new_source, tmp_dir, 'new.conf')) as new:
+                report['status'] = 'changed'
+                old_version = config_version(old)
+                new_version = config_version(new)
+                if old_version != new_version:
+                    report['version'] = {'old': old_version, 'new': new_version}
+                report['sections'] = diff_configs(old, new)
+    except (OSError, KeyError, ValueError) as e:
+        return False, f'Error comparing configs of {device_name}: {e}'
+    return True, report
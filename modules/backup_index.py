@@ -0,0 +1,262 @@
+from modules.backup_archive import ARCHIVE_EXTENSION, INDEX_EXTENSION, read_archive_index, read_archived_config
+from modules.backup_store import MANIFEST_FILE, config_hash, read_manifest, manifest_object_path
+from modules.file_utils import AtomicFileWriter, is_temp_file
+import datetime
+import json
+import os
+import re
+
+# Date tag fg_backup_from_list.py puts in front of run directory, archive and (flat) file names
+DATE_TAG_RE = re.compile(r'^\d{4}-\d{2}-\d{2}-\d{6}')
+INDEX_FILE = '.backup_index.json'
+INDEX_VERSION = 2
+
+
+def device_from_file(file_name: str):
+    """ Device name for a backup file name, <date tag><name>.conf -> name """
+    return DATE_TAG_RE.sub('', os.path.basename(file_name)[:-len('.conf')])
+
+
+def date_tag_time(name: str):
+    """ ISO time from the date tag at the start of a file or run name, None if it has none """
+    match = DATE_TAG_RE.match(os.path.basename(name))
+    if not match:
+        return None
+    return datetime.datetime.strptime(match.group(), '%Y-%m-%d-%H%M%S').isoformat()
+
+
+def load_run(run_path: str):
+    """
+    Return dict of device name -> source for the configs of a backup run made by fg_backup_from_list.py.
+    run_path may be a run archive (.fgz), a store run directory (with manifest.json) or a directory
+    of plain .conf files.  Devices are named from their backup file names, so runs made with
+    different --output_format values pair up.  A source is a dict with either "path" (a config
+    file) or "archive" and "entry" (its archive index entry), and "sha256", the config_hash of the
+    config as recorded by store and archive runs, or computed here for the files of flat runs.
+    """
+    sources = {}
+    if run_path.endswith(ARCHIVE_EXTENSION):
+        index = read_archive_index(run_path)
+        for device_name, entry in index['devices'].items():
+            sources[device_from_file(entry['file'])] = {'archive': run_path, 'device': device_name,
+                                                        'entry': entry, 'sha256': entry['sha256']}
+        return sources
+
+    manifest = read_manifest(run_path)
+    if manifest is not None:
+        for device_name, entry in manifest['devices'].items():
+            # The run's own <device>.conf is a hard link to the stored object, where hard links were possible
+            path = os.path.join(run_path, entry['file'])
+            if not os.path.exists(path):
+                path = os.path.normpath(manifest_object_path(run_path, manifest, device_name))
+            sources[device_from_file(entry['file'])] = {'path': path, 'sha256': entry['sha256']}
+        return sources
+
+    for file_name in sorted(os.listdir(run_path)):
+        if file_name.endswith('.conf') and not is_temp_file(file_name):
+            path = os.path.join(run_path, file_name)
+            sources[device_from_file(file_name)] = {'path': path, 'sha256': config_hash(path)}
+    return sources
+
+
+def source_file(source: dict, tmp_dir: str, name: str):
+    """ Path of a config file for source, archived configs are extracted into tmp_dir """
+    if 'path' in source:
+        return source['path']
+    config = read_archived_config(source['archive'], source['device'], {'devices': {source['device']: source['entry']}})
+    path = os.path.join(tmp_dir, name)
+    with open(path, 'wb') as f:
+        f.write(config)
+    return path
+
+
+def match_devices(keys, device_names):
+    """
+    Map backup names (keys) to device names.  A key belongs to the device with the same name, or
+    else to the longest device name followed by "-" at the start of the key (file names made
+    with a lab name tag are <device>-<lab_name>), so "fg1" never claims "fg10" or "fg10-lab".
+    Returns dict of key -> device name for the keys that match a device.
+    """
+    device_names = set(device_names)
+    matched = {}
+    for key in keys:
+        if key in device_names:
+            matched[key] = key
+            continue
+        # Try each "-" boundary, longest prefix first
+        pos = len(key)
+        while True:
+            pos = key.rfind('-', 0, pos)
+            if pos <= 0:
+                break
+            if key[:pos] in device_names:
+                matched[key] = key[:pos]
+                break
+    return matched
+
+
+class BackupIndex:
+    """
+    Index of all config backups under a backup directory: device name -> versions, each with the
+    run it belongs to, its time and config hash.
+
+    Runs are the run directories (flat or store), run archives (.fgz) and the plain .conf files
+    kept directly in backup_dir (--create_new_dir false), where each file is its own version.
+    Hidden entries (.store, staging directories, temp files) are skipped.  The index is persisted
+    to <backup_dir>/.backup_index.json by save() and on the next refresh() only runs whose
+    modification time changed are scanned again, so lookups stay fast with many runs and files.
+    """
+    def __init__(self, backup_dir: str, rebuild: bool = False):
+        self.backup_dir = backup_dir
+        self.index_file = os.path.join(backup_dir, INDEX_FILE)
+        self.runs = {}
+        self.devices = {}
+        self.changed = False
+        # With rebuild the persisted index is ignored (but still replaced by save())
+        if not rebuild:
+            try:
+                with open(self.index_file) as f:
+                    data = json.load(f)
+                if data.get('version') == INDEX_VERSION:
+                    self.runs = data['runs']
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError) as e:
+                print(f'Warning, ignoring unreadable backup index {self.index_file}: {e}')
+
+    def _scan_run(self, run_name: str, run_path: str, mtime: int):
+        """ Index entry for one run directory or archive """
+        run_time = date_tag_time(run_name)
+        if run_time is None:
+            run_time = datetime.datetime.fromtimestamp(mtime / 1e9).isoformat(timespec='seconds')
+        versions = {}
+        for key, source in load_run(run_path).items():
+            versions[key] = dict(source, run=run_name, time=run_time)
+        return {'mtime': mtime, 'versions': versions}
+
+    def _scan_top_level(self, files: list, mtime: int):
+        """
+        Index entry for the plain .conf files directly in backup_dir, one version per file.  Files
+        are only hashed again when their modification time changed since the persisted index.
+        """
+        cached = {}
+        for old_versions in self.runs.get('', {}).get('files', {}).values():
+            for version in old_versions:
+                cached[version['path']] = version
+        versions = {}
+        for entry in files:
+            try:
+                file_mtime = entry.stat().st_mtime_ns
+                old = cached.get(entry.path)
+                if old and old.get('mtime') == file_mtime:
+                    digest = old['sha256']
+                else:
+                    digest = config_hash(entry.path)
+            except OSError as e:
+                print(f'Warning, skipping unreadable backup file {entry.path}: {e}')
+                continue
+            version = {'path': entry.path, 'run': '', 'sha256': digest, 'mtime': file_mtime,
+                       'time': date_tag_time(entry.name) or
+                       datetime.datetime.fromtimestamp(file_mtime / 1e9).isoformat(timespec='seconds')}
+            versions.setdefault(device_from_file(entry.name), []).append(version)
+        return {'mtime': mtime, 'files': versions}
+
+    def refresh(self):
+        """ Scan backup_dir, rescanning only runs that are new or changed since the persisted index """
+        runs = {}
+        top_level = []
+        with os.scandir(self.backup_dir) as it:
+            for entry in it:
+                if is_temp_file(entry.name):
+                    continue
+                if entry.is_dir():
+                    run_path = entry.path
+                elif entry.name.endswith(ARCHIVE_EXTENSION):
+                    run_path = entry.path
+                elif entry.name.endswith('.conf'):
+                    top_level.append(entry)
+                    continue
+                else:
+                    continue
+
+                # A run changes when files are added/replaced (directory) or its index is rewritten (archive)
+                stat_path = os.path.join(run_path, MANIFEST_FILE) if entry.is_dir() else f'{run_path}{INDEX_EXTENSION}'
+                try:
+                    mtime = max(entry.stat().st_mtime_ns, os.stat(stat_path).st_mtime_ns)
+                except FileNotFoundError:
+                    mtime = entry.stat().st_mtime_ns
+                cached = self.runs.get(entry.name)
+                if cached and cached['mtime'] == mtime:
+                    runs[entry.name] = cached
+                    continue
+                try:
+                    runs[entry.name] = self._scan_run(entry.name, run_path, mtime)
+                except (OSError, KeyError, ValueError) as e:
+                    print(f'Warning, skipping unreadable backup run {run_path}: {e}')
+                    continue
+                self.changed = True
+
+        if top_level:
+            mtime = os.stat(self.backup_dir).st_mtime_ns
+            cached = self.runs.get('')
+            if cached and cached['mtime'] == mtime:
+                runs[''] = cached
+            else:
+                runs[''] = self._scan_top_level(top_level, mtime)
+                self.changed = True
+
+        if set(runs) != set(self.runs):
+            self.changed = True
+        self.runs = runs
+        self._build_devices()
+        return self
+
+    def _build_devices(self):
+        """ Backup name -> versions sorted oldest to newest, from the run entries """
+        devices = {}
+        for run in self.runs.values():
+            for key, version in run.get('versions', {}).items():
+                devices.setdefault(key, []).append(version)
+            for key, versions in run.get('files', {}).items():
+                devices.setdefault(key, []).extend(versions)
+        for versions in devices.values():
+            versions.sort(key=lambda v: (v['time'], v['run']))
+        self.devices = devices
+
+    def save(self):
+        """ Persist the index if anything changed, failure to write it is not an error """
+        if not self.changed:
+            return
+        try:
+            with AtomicFileWriter(self.index_file) as writer:
+                writer.write(json.dumps({'version': INDEX_VERSION, 'runs': self.runs}).encode())
+                writer.commit()
+            self.changed = False
+        except OSError as e:
+            print(f'Warning, unable to save backup index {self.index_file}: {e}')
+
+    def run_names(self):
+        """ Names of the indexed runs, oldest first ('' is the plain files directly in backup_dir) """
+        return sorted(self.runs, key=lambda r: (date_tag_time(r) or '', r))
+
+    def versions(self, device_names: list):
+        """ Dict of device name -> versions (oldest to newest) for each of device_names with any backups """
+        result = {}
+        for key, device_name in match_devices(self.devices, device_names).items():
+            result.setdefault(device_name, []).extend(self.devices[key])
+        for versions in result.values():
+            versions.sort(key=lambda v: (v['time'], v['run']))
+        return result
+
+    def select(self, device_names: list, run: str = None):
+        """
+        Dict of device name -> version to restore for each of device_names: the newest backup of
+        the device, or with run given the device's backup in that run (run directory or archive name).
+        """
+        selected = {}
+        for device_name, versions in self.versions(device_names).items():
+            if run is not None:
+                versions = [v for v in versions if v['run'] == run]
+            if versions:
+                selected[device_name] = versions[-1]
+        return selected
@@ -0,0 +1,74 @@
+from modules.backup_archive import extract_config
+from modules.file_utils import AtomicFileWriter
+import datetime
+import json
+import os
+import shutil
+import threading
+
+STATE_FILE = '.backup_state.json'
+
+
+class BackupState:
+    """
+    Per-device state persisted between backup runs in <backup_dir>/.backup_state.json
+
+    For each device, records the config fingerprint (see FortiGateApiUtils.get_config_fingerprint)
+    seen at its last successful backup and where that backup is.  When the fingerprint has not
+    changed, the previous backup can be reused instead of downloading the config again.
+    """
+    def __init__(self, backup_dir: str):
+        self.state_file = os.path.join(backup_dir, STATE_FILE)
+        self.lock = threading.Lock()
+        try:
+            with open(self.state_file) as f:
+                self.devices = json.load(f).get('devices', {})
+        except FileNotFoundError:
+            self.devices = {}
+        except ValueError as e:
+            print(f'Warning, ignoring unreadable backup state file {self.state_file}: {e}')
+            self.devices = {}
+
+    def unchanged(self, device_name: str, fingerprint: str):
+        """ True if fingerprint matches the last backup of device_name and that backup still exists """
+        entry = self.devices.get(device_name)
+        if not fingerprint or not entry or entry.get('fingerprint') != fingerprint:
+            return False
+        return os.path.exists(entry['path'])
+
+    def update(self, device_name: str, fingerprint: str, path: str, archive: bool = False):
+        """
+        Record a successful backup of device_name.  path is a plain config file, or a run archive
+        if archive is True.  Devices without a fingerprint are removed (always fully backed up).
+        """
+        with self.lock:
+            if not fingerprint:
+                self.devices.pop(device_name, None)
+                return
+            self.devices[device_name] = {'fingerprint': fingerprint, 'path': os.path.abspath(path),
+                                         'archive': archive,
+                                         'time': datetime.datetime.now().isoformat(timespec='seconds')}
+
+    def reuse_backup(self, device_name: str, dest_file: str):
+        """ Recreate the last backup of device_name as dest_file, without contacting the device """
+        entry = self.devices[device_name]
+        if entry.get('archive'):
+            return extract_config(entry['path'], device_name, dest_file)
+        if os.path.abspath(dest_file) == entry['path']:
+            return dest_file
+        try:
+            # Hard link where possible, the content is identical and doesn't need copying
+            os.link(entry['path'], dest_file)
+        except FileExistsError:
+            os.unlink(dest_file)
+            os.link(entry['path'], dest_file)
+        except OSError:
+            shutil.copyfile(entry['path'], dest_file)
+        return dest_file
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({'devices': self.devices}, indent=2)
+        with AtomicFileWriter(self.state_file) as writer:
+            writer.write(data.encode())
+            writer.commit()
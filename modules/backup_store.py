@@ -0,0 +1,141 @@
+from modules.file_utils import AtomicFileWriter
+import datetime
+import hashlib
+import json
+import os
+import shutil
+
+# Header lines which change between backups of an otherwise identical config
+VOLATILE_HEADER_PREFIXES = (b'#conf_file_ver=',)
+MANIFEST_FILE = 'manifest.json'
+STORE_DIR = '.store'
+
+
+def normalize_header_line(line: bytes):
+    """
+    Return header line with volatile fields removed, or None to drop the line entirely.
+    The #config-version line includes the name of the admin that took the backup (user=)
+    which is dropped, the platform/version/build fields are kept.
+    """
+    if line.startswith(VOLATILE_HEADER_PREFIXES):
+        return None
+    if line.startswith(b'#config-version='):
+        return b':'.join(field for field in line.rstrip(b'\r\n').split(b':') if not field.startswith(b'user='))
+    return line
+
+
+def config_hash(config_file: str):
+    """
+    sha256 hex digest of a FortiOS config file, ignoring volatile header fields so two
+    backups of an unchanged config hash the same.  The file is read line by line.
+    """
+    digest = hashlib.sha256()
+    with open(config_file, 'rb') as f:
+        in_header = True
+        for line in f:
+            if in_header and line.startswith(b'#'):
+                line = normalize_header_line(line)
+                if line is None:
+                    continue
+            else:
+                in_header = False
+            digest.update(line)
+    return digest.hexdigest()
+
+
+class BackupStore:
+    """
+    Content addressed store for config backups, kept in <backup_dir>/.store
+
+    Each distinct config (by config_hash) is stored once as .store/objects/<xx>/<hash>.conf.
+    Run directories keep their normal <device>.conf files, but as hard links to the stored
+    object, so unchanged configs take no extra disk space.  Each run directory also gets a
+    manifest.json recording the device -> hash mapping, which is enough to rebuild the run
+    even where hard links are not possible (the .conf is then left out of the run directory).
+    """
+    def __init__(self, backup_dir: str):
+        self.root = os.path.join(backup_dir, STORE_DIR)
+        self.objects_dir = os.path.join(self.root, 'objects')
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    def object_path(self, digest: str):
+        return os.path.join(self.objects_dir, digest[:2], f'{digest}.conf')
+
+    def add_file(self, config_file: str):
+        """
+        Add config_file to the store and replace config_file with a hard link to the stored object.
+        Returns dict of details for the manifest (sha256, size, new, linked).  Safe to call from
+        multiple threads at the same time.
+        """
+        digest = config_hash(config_file)
+        obj = self.object_path(digest)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+
+        new = False
+        linked = True
+        try:
+            # First time this config has been seen, the backup file itself becomes the stored object
+            os.link(config_file, obj)
+            new = True
+        except FileExistsError:
+            # Already stored, point the run directory file at the existing object instead
+            tmp_link = f'{config_file}.{os.getpid()}.tmp'
+            try:
+                os.link(obj, tmp_link)
+                os.replace(tmp_link, config_file)
+            except OSError:
+                # No hard link support, the run directory keeps just the manifest reference
+                os.unlink(config_file)
+                linked = False
+        except OSError:
+            # No hard link support, move the file into the store and reference it from the manifest
+            shutil.move(config_file, obj)
+            new = True
+            linked = False
+
+        return {'sha256': digest, 'size': os.path.getsize(obj), 'new': new, 'linked': linked}
+
+    def write_manifest(self, run_dir: str, devices: dict):
+        """
+        Write manifest.json to run_dir.  devices is a dict of device name -> dict from add_file()
+        with a "file" key for the file name in the run directory.
+        """
+        manifest = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                    'store': os.path.relpath(self.root, run_dir),
+                    'devices': devices}
+        with AtomicFileWriter(os.path.join(run_dir, MANIFEST_FILE)) as writer:
+            writer.write(json.dumps(manifest, indent=2).encode())
+            writer.commit()
+
+
+def read_manifest(run_dir: str):
+    """ Return the manifest dict of a store run directory, or None if run_dir has no manifest """
+    try:
+        with open(os.path.join(run_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def manifest_object_path(run_dir: str, manifest: dict, device_name: str):
+    """ Path of the stored object for device_name in the run described by manifest """
+    digest = manifest['devices'][device_name]['sha256']
+    return os.path.join(run_dir, manifest['store'], 'objects', digest[:2], f'{digest}.conf')
+
+
+def export_run(run_dir: str, dest_dir: str):
+    """
+    Export a store run directory to the plain flat layout, independent copies of
+    <device>.conf in dest_dir.  Returns list of files written.
+    """
+    manifest = read_manifest(run_dir)
+    if manifest is None:
+        raise FileNotFoundError(f'No {MANIFEST_FILE} in {run_dir}, not a backup store run directory')
+
+    os.makedirs(dest_dir, exist_ok=True)
+    written = []
+    for device_name, entry in manifest['devices'].items():
+        dest = os.path.join(dest_dir, entry['file'])
+        shutil.copyfile(manifest_object_path(run_dir, manifest, device_name), dest)
+        written.append(dest)
+    return written
@@ -1,29 +1,31 @@
+from modules.file_utils import is_temp_file
+from modules.inventory import load_inventory
 import yaml
 import os
 import platform
 
-def read_device_file(dev_file, type='yaml'):
+def read_device_file(dev_file, type='yaml', cache=True):
     """
-    Read yaml and return as dict()
+    Read yaml and return it as an Inventory (see modules/inventory), the DeviceRecord of each valid
+    device is in its devices.  Invalid devices are reported and left out.  The parsed file is cached
+    next to the file until it changes
     """
     if type != 'yaml':
         raise NotImplementedError('Only YAML type device files are currently supported') 
     try:
-        # Open device yaml file for reading.
-        with open(dev_file) as file:
-            try:
-                # Read yaml file to python dict()
-                fgt_details = yaml.safe_load(file)
-
-            except yaml.YAMLError as e:
-                print(f'Error processing device yaml file: {e}')
-                return False
-        
-            return fgt_details
-        
+        inventory = load_inventory(dev_file, cache=cache)
+    except yaml.YAMLError as e:
+        print(f'Error processing device yaml file: {e}')
+        return False
+    except ValueError as e:
+        print(f'Invalid device yaml file {dev_file}: {e}')
+        return False
     except IOError as e:
         print(f'Error reading device yaml file: {e}')
         return False
+    for name, reason in inventory.invalid.items():
+        print(f'Skipping invalid device {name} in {dev_file}: {reason}')
+    return inventory
 
 
 def user_file_selection(fdir):
@@ -33,12 +35,15 @@ def user_file_selection(fdir):
     """
     # List to track indexes in directory file list
     fdir_idx = []
-    # Get list of files in backup_dir
+    # Get list of files in backup_dir, without the hidden files kept next to device files (cache, key journal)
     try:
-        fdir_files = os.listdir(fdir)
+        fdir_files = [f for f in os.listdir(fdir) if not is_temp_file(f)]
     except OSError as e:
         print(f'Error opening device file directory {fdir}, aborting: {e}')
         raise SystemExit
+    if not fdir_files:
+        print(f'No device files in {fdir}, aborting')
+        raise SystemExit
 
     print('Select a device file to use for this operation:')
     for f in fdir_files:
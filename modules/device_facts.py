@@ -0,0 +1,28 @@
+class DeviceFacts:
+    """
+    Facts about a FG from its monitor/system/status response, which the apikey login already fetches
+    to verify the key, so later calls (upgrade version checks, reports) don't ask the FG again.
+    They are as of the time of the status call, a firmware upgrade changes version and build.
+
+    vdom_mode is not part of the status response, it is filled in from the #config-version header
+    when a backup of the FG is taken ("multi-vdom" or "no-vdom"), otherwise it is None.
+    """
+    def __init__(self, status: dict):
+        results = status.get('results') or {}
+        self.version = status.get('version')
+        self.build = status.get('build')
+        self.serial = status.get('serial')
+        self.model = results.get('model')
+        self.hostname = results.get('hostname')
+        self.vdom_mode = None
+
+    def update_from_header(self, header: bytes):
+        """ Fill in vdom_mode from the first line of a config backup (#config-version=...:vdom=1:...) """
+        first_line = header.split(b'\n', 1)[0]
+        for field in first_line.split(b':'):
+            if field.startswith(b'vdom='):
+                self.vdom_mode = 'multi-vdom' if field == b'vdom=1' else 'no-vdom'
+
+    def as_dict(self):
+        return {'version': self.version, 'build': self.build, 'serial': self.serial, 'model': self.model,
+                'hostname': self.hostname, 'vdom_mode': self.vdom_mode}
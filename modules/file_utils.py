@@ -0,0 +1,87 @@
+import os
+import tempfile
+
+
+# mkstemp creates files readable only by the owner, files are given normal umask based permissions instead
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class AtomicFileWriter:
+    """
+    Write a file via a temp file in the same directory which is only renamed to
+    file_path by commit(), so a crash or error part way through never leaves a
+    truncated file_path behind (the temp file is removed when used as a context
+    manager and commit() was not reached).
+
+    If expect_header (bytes) is given, the start of the data written is checked
+    against it as soon as enough bytes have arrived.  valid is None until then,
+    then True or False.  commit() refuses to rename an invalid file.
+
+    Temp files are named ".<file name>.<random>.tmp" so they are easy to tell
+    apart from real files when scanning a directory.
+
+    The file gets permissions mode if given (such as 0o600 for a file holding
+    secrets), otherwise the usual umask based ones.  They are set before the
+    rename, so file_path never has other permissions.
+    """
+    def __init__(self, file_path: str, expect_header: bytes = None, mode: int = None):
+        self.file_path = file_path
+        self.expect_header = expect_header
+        self.mode = 0o666 & ~_UMASK if mode is None else mode
+        self.header = b''
+        self.valid = None if expect_header else True
+        self.bytes_written = 0
+        self.committed = False
+
+        fd, self.tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(file_path)}.', suffix='.tmp',
+                                             dir=os.path.dirname(file_path) or '.')
+        self.file = os.fdopen(fd, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.committed:
+            self.abort()
+
+    def write(self, chunk: bytes):
+        if self.valid is None:
+            # Collect just enough of the first chunk(s) to check the header
+            self.header += chunk[:len(self.expect_header) - len(self.header)]
+            if len(self.header) == len(self.expect_header):
+                self.valid = self.header == self.expect_header
+            elif not self.expect_header.startswith(self.header):
+                self.valid = False
+        self.file.write(chunk)
+        self.bytes_written += len(chunk)
+
+    def commit(self):
+        """ Flush the temp file to disk and rename it to file_path, returns file_path """
+        if not self.valid:
+            raise ValueError(f'Refusing to write {self.file_path}, content did not start with {self.expect_header}')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        os.chmod(self.tmp_path, self.mode)
+        self.file.close()
+        os.replace(self.tmp_path, self.file_path)
+        self.committed = True
+        return self.file_path
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+def is_temp_file(file_name: str):
+    """ True if file_name looks like a leftover AtomicFileWriter temp file (or other hidden file) """
+    return os.path.basename(file_name).startswith('.') or file_name.endswith('.tmp')
+
+
+def read_first_line(file_path: str):
+    """ First line of file_path (bytes, with its newline), such as the #config-version header of a backup """
+    with open(file_path, 'rb') as f:
+        return f.readline()
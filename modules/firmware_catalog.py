@@ -0,0 +1,83 @@
+import asyncio
+import re
+import threading
+import time
+import weakref
+
+# Such as "v7.2.5" or the version in an image file name like FGT_VM64-v7.2.6.F-build1575-FORTINET.out
+VERSION_RE = re.compile(r'(\d+)\.(\d+)\.(\d+)')
+
+# Seconds a platform's catalog is used before it is fetched again, FortiGuard only changes with new releases
+DEFAULT_TTL = 3600
+
+
+def parse_version(text: str):
+    """ (major, minor, patch) of the first version found in text, None if there is none """
+    match = VERSION_RE.search(text or '')
+    if not match:
+        return None
+    return tuple(int(x) for x in match.groups())
+
+
+def index_available(available: list):
+    """ Dict of (major, minor, patch) -> image entry for the "available" list of monitor/system/firmware """
+    return {(image['major'], image['minor'], image['patch']): image for image in available}
+
+
+class FirmwareCatalog:
+    """
+    Cache of the firmware images FortiGuard offers, per platform (such as FGVM64 or FG100F).
+
+    Every device of a model is offered the same images, so the catalog of a platform is fetched
+    from the first device of that model and used for all the others until it is ttl seconds old.
+    Callers pass the fetch function/coroutine of their own device, devices of a platform arriving
+    while it is being fetched wait for that fetch instead of making their own.
+    """
+    def __init__(self, ttl: float = DEFAULT_TTL):
+        self.ttl = ttl
+        self.platforms = {}
+        self._lock = threading.Lock()
+        self._platform_locks = {}
+        # asyncio locks belong to one event loop, a run may use more than one (one per asyncio.run())
+        self._async_locks = weakref.WeakKeyDictionary()
+
+    def cached(self, platform: str):
+        """ Index of the images available for platform, None if not cached or older than ttl """
+        entry = self.platforms.get(platform)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    def add(self, platform: str, available: list):
+        index = index_available(available)
+        self.platforms[platform] = (time.monotonic(), index)
+        return index
+
+    def _platform_lock(self, platform: str, locks: dict, lock_type):
+        with self._lock:
+            lock = locks.get(platform)
+            if lock is None:
+                lock = locks[platform] = lock_type()
+            return lock
+
+    def lookup(self, platform: str, fetch):
+        """ Index of the images available for platform, calling fetch() for the "available" list if not cached """
+        with self._platform_lock(platform, self._platform_locks, threading.Lock):
+            index = self.cached(platform)
+            if index is None:
+                index = self.add(platform, fetch())
+            return index
+
+    async def lookup_async(self, platform: str, fetch):
+        """ Same as lookup, fetch is a coroutine function """
+        with self._lock:
+            locks = self._async_locks.setdefault(asyncio.get_running_loop(), {})
+        async with self._platform_lock(platform, locks, asyncio.Lock):
+            index = self.cached(platform)
+            if index is None:
+                index = self.add(platform, await fetch())
+            return index
+
+
+# Shared by every device (thread or task) of a run
+catalog = FirmwareCatalog()
@@ -0,0 +1,118 @@
+from modules.file_utils import AtomicFileWriter, is_temp_file
+import hashlib
+import json
+import os
+import re
+
+# FOS image file names, such as FGT_VM64-v7.2.6.F-build1575-FORTINET.out or FGT_100F-v7.0.12.M-build0523-FORTINET.out
+IMAGE_RE = re.compile(r'^FGT_(?P<model>[A-Za-z0-9_]+?)-v(?P<major>\d+)\.(?P<minor>\d+)\.(?P<patch>\d+)'
+                      r'(?:\.[A-Za-z]+)?-build(?P<build>\d+)', re.IGNORECASE)
+IMAGE_EXTENSION = '.out'
+REPO_INDEX_FILE = '.firmware_index.json'
+REPO_INDEX_VERSION = 1
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def platform_key(model: str):
+    """
+    Key matching a device's reported model (such as FGVM64, FG100F or FGT60F) to the model in image
+    file names (VM64, 100F, 60F), upper case without the FG/FGT prefix or separators
+    """
+    key = model.upper().replace('_', '').replace('-', '')
+    for prefix in ('FGT', 'FG'):
+        if key.startswith(prefix):
+            return key[len(prefix):]
+    return key
+
+
+def file_sha256(path: str):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class FirmwareRepository:
+    """
+    Local directory (and sub directories) of FOS images, indexed by platform and version from their
+    file names, so the right image for each device of a mixed fleet can be selected from its model.
+
+    The sha256 of each image is computed once and persisted with the index in
+    <repo_dir>/.firmware_index.json by save(), on the next refresh() only images that are new or whose
+    size or modification time changed are hashed again.
+    """
+    def __init__(self, repo_dir: str, rebuild: bool = False):
+        self.repo_dir = repo_dir
+        self.index_file = os.path.join(repo_dir, REPO_INDEX_FILE)
+        self.images = {}
+        self.changed = False
+        if not rebuild:
+            try:
+                with open(self.index_file) as f:
+                    data = json.load(f)
+                if data.get('version') == REPO_INDEX_VERSION:
+                    self.images = data['images']
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError) as e:
+                print(f'Warning, ignoring unreadable firmware index {self.index_file}: {e}')
+
+    def refresh(self):
+        """ Scan repo_dir for images, hashing only new or changed ones """
+        images = {}
+        for dir_path, dir_names, file_names in os.walk(self.repo_dir):
+            dir_names[:] = [d for d in dir_names if not is_temp_file(d)]
+            for file_name in file_names:
+                match = IMAGE_RE.match(file_name)
+                if not file_name.endswith(IMAGE_EXTENSION) or is_temp_file(file_name) or not match:
+                    continue
+                path = os.path.join(dir_path, file_name)
+                rel_path = os.path.relpath(path, self.repo_dir)
+                stat = os.stat(path)
+                cached = self.images.get(rel_path)
+                if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime_ns:
+                    images[rel_path] = cached
+                    continue
+                images[rel_path] = {'platform': platform_key(match['model']),
+                                    'version': f'v{int(match["major"])}.{int(match["minor"])}.{int(match["patch"])}',
+                                    'build': int(match['build']), 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                                    'sha256': file_sha256(path)}
+                self.changed = True
+
+        if set(images) != set(self.images):
+            self.changed = True
+        self.images = images
+        return self
+
+    def save(self):
+        """ Persist the index if anything changed, failure to write it is not an error """
+        if not self.changed:
+            return
+        try:
+            with AtomicFileWriter(self.index_file) as writer:
+                writer.write(json.dumps({'version': REPO_INDEX_VERSION, 'images': self.images}).encode())
+                writer.commit()
+            self.changed = False
+        except OSError as e:
+            print(f'Warning, unable to save firmware index {self.index_file}: {e}')
+
+    def platforms(self):
+        return sorted({image['platform'] for image in self.images.values()})
+
+    def select(self, model: str, version: tuple):
+        """
+        Image for a device reporting model (such as FGVM64) at version (major, minor, patch), the
+        highest build if there are several.  Returns the index entry plus its "path", or None.
+        """
+        platform = platform_key(model)
+        version_str = 'v{}.{}.{}'.format(*version)
+        best = None
+        for rel_path, image in self.images.items():
+            if image['platform'] == platform and image['version'] == version_str:
+                if best is None or image['build'] > best['build']:
+                    best = dict(image, path=os.path.join(self.repo_dir, rel_path))
+        return best
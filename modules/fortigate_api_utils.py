@@ -1,58 +1,164 @@
 from pyFGT.fortigate import *
+from modules.device_facts import DeviceFacts
+from modules.file_utils import AtomicFileWriter, read_first_line
+from modules.firmware_catalog import catalog, parse_version
+from modules.firmware_repo import FirmwareRepository
+from modules.instrumentation import recorder
+from modules.retry_policy import PolicyRegistry, RETRIES, CONNECT_TIMEOUT
+from modules.session_pool import SessionPool, MAX_SESSIONS, POOL_MAXSIZE
+from modules.upload_utils import JsonUploadBody, StreamingB64File, shared_encoded_file
+import requests
 import base64
+import hashlib
+import json
+import os
 import sys
+import time
 
 
-# Prepare fg config file for restore
+# Every valid FortiOS config backup starts with this
+CONFIG_HEADER = b'#config-version'
+
+
+# Prepare fg config file for restore, as a string.  Uploads stream the encoding instead (see upload_utils)
 def file_to_b64(my_file):
     try:
         with open(my_file, 'rb') as f:
-            f64 = base64.encodebytes(f.read())
-            f64_clean = f64.decode('ASCII').replace('\n', '')
+            # b64encode adds no newlines, so nothing to strip afterwards
+            f64_clean = base64.b64encode(f.read()).decode('ASCII')
     except IOError as e:
         print('Error opening file or converting to base64')
         raise Exception
     return f64_clean
 
 
+def parse_config_fingerprint(code, msg):
+    """
+    Build a config fingerprint from a monitor/system/ha-checksums response, the config checksums
+    FortiOS maintains (also on standalone, non HA units) plus the firmware version/build.
+    Returns None if the response does not contain checksums.
+    """
+    if code != 'success' or not isinstance(msg, dict):
+        return None
+    results = msg.get('results')
+    if isinstance(results, list):
+        # One entry per cluster member, use the one for the unit we are talking to
+        members = [r for r in results if r.get('serial_no') == msg.get('serial')] or results
+        results = members[0] if members else None
+    if not isinstance(results, dict) or not results.get('checksum'):
+        return None
+    fingerprint = json.dumps([msg.get('version'), msg.get('build'), results['checksum']], sort_keys=True)
+    return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+
+def upgrade_succeeded(code):
+    """
+    True if code, from upgrade_image of either api client, means the upgrade was requested (or not needed).
+    An image upload answers with the response's http_status (200) or status ('success'), the other
+    paths with True.
+    """
+    return code is True or code in (200, 'success')
+
+
 class FortiGateApiUtils:
     # Class Constants
     API_TIMEOUT = 30
+    API_RETRIES = RETRIES
+    CONNECT_TIMEOUT = CONNECT_TIMEOUT
     API_DIS_REQ_WARNINGS = True
+    BACKUP_CHUNK_SIZE = 64 * 1024
+    UPLOAD_TIMEOUT = 600
+
+    # Keep-alive sessions shared by all instances, one per device
+    sessions = SessionPool()
+    # Adaptive timeouts and retries, one policy per device (see retry_policy.DevicePolicy)
+    policies = PolicyRegistry()
+
+    @classmethod
+    def configure_sessions(cls, max_sessions: int = MAX_SESSIONS, pool_maxsize: int = POOL_MAXSIZE):
+        """ Size the shared session pool, max_sessions should be at least the number of concurrent workers """
+        cls.sessions.close()
+        cls.sessions = SessionPool(max_sessions=max_sessions, pool_maxsize=pool_maxsize)
 
     # class initializer
     def __init__(self, device: dict = None, verbose: bool = True, debug: bool = True):
         self.verbose = verbose
         self.debug = debug
         self.device = device
+        # Optional device attribute, allows plain http for lab/mock devices (default is https)
+        use_ssl = device.get('use_ssl', True)
+        self.base_url = f'{"https" if use_ssl else "http"}://{device["ip"]}'
 
         if 'apikey' in device:
-            self.api = FortiGate(device['ip'], device['login'], apikey=device['apikey'], debug=debug,
+            self.api = FortiGate(device['ip'], device.get('login', 'apiadmin'), apikey=device['apikey'], debug=debug,
                                  disable_request_warnings=FortiGateApiUtils.API_DIS_REQ_WARNINGS,
-                                 timeout=FortiGateApiUtils.API_TIMEOUT)
+                                 timeout=FortiGateApiUtils.API_TIMEOUT, use_ssl=use_ssl)
         elif 'password' in device:
             self.api = FortiGate(device['ip'], device['login'], passwd=device['password'], debug=debug,
                                  disable_request_warnings=FortiGateApiUtils.API_DIS_REQ_WARNINGS,
-                                 timeout=FortiGateApiUtils.API_TIMEOUT)
+                                 timeout=FortiGateApiUtils.API_TIMEOUT, use_ssl=use_ssl)
         else:
             raise Exception('Neither "passwd" nor "apikey" were provided, must define one of these.')
 
+        # Use the device's pooled keep-alive session, rather than pyFGT creating a new one per instance
+        self.session_key = (self.base_url, device.get('apikey') or device.get('login'))
+        self.api._session = FortiGateApiUtils.sessions.get(self.session_key)
+        self.policy = FortiGateApiUtils.policies.get(self.session_key, FortiGateApiUtils.API_TIMEOUT,
+                                                     retries=FortiGateApiUtils.API_RETRIES,
+                                                     connect_timeout=FortiGateApiUtils.CONNECT_TIMEOUT)
+        # DeviceFacts from the status response, set by an apikey login or the first get_facts()
+        self.facts = None
+
     # Stringify the class instance
     def __str__(self):
         # Return all instance variables as string
         return str(vars(self))
 
-    # API login to FG
-    def login(self):
+    # pyFGT get/post with the device's adaptive timeouts, retried on connection errors and timeouts if idempotent
+    def _api_call(self, method: str, path: str, idempotent: bool = True, minimum: float = 0, **params):
+        def attempt(timeouts):
+            self.api.timeout = timeouts
+            # pyFGT doesn't expose the response, so bytes in/out are not recorded for these calls
+            with recorder.span(f'{method.upper()} {path.lstrip("/")}', self.device['name']) as span:
+                try:
+                    code, msg = getattr(self.api, method)(path, **params)
+                except FGTBaseException as e:
+                    # pyFGT raises a read timeout as a generic error, as far as retries go it is a connection error
+                    if isinstance(e.__context__, requests.exceptions.Timeout):
+                        raise FGTConnectionError(str(e))
+                    raise
+                span.status = code
+                return code, msg
+
+        return self.policy.call(attempt, idempotent=idempotent, minimum=minimum)
+
+    # API login to FG, facts from an earlier status check of the FG in this run (such as a pre-flight check)
+    # saves verifying the apikey with another one
+    def login(self, facts: DeviceFacts = None):
+        with recorder.span('login', self.device['name']) as span:
+            r, msg = self._login(facts)
+            span.status = 'ok' if r else 'failed'
+        return r, msg
+
+    def _login(self, facts: DeviceFacts = None):
+        # Short connect timeout, so an unreachable FG fails fast
+        self.api.timeout = self.policy.timeouts(minimum=FortiGateApiUtils.API_TIMEOUT)
         r = self.api.login()
         # pyfgt login doesn't seem to validate that the apikey is valid on the target host
         # thus we run a quick api get call to verify authentication before return result
         if self.api.api_key_used:
             print('using apikey')
+            if facts is not None:
+                self.facts = facts
+                return True, 'Connected'
             self.api.debug = False # Since this is not a user requested check we want to not output debug to stdout
-            code, msg = self.api.get('monitor/system/status')
-            self.api.debug = self.debug  # reset the debug status to whatever was last defined
+            try:
+                code, msg = self._api_call('get', 'monitor/system/status')
+            finally:
+                self.api.debug = self.debug  # reset the debug status to whatever was last defined
             if code == 'success':
+                # Keep the status response, it is the device facts later calls need
+                self.facts = DeviceFacts(msg)
                 return True, 'Connected'
             else:
                 return False, 'Likely, the apikey was not verified/authenticated by FG'
@@ -69,27 +175,147 @@ class FortiGateApiUtils:
         except FGTBaseException:
             return False, 'Something failed, oh well, probably can ignore since is logout'
             pass
+        finally:
+            # pyFGT drops the session headers on a password logout, that session can't be used again
+            if not self.api.api_key_used:
+                FortiGateApiUtils.sessions.discard(self.session_key)
+
+    # Cheap check of the current config state, used to skip backups of unchanged devices
+    def get_config_fingerprint(self):
+        """
+        Return a fingerprint string which changes whenever the device config (or firmware) changes,
+        without downloading the config.  Returns None if not available, take a full backup then.
+        """
+        self.api.debug = False  # Not a user requested call, don't output debug to stdout
+        try:
+            code, msg = self._api_call('get', 'monitor/system/ha-checksums')
+        finally:
+            self.api.debug = self.debug
+        return parse_config_fingerprint(code, msg)
 
     # Method to get FG instance backup and write it to backup_dir with timestamp and tag
     def backup_to_file(self, backup_dir, date: str = '', file_tag: str = ''):
-        response = self.api.post('/monitor/system/config/backup', 'scope=global')
-        # Need to extract data from response object at second position of returned tuple
+        backup_file = f'{backup_dir}/{date}{self.device["name"]}{file_tag}.conf'
 
-        # Very simple check for validity of returned file
-        config = response[1].content.decode('ASCII')
-        if not config.startswith('#config-version'):
-            return False, 'Backup file check, file may not be valid config'
+        # pyFGT reads the whole response into memory, so use its session directly to stream the
+        # config to disk in chunks.  The session already carries the login cookies/token headers.
+        def attempt(timeouts):
+            with recorder.span('POST monitor/system/config/backup', self.device['name']) as span:
+                result, msg, bytes_written = download(timeouts)
+                span.bytes_in = bytes_written
+                span.status = 'ok' if result else 'invalid'
+            if result:
+                self.policy.observe(time.perf_counter() - span.start, bytes_written)
+            return result, msg
+
+        def download(timeouts):
+            try:
+                response = self.api.fgt_session.post(f'{self.base_url}/api/v2/monitor/system/config/backup',
+                                                     params={'scope': 'global'}, stream=True,
+                                                     verify=self.api.verify_ssl, timeout=timeouts)
+            except requests.exceptions.RequestException as e:
+                raise FGTConnectionError(f'Connection error: {type(e)} {e}')
+
+            # Time spent writing to disk, recorded apart from the download
+            write_time = 0.0
+            with response:
+                try:
+                    # Written to a temp file then renamed, so a failure never leaves a truncated .conf behind
+                    with AtomicFileWriter(backup_file, expect_header=CONFIG_HEADER) as writer:
+                        for chunk in response.iter_content(chunk_size=FortiGateApiUtils.BACKUP_CHUNK_SIZE):
+                            start = time.perf_counter()
+                            writer.write(chunk)
+                            write_time += time.perf_counter() - start
+                            # Very simple check for validity of returned file, done on the first chunk
+                            if writer.valid is False:
+                                return False, 'Backup file check, file may not be valid config', writer.bytes_written
+                        if not writer.valid:
+                            return False, 'Backup file check, file may not be valid config', writer.bytes_written
+                        start = time.perf_counter()
+                        writer.commit()
+                        write_time += time.perf_counter() - start
+                except requests.exceptions.RequestException as e:
+                    raise FGTConnectionError(f'Connection error during backup download: {type(e)} {e}')
+                except IOError as e:
+                    return False, f'Error writing backup file: {e}', 0
+            recorder.add('file write', self.device['name'], write_time, bytes_out=writer.bytes_written)
+            return True, backup_file, writer.bytes_written
+
+        # The FG builds the whole config before sending it, so a backup gets at least API_TIMEOUT
+        result, msg = self.policy.call(attempt, minimum=FortiGateApiUtils.API_TIMEOUT, observe=False)
+        if not result:
+            return result, msg
+
+        # The config header tells if the FG is in multi-vdom mode, which the status response doesn't
+        if self.facts is not None:
+            self.facts.update_from_header(read_first_line(backup_file))
+        return True, backup_file
+
+    # POST a large upload (image or config) to the api
+    def _post_upload(self, path: str, body: JsonUploadBody, minimum: int):
+        """
+        Send body to the api a chunk at a time, pyFGT would json.dumps the whole request into one
+        string first.  Uses the pyFGT session (login cookies/token headers) and returns (code, msg)
+        the same way pyFGT does.  Not retried, the timeout is at least minimum plus the time to
+        send body at the device's observed transfer rate.
+        """
+        url = f'{self.base_url}/api/v2/{path.lstrip("/")}'
+
+        def attempt(timeouts):
+            with recorder.span(f'POST {path.lstrip("/")}', self.device['name']) as span:
+                span.bytes_out = len(body)
+                try:
+                    response = self.api.fgt_session.post(url, data=body, verify=self.api.verify_ssl, timeout=timeouts)
+                except requests.exceptions.RequestException as e:
+                    raise FGTConnectionError(f'Connection error: {type(e)} {e}')
+                span.bytes_in = len(response.content)
+                span.status = response.status_code
+                return response
+
+        response = self.policy.call(attempt, idempotent=False, payload_bytes=len(body), minimum=minimum)
 
-        # Open file for writing and write config to file
         try:
-            with open(f'{backup_dir}/{date}{self.device["name"]}{file_tag}.conf', 'w+') as backup_file:
-                backup_file.write(config)
-        except IOError as e:
-            return False, f'Error writing backup file: {e}'
-        return True, f'{backup_dir}/{date}{self.device["name"]}{file_tag}.conf'
+            msg = response.json()
+        except ValueError:
+            return 100, response
+        if self.debug:
+            print(f'POST REQUEST: {url} ({len(body)} bytes)')
+            print(f'RESPONSE: {msg}')
+        return msg.get('http_status', msg.get('status')), msg
+
+    # Facts (version, model, serial, hostname, ...) of the FG, from the apikey login or else one status call
+    def get_facts(self, refresh: bool = False):
+        if self.facts is None or refresh:
+            code, msg = self._api_call('get', 'monitor/system/status')
+            if code != 'success':
+                raise FGTValueError(f'Unable to get system status: {msg}')
+            self.facts = DeviceFacts(msg)
+        return self.facts
+
+    # Platform (model, such as FGVM64) and current FOS version of the FG
+    def get_platform_version(self):
+        facts = self.get_facts()
+        return facts.model or self.device['name'], facts.version
+
+    # Images available from FortiGuard for platform, indexed by (major, minor, patch).  Fetched from this
+    # FG only when no other FG of the same platform already has (the catalog is shared by all devices)
+    def available_firmware(self, platform: str):
+        def fetch():
+            code, msg = self._api_call('get', '/monitor/system/firmware')
+            if code != 'success':
+                raise FGTValueError(f'Unable to get available firmware: {msg}')
+            return msg['results']['available']
+
+        return catalog.lookup(platform, fetch)
+
+    # Pre-flight check of a FortiGuard upgrade, returns (platform, current version, image entry or None)
+    def firmware_preflight(self, img_ver_rev: str):
+        platform, version = self.get_platform_version()
+        return platform, version, self.available_firmware(platform).get(parse_version(img_ver_rev))
 
     # Method to execute upgrade of fgt instance
-    def upgrade_image(self, image_source: str = 'fortiguard', img_ver_rev: str = None):
+    def upgrade_image(self, image_source: str = 'fortiguard', img_ver_rev: str = None,
+                      firmware_repo: FirmwareRepository = None):
         if not img_ver_rev:
             raise Exception('var "img_ver_rev" is required by was not supplied')
 
@@ -97,51 +323,58 @@ class FortiGateApiUtils:
             if self.verbose:
                 print(f'<<< Starting upgrade from FortiGuard >>>')
 
-            # Query current available firmware from fortiguard available to this device
-            code, msg = self.api.get('/monitor/system/firmware')
-
             # Check if current version is same as requested version and exit if so
-            if msg['results']['current']['version'].lstrip('v') == img_ver_rev:
-                return True, f"Version requested {img_ver_rev }is same as current version, skipping"
-
-            # Split requested version var (img_ver_rev) to major, minor, patch vars
-            os_major, os_minor, os_patch = img_ver_rev.split(".")
+            platform, version = self.get_platform_version()
+            if version.lstrip('v') == img_ver_rev:
+                return True, f"Version requested {img_ver_rev} is same as current version, skipping"
 
-            # Identify if requested versions available on this device through fortiguard
-            for avail_ver in msg['results']['available']:
-                if avail_ver['major'] == int(os_major) and avail_ver['minor'] == int(os_minor) and \
-                        avail_ver['patch'] == int(os_patch):
+            # Identify if requested version is available on this device through fortiguard
+            avail_ver = self.available_firmware(platform).get(parse_version(img_ver_rev))
+            if avail_ver is None:
+                return False, f'No image found for {img_ver_rev} for this device'
 
-                    if self.verbose:
-                        print(f'  Found available image {avail_ver["version"]} with ID: {avail_ver["id"]}')
-                        print(f'  Initiating upgrade with image ID: {avail_ver["id"]}: ', end='')
+            if self.verbose:
+                print(f'  Found available image {avail_ver["version"]} with ID: {avail_ver["id"]}')
+                print(f'  Initiating upgrade with image ID: {avail_ver["id"]}: ', end='')
 
-                    code, msg = self.api.post('/monitor/system/firmware/upgrade', vdom='root', source='fortiguard',
-                                              filename=avail_ver["id"])
+            # The FG looks the image up with FortiGuard before answering, so the request gets at least API_TIMEOUT
+            code, msg = self._api_call('post', '/monitor/system/firmware/upgrade', idempotent=False,
+                                       minimum=FortiGateApiUtils.API_TIMEOUT, vdom='root', source='fortiguard',
+                                       filename=avail_ver["id"])
 
-                    if msg['results']['status'] == 'success':
-                        return True, msg
-                    else:
-                        return False, f'Upgrade request for image id {avail_ver["id"]} failed {msg}'
-                else:
-                    return False, f'No image found for {img_ver_rev} for this device'
+            if msg['results']['status'] == 'success':
+                return True, msg
+            else:
+                return False, f'Upgrade request for image id {avail_ver["id"]} failed {msg}'
         else:
-            # Read image file, base64 encode it then convert to string
+            image_file = img_ver_rev
+            if firmware_repo is not None:
+                # img_ver_rev is a version, the image for this FG's platform comes from the firmware repository
+                platform, version = self.get_platform_version()
+                if version.lstrip('v') == img_ver_rev:
+                    return True, f"Version requested {img_ver_rev} is same as current version, skipping"
+                repo_image = firmware_repo.select(platform, parse_version(img_ver_rev))
+                if repo_image is None:
+                    return False, f'No image for {img_ver_rev} for platform {platform} in {firmware_repo.repo_dir}'
+                image_file = repo_image['path']
+
+            # Image file is read and base64 encoded once per run, then shared by every device's upload
             try:
-                img64 = file_to_b64(img_ver_rev)
-            except Exception as e:
+                image = shared_encoded_file(image_file)
+            except OSError as e:
                 print('Unable to either read image  file or convert it to base64')
-                sys.exit()
+                return False, f'Unable to either read image file or convert it to base64: {e}'
+            if firmware_repo is not None and image.sha256 != repo_image['sha256']:
+                return False, f'Image {image_file} does not match its sha256 in the firmware index, not uploaded'
 
             # Upgrade firmware image
-            print(f'  Sending image {image_source} to {self.device["name"]}: ', end='')
+            print(f'  Sending image {os.path.basename(image_file)} to {self.device["name"]}: ', end='')
 
-            self.api.timeout = 600
-            code, msg = self.api.post('/monitor/system/firmware/upgrade', vdom='root', source='upload',
-                                          scope='global', ignore_invalid_sinature='true', file_content=img64)
-            # Set timeout back to standard
-            self.api.timeout = 30
-            # code, msg = json.loads(json_response.decode())
+            body = JsonUploadBody({'vdom': 'root', 'source': 'upload', 'scope': 'global',
+                                   'ignore_invalid_sinature': 'true'}, 'file_content', image)
+            # The FG checks the image before answering, so an upload gets at least UPLOAD_TIMEOUT
+            code, msg = self._post_upload('/monitor/system/firmware/upgrade', body,
+                                          minimum=FortiGateApiUtils.UPLOAD_TIMEOUT)
 
             return code, msg
 
@@ -153,12 +386,16 @@ class FortiGateApiUtils:
         if 'apikey' in self.device:
             # Check if API key is string
             if isinstance(self.device['apikey'], str):
-                # Convert config string to b64 (and remove whitespace)
-                b64_file = file_to_b64(config_file)
+                # Config is base64 encoded (without whitespace) a chunk at a time while it is uploaded
+                try:
+                    body = JsonUploadBody({'source': 'upload', 'scope': 'global'}, 'file_content',
+                                          StreamingB64File(config_file))
+                except OSError as e:
+                    return False, f'Unable to read config file {config_file}: {e}'
 
                 # Upload config to restore
-                code, msg = self.api.post('/monitor/system/config/restore', source='upload',
-                                          scope='global', file_content=b64_file)
+                code, msg = self._post_upload('/monitor/system/config/restore', body,
+                                              minimum=FortiGateApiUtils.API_TIMEOUT)
 
                 if code == 'success':
                     return True, msg
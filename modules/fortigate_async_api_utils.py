@@ -0,0 +1,421 @@
+from pyFGT.fortigate import FGTBaseException, FGTValueError, FGTConnectionError
+from modules.fortigate_api_utils import FortiGateApiUtils, parse_config_fingerprint, CONFIG_HEADER
+from modules.device_facts import DeviceFacts
+from modules.file_utils import AtomicFileWriter, read_first_line
+from modules.firmware_catalog import catalog, parse_version
+from modules.firmware_repo import FirmwareRepository
+from modules.instrumentation import recorder
+from modules.upload_utils import JsonUploadBody, StreamingB64File, shared_encoded_file
+import asyncio
+import json
+import os
+import time
+
+# aiohttp is only needed when the async api is selected (--async_api true)
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class FortiGateAsyncApiUtils:
+    """
+    asyncio counterpart to FortiGateApiUtils with the same methods and return values,
+    (login, logout, backup_to_file, upgrade_image, restore_config_from_file) each of which
+    must be awaited.
+
+    All instances share one aiohttp ClientSession, and so one connection pool, which is limited
+    to CONNECTION_LIMIT concurrent connections.  Open it once per run with open_session() and
+    close it with close_session() when finished.
+
+    Errors reaching the FG are raised as the same pyFGT exception types used by FortiGateApiUtils
+    so callers can handle both the same way.  Timeouts and retries follow the same per device
+    policy as FortiGateApiUtils (shared with it), GETs and backups are retried, other POSTs not.
+    """
+    # Class Constants
+    API_TIMEOUT = 30
+    UPLOAD_TIMEOUT = 600
+    CONNECTION_LIMIT = 100
+
+    # Shared aiohttp session for all instances
+    session = None
+
+    # class initializer
+    def __init__(self, device: dict = None, verbose: bool = True, debug: bool = True):
+        self.verbose = verbose
+        self.debug = debug
+        self.device = device
+        self.api_key_used = 'apikey' in device
+
+        if not self.api_key_used and 'password' not in device:
+            raise Exception('Neither "passwd" nor "apikey" were provided, must define one of these.')
+
+        proto = 'https' if device.get('use_ssl', True) else 'http'
+        self.base_url = f'{proto}://{device["ip"]}'
+        self.headers = {'content-type': 'application/json'}
+        if self.api_key_used:
+            self.headers['Authorization'] = f'Bearer {device["apikey"]}'
+        self.connected = False
+        self.policy = FortiGateApiUtils.policies.get((self.base_url, device.get('apikey') or device.get('login')),
+                                                     self.API_TIMEOUT, retries=FortiGateApiUtils.API_RETRIES,
+                                                     connect_timeout=FortiGateApiUtils.CONNECT_TIMEOUT)
+        # DeviceFacts from the status response, set by an apikey login or the first get_facts()
+        self.facts = None
+
+    # Stringify the class instance
+    def __str__(self):
+        # Return all instance variables as string
+        return str(vars(self))
+
+    @classmethod
+    async def open_session(cls, limit: int = None):
+        """ Create the shared session, limit is the max number of concurrent connections across all devices """
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for the async api, install it with "pip install aiohttp"')
+        if cls.session is None or cls.session.closed:
+            connector = aiohttp.TCPConnector(limit=limit or cls.CONNECTION_LIMIT, ssl=False)
+            # Session cookies are tracked per instance (per device) rather than in a shared jar
+            cls.session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+        return cls.session
+
+    @classmethod
+    async def close_session(cls):
+        if cls.session is not None and not cls.session.closed:
+            await cls.session.close()
+        cls.session = None
+
+    def _url(self, path: str):
+        if 'logincheck' in path or 'logout' in path:
+            return f'{self.base_url}/{path.lstrip("/")}'
+        return f'{self.base_url}/api/v2/{path.lstrip("/")}'
+
+    def _debug_print(self, method, url, code, msg):
+        if self.debug:
+            print('-' * 100 + '\n')
+            print(f'{method.upper()} REQUEST: {url}')
+            print(f'\nRESPONSE: {code}')
+            print(msg)
+            print('\n' + '-' * 100 + '\n')
+
+    async def _request(self, method: str, path: str, params: dict = None, data=None, json_body: dict = None,
+                       timeout: int = None, raw: bool = False, upload: JsonUploadBody = None,
+                       idempotent: bool = False, minimum: float = 0):
+        """
+        Send request to the FG and return (code, msg) the same way pyFGT does, code is the
+        "http_status" or "status" value of the json response.  If raw is True or the response is
+        not json, returns (100, bytes of the response body).  upload is sent a chunk at a time
+        as the request body instead of data/json_body.
+
+        Timeouts come from the device's policy (at least minimum), and the request is retried if
+        idempotent.  A timeout given by the caller is used as is, without retries.
+        """
+        if self.session is None:
+            raise FGTBaseException('No async session, call FortiGateAsyncApiUtils.open_session() first')
+
+        async def attempt(timeouts):
+            return await self._send(method, path, params, data, json_body, timeouts, raw, upload)
+
+        if timeout is not None:
+            return await attempt((timeout, timeout))
+        return await self.policy.call_async(attempt, idempotent=idempotent, minimum=minimum,
+                                            payload_bytes=len(upload) if upload is not None else 0)
+
+    async def _send(self, method: str, path: str, params: dict, data, json_body: dict, timeouts: tuple, raw: bool,
+                    upload: JsonUploadBody):
+        """ One attempt of _request, with (connect, total) timeouts """
+        url = self._url(path)
+        headers = self.headers
+        if json_body is not None:
+            data = json.dumps(json_body)
+        elif upload is not None:
+            # Known length, so sent with Content-Length rather than as a chunked body
+            data = upload.async_chunks()
+            headers = {**headers, 'Content-Length': str(len(upload))}
+        req_timeout = aiohttp.ClientTimeout(total=timeouts[1], sock_connect=timeouts[0])
+        with recorder.span(f'{method.upper()} {path.lstrip("/")}', self.device['name']) as span:
+            if upload is not None:
+                span.bytes_out = len(upload)
+            elif isinstance(data, (str, bytes)):
+                span.bytes_out = len(data)
+            try:
+                async with self.session.request(method, url, params=params, data=data, headers=headers,
+                                                timeout=req_timeout) as resp:
+                    if 'logincheck' in path:
+                        self._set_cookies(resp)
+                    body = await resp.read()
+                    status = resp.status
+            except asyncio.TimeoutError as e:
+                raise FGTConnectionError(f'Connection timeout: {url} {e}')
+            except aiohttp.ClientError as e:
+                raise FGTConnectionError(f'Connection error: {type(e)} {e}')
+            span.bytes_in = len(body)
+            span.status = status
+
+        if raw:
+            return 100, body
+        try:
+            response = json.loads(body)
+        except ValueError:
+            return 100, body
+        if not isinstance(response, dict):
+            raise FGTValueError(f'Unexpected response from {url}: {response}')
+
+        code = response.get('http_status', response.get('status', status))
+        self._debug_print(method, url, code, response)
+        return code, response
+
+    async def get(self, path: str, **kwargs):
+        return await self._request('get', path, idempotent=True, **kwargs)
+
+    async def post(self, path: str, **kwargs):
+        return await self._request('post', path, **kwargs)
+
+    def _set_cookies(self, resp):
+        """ Keep session cookie and csrf token from a password login """
+        cookies = []
+        for name, morsel in resp.cookies.items():
+            cookies.append(f'{name}={morsel.value}')
+            if name == 'ccsrftoken':
+                self.headers['X-CSRFTOKEN'] = morsel.value.strip('"')
+        if cookies:
+            self.headers['Cookie'] = '; '.join(cookies)
+
+    # API login to FG, facts from an earlier status check of the FG in this run (such as a pre-flight check)
+    # saves verifying the apikey with another one
+    async def login(self, facts: DeviceFacts = None):
+        with recorder.span('login', self.device['name']) as span:
+            r, msg = await self._login(facts)
+            span.status = 'ok' if r else 'failed'
+        return r, msg
+
+    async def _login(self, facts: DeviceFacts = None):
+        # With apikey there is no login, verify the apikey with a quick api get call instead
+        if self.api_key_used:
+            if self.verbose:
+                print('using apikey')
+            if facts is not None:
+                self.connected = True
+                self.facts = facts
+                return True, 'Connected'
+            debug, self.debug = self.debug, False
+            try:
+                code, msg = await self.get('monitor/system/status')
+            finally:
+                self.debug = debug
+            if code == 'success':
+                self.connected = True
+                self.facts = DeviceFacts(msg)
+                return True, 'Connected'
+            else:
+                return False, 'Likely, the apikey was not verified/authenticated by FG'
+        else:
+            data = {'username': self.device['login'], 'secretkey': self.device['password'], 'ajax': 1}
+            headers, self.headers = self.headers, {}
+            try:
+                code, body = await self._request('post', 'logincheck', data=data, raw=True)
+            finally:
+                # Keep cookie/csrf headers set by login, restore content-type
+                self.headers = {**headers, **self.headers}
+            if body[:1] == b'1':
+                self.connected = True
+                return True, 'Connected'
+            else:
+                return False, "Error logging in to FG (check IP, password, etc)"
+
+    # API logout from FG
+    async def logout(self):
+        self.connected = False
+        if self.api_key_used:
+            return True, 'Logged out'
+        try:
+            await self._request('post', 'logout', raw=True)
+        except (FGTBaseException, FGTConnectionError):
+            return False, 'Something failed, oh well, probably can ignore since is logout'
+        return True, 'Logged out'
+
+    # Cheap check of the current config state, used to skip backups of unchanged devices
+    async def get_config_fingerprint(self):
+        debug, self.debug = self.debug, False
+        try:
+            code, msg = await self.get('monitor/system/ha-checksums')
+        finally:
+            self.debug = debug
+        return parse_config_fingerprint(code, msg)
+
+    # Method to get FG instance backup and write it to backup_dir with timestamp and tag
+    async def backup_to_file(self, backup_dir, date: str = '', file_tag: str = ''):
+        if self.session is None:
+            raise FGTBaseException('No async session, call FortiGateAsyncApiUtils.open_session() first')
+        backup_file = f'{backup_dir}/{date}{self.device["name"]}{file_tag}.conf'
+
+        # Stream the config to a temp file in chunks, renamed to backup_file only once complete and valid
+        url = self._url('/monitor/system/config/backup')
+
+        async def attempt(timeouts):
+            with recorder.span('POST monitor/system/config/backup', self.device['name']) as span:
+                result, msg, bytes_written = await download(timeouts)
+                span.bytes_in = bytes_written
+                span.status = 'ok' if result else 'invalid'
+            if result:
+                self.policy.observe(time.perf_counter() - span.start, bytes_written)
+            return result, msg
+
+        async def download(timeouts):
+            # Time spent writing to disk, recorded apart from the download.  The file is written, synced and
+            # renamed in a thread (as the image encoding is), so disk I/O doesn't hold up the other devices
+            write_time = 0.0
+            writer = None
+            try:
+                # The read timeout applies to each read, as with requests in the pyFGT client, rather than to
+                # the whole download: a large config may take longer than that to send
+                async with self.session.post(url, params={'scope': 'global'}, headers=self.headers,
+                                             timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeouts[0],
+                                                                           sock_read=timeouts[1])) as resp:
+                    writer = await asyncio.to_thread(AtomicFileWriter, backup_file, expect_header=CONFIG_HEADER)
+                    async for chunk in resp.content.iter_chunked(FortiGateApiUtils.BACKUP_CHUNK_SIZE):
+                        start = time.perf_counter()
+                        await asyncio.to_thread(writer.write, chunk)
+                        write_time += time.perf_counter() - start
+                        # Very simple check for validity of returned file, done on the first chunk
+                        if writer.valid is False:
+                            return False, 'Backup file check, file may not be valid config', writer.bytes_written
+                    if not writer.valid:
+                        return False, 'Backup file check, file may not be valid config', writer.bytes_written
+                    start = time.perf_counter()
+                    await asyncio.to_thread(writer.commit)
+                    write_time += time.perf_counter() - start
+            except asyncio.TimeoutError as e:
+                raise FGTConnectionError(f'Connection timeout: {url} {e}')
+            except aiohttp.ClientError as e:
+                raise FGTConnectionError(f'Connection error: {type(e)} {e}')
+            except IOError as e:
+                return False, f'Error writing backup file: {e}', 0
+            finally:
+                # Remove the temp file of a download that did not complete
+                if writer is not None and not writer.committed:
+                    await asyncio.to_thread(writer.abort)
+            recorder.add('file write', self.device['name'], write_time, bytes_out=writer.bytes_written)
+            return True, backup_file, writer.bytes_written
+
+        # The FG builds the whole config before sending it, so a backup gets at least API_TIMEOUT
+        result, msg = await self.policy.call_async(attempt, minimum=self.API_TIMEOUT, observe=False)
+        if not result:
+            return result, msg
+
+        # The config header tells if the FG is in multi-vdom mode, which the status response doesn't
+        if self.facts is not None:
+            self.facts.update_from_header(await asyncio.to_thread(read_first_line, backup_file))
+        return True, backup_file
+
+    # Facts (version, model, serial, hostname, ...) of the FG, from the apikey login or else one status call
+    async def get_facts(self, refresh: bool = False):
+        if self.facts is None or refresh:
+            code, msg = await self.get('monitor/system/status')
+            if code != 'success':
+                raise FGTValueError(f'Unable to get system status: {msg}')
+            self.facts = DeviceFacts(msg)
+        return self.facts
+
+    # Platform (model, such as FGVM64) and current FOS version of the FG
+    async def get_platform_version(self):
+        facts = await self.get_facts()
+        return facts.model or self.device['name'], facts.version
+
+    # Images available from FortiGuard for platform, indexed by (major, minor, patch), see FortiGateApiUtils
+    async def available_firmware(self, platform: str):
+        async def fetch():
+            code, msg = await self.get('/monitor/system/firmware')
+            if code != 'success':
+                raise FGTValueError(f'Unable to get available firmware: {msg}')
+            return msg['results']['available']
+
+        return await catalog.lookup_async(platform, fetch)
+
+    # Pre-flight check of a FortiGuard upgrade, returns (platform, current version, image entry or None)
+    async def firmware_preflight(self, img_ver_rev: str):
+        platform, version = await self.get_platform_version()
+        return platform, version, (await self.available_firmware(platform)).get(parse_version(img_ver_rev))
+
+    # Method to execute upgrade of fgt instance
+    async def upgrade_image(self, image_source: str = 'fortiguard', img_ver_rev: str = None,
+                            firmware_repo: FirmwareRepository = None):
+        if not img_ver_rev:
+            raise Exception('var "img_ver_rev" is required by was not supplied')
+
+        if image_source == 'fortiguard':
+            if self.verbose:
+                print(f'<<< Starting upgrade from FortiGuard >>>')
+
+            # Check if current version is same as requested version and exit if so
+            platform, version = await self.get_platform_version()
+            if version.lstrip('v') == img_ver_rev:
+                return True, f"Version requested {img_ver_rev} is same as current version, skipping"
+
+            # Identify if requested version is available on this device through fortiguard
+            avail_ver = (await self.available_firmware(platform)).get(parse_version(img_ver_rev))
+            if avail_ver is None:
+                return False, f'No image found for {img_ver_rev} for this device'
+
+            if self.verbose:
+                print(f'  Found available image {avail_ver["version"]} with ID: {avail_ver["id"]}')
+                print(f'  Initiating upgrade with image ID: {avail_ver["id"]}: ', end='')
+
+            # The FG looks the image up with FortiGuard before answering, so the request gets at least API_TIMEOUT
+            code, msg = await self.post('/monitor/system/firmware/upgrade',
+                                        json_body={'vdom': 'root', 'source': 'fortiguard',
+                                                   'filename': avail_ver['id']}, minimum=self.API_TIMEOUT)
+
+            if msg['results']['status'] == 'success':
+                return True, msg
+            else:
+                return False, f'Upgrade request for image id {avail_ver["id"]} failed {msg}'
+        else:
+            image_file = img_ver_rev
+            if firmware_repo is not None:
+                # img_ver_rev is a version, the image for this FG's platform comes from the firmware repository
+                platform, version = await self.get_platform_version()
+                if version.lstrip('v') == img_ver_rev:
+                    return True, f"Version requested {img_ver_rev} is same as current version, skipping"
+                repo_image = firmware_repo.select(platform, parse_version(img_ver_rev))
+                if repo_image is None:
+                    return False, f'No image for {img_ver_rev} for platform {platform} in {firmware_repo.repo_dir}'
+                image_file = repo_image['path']
+
+            # Image file is base64 encoded once per run (in a thread, this is cpu/disk bound) and shared
+            # by every device's upload
+            try:
+                image = await asyncio.to_thread(shared_encoded_file, image_file)
+            except OSError as e:
+                return False, f'Unable to either read image file or convert it to base64: {e}'
+            if firmware_repo is not None and image.sha256 != repo_image['sha256']:
+                return False, f'Image {image_file} does not match its sha256 in the firmware index, not uploaded'
+
+            # Upgrade firmware image
+            print(f'  Sending image {os.path.basename(image_file)} to {self.device["name"]}: ', end='')
+            body = JsonUploadBody({'vdom': 'root', 'source': 'upload', 'scope': 'global',
+                                   'ignore_invalid_sinature': 'true'}, 'file_content', image)
+            # The FG checks the image before answering, so an upload gets at least UPLOAD_TIMEOUT
+            code, msg = await self.post('/monitor/system/firmware/upgrade', upload=body, minimum=self.UPLOAD_TIMEOUT)
+            return code, msg
+
+    #  Upload config for restore
+    async def restore_config_from_file(self, config_file: str):
+        # FG API does not allow to restore using standard admin user with password, must use api user
+        if 'apikey' in self.device and isinstance(self.device['apikey'], str):
+            # Config is base64 encoded (without whitespace) a chunk at a time while it is uploaded
+            try:
+                body = JsonUploadBody({'source': 'upload', 'scope': 'global'}, 'file_content',
+                                      StreamingB64File(config_file))
+            except OSError as e:
+                return False, f'Unable to read config file {config_file}: {e}'
+
+            # Upload config to restore, the FG checks the config before answering so it gets at least API_TIMEOUT
+            code, msg = await self.post('/monitor/system/config/restore', upload=body, minimum=self.API_TIMEOUT)
+
+            if code == 'success':
+                return True, msg
+            else:
+                return False, msg
+
+        # If apikey not provided or is not string will fall to this
+        return False, 'Must use apikey to restore config file'
@@ -0,0 +1,80 @@
+import re
+import time
+
+# Text the FG prints when a cli command is rejected
+FAILURE_MARKERS = ('Command fail', 'Unknown action', 'entry not found', 'value parse error')
+MORE_PROMPT = '--More-- '
+
+
+class FortiOSShell:
+    """
+    One interactive cli session on an SSH channel of a FG (paramiko SSHClient already connected).
+
+    Commands are sent down the one channel and their output is told apart by the cli prompt
+    ("<hostname> # ", or "<hostname> (<context>) # " inside config/edit) that follows each of them,
+    rather than by line positions, which differ between no-vdom and multi-vdom devices.  Sending a
+    batch of commands in one write (see run) takes a single round trip instead of a channel, and a
+    "config global", per command.
+    """
+    def __init__(self, client, timeout: float = 30):
+        self.timeout = timeout
+        self.channel = client.invoke_shell(width=512, height=0)
+        self.channel.settimeout(timeout)
+        # Until the first prompt is seen the hostname is unknown, any "<word> # " will do
+        self.prompt_re = re.compile(r'(?m)^\S+ (?:\(\S+\) )?[#$] ')
+        banner = self._read_prompts(1)
+        hostname = banner.rstrip().rsplit('\n', 1)[-1].split(' ', 1)[0]
+        self.prompt_re = re.compile(rf'(?m)^{re.escape(hostname)} (?:\(\S+\) )?[#$] ')
+
+    def _read_prompts(self, count: int):
+        """
+        Read from the channel until count prompts were received, returns everything read.  Each
+        command (prompt) gets timeout seconds, rather than the whole batch.
+        """
+        deadline = time.monotonic() + self.timeout
+        buffer = ''
+        seen = 0
+        while seen < count:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'No cli prompt within {self.timeout}s, received: {buffer[-200:]!r}')
+            data = self.channel.recv(65536)
+            if not data:
+                raise EOFError(f'SSH channel closed, received: {buffer[-200:]!r}')
+            buffer += data.decode(errors='replace').replace('\r', '')
+            # Paged output, ask for the rest
+            if buffer.endswith(MORE_PROMPT):
+                buffer = buffer[:-len(MORE_PROMPT)]
+                self.channel.sendall(b' ')
+            prompts = len(self.prompt_re.findall(buffer))
+            if prompts > seen:
+                seen = prompts
+                deadline = time.monotonic() + self.timeout
+        return buffer
+
+    def run(self, commands: list):
+        """
+        Send commands in one write and wait for the prompt after the last one, returns list of
+        (command, output) with the echoed command and the prompts removed.
+        """
+        commands = [command.strip() for command in commands if command.strip()]
+        if not commands:
+            return []
+        self.channel.sendall(('\n'.join(commands) + '\n').encode())
+        buffer = self._read_prompts(len(commands))
+        results = []
+        # Each part is the echo of a command followed by its output, up to the prompt after it
+        for command, part in zip(commands, self.prompt_re.split(buffer)):
+            results.append((command, part.split('\n', 1)[1] if '\n' in part else ''))
+        return results
+
+    @staticmethod
+    def failed(output: str):
+        """ True if output shows that its command was rejected """
+        return any(marker in output for marker in FAILURE_MARKERS)
+
+    def close(self):
+        try:
+            self.channel.sendall(b'exit\n')
+        except OSError:
+            pass
+        self.channel.close()
@@ -0,0 +1,322 @@
+from array import array
+import mmap
+import os
+
+# Node kinds
+ROOT = 0
+CONFIG = 1
+EDIT = 2
+SET = 3
+UNSET = 4
+KIND_NAMES = {ROOT: 'root', CONFIG: 'config', EDIT: 'edit', SET: 'set', UNSET: 'unset'}
+
+
+def unquote(name: str):
+    """ Remove the double quotes FortiOS puts around edit names and string values """
+    if len(name) >= 2 and name[0] == '"' and name[-1] == '"':
+        return name[1:-1].replace('\\"', '"')
+    return name
+
+
+def _open_quote(value: bytes):
+    """ True if value has an unterminated double quoted string (a value continuing on the next line) """
+    return (value.count(b'"') - value.count(b'\\"')) % 2 == 1
+
+
+class FortiOSConfig:
+    """
+    Streaming parser for FortiOS config files (config/edit/set/unset/next/end syntax).
+
+    The file is memory mapped and parsed one line at a time into a compact tree held in
+    parallel arrays, one entry per config/edit/set/unset line:
+      kind, parent, name (id into an interned name table), first_child/next_sibling links
+      and value_offset/value_length, the location of a set value in the mapped file.
+    Set values are never copied out of the file during parsing, they are only decoded when
+    asked for, so a large multi-VDOM config costs a few tens of bytes per line instead of a
+    Python dict of strings.
+
+    Config and edit nodes are indexed by (parent, name) so paths resolve without scanning.
+    Paths are the names of each level joined with "/", such as:
+      system interface/port1/ip
+      vdom/root/firewall policy/12/srcintf
+      global/system global/hostname
+    Repeated blocks (multi-VDOM configs open "config vdom" / "edit root" more than once)
+    are merged into the same node.  Lines starting with "#" before the first config line
+    are kept in header.
+    """
+    def __init__(self, config_file: str):
+        self.config_file = config_file
+        self.header = []
+
+        # Interned names, node name arrays hold an index into names
+        self.names = []
+        self._name_ids = {}
+
+        self.kind = array('b')
+        self.parent = array('i')
+        self.name = array('i')
+        self.first_child = array('i')
+        self.last_child = array('i')
+        self.next_sibling = array('i')
+        self.value_offset = array('q')
+        self.value_length = array('i')
+        self._child_index = {}
+
+        self._file = open(config_file, 'rb')
+        if os.fstat(self._file.fileno()).st_size:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mm = None
+
+        self._add_node(-1, ROOT, '', 0, 0)
+        if self._mm is not None:
+            self._parse()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.kind)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+    def _intern(self, name: str):
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.names.append(name)
+            self._name_ids[name] = name_id
+        return name_id
+
+    def _add_node(self, parent: int, kind: int, name: str, value_offset: int, value_length: int):
+        node = len(self.kind)
+        self.kind.append(kind)
+        self.parent.append(parent)
+        self.name.append(self._intern(name))
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+        self.value_offset.append(value_offset)
+        self.value_length.append(value_length)
+        if parent >= 0:
+            if self.last_child[parent] < 0:
+                self.first_child[parent] = node
+            else:
+                self.next_sibling[self.last_child[parent]] = node
+            self.last_child[parent] = node
+        return node
+
+    def _container(self, parent: int, kind: int, name: str, line_offset: int):
+        """ Get or create the config/edit node name under parent """
+        key = (parent, self._intern(name))
+        node = self._child_index.get(key)
+        if node is None:
+            node = self._add_node(parent, kind, name, line_offset, 0)
+            self._child_index[key] = node
+        return node
+
+    def _parse(self):
+        mm = self._mm
+        readline = mm.readline
+        kind = self.kind
+        first_child = self.first_child
+        last_child = self.last_child
+        next_sibling = self.next_sibling
+        container = self._container
+        intern = self._intern
+        # Set nodes are appended inline here rather than via _add_node, they are most of the lines
+        kind_append = kind.append
+        parent_append = self.parent.append
+        name_append = self.name.append
+        first_child_append = first_child.append
+        last_child_append = last_child.append
+        next_sibling_append = next_sibling.append
+        value_offset_append = self.value_offset.append
+        value_length_append = self.value_length.append
+        key_ids = {}
+        stack = [0]
+        in_header = True
+        offset = 0
+
+        while True:
+            raw = readline()
+            if not raw:
+                break
+            line_offset = offset
+            offset += len(raw)
+            line = raw.lstrip()
+            indent = len(raw) - len(line)
+            line = line.rstrip()
+            if not line:
+                continue
+            if line[0] == 35:  # "#"
+                if in_header:
+                    self.header.append(line.decode('utf-8', 'replace'))
+                continue
+            in_header = False
+
+            word, _, rest = line.partition(b' ')
+            if word == b'set':
+                key, _, value = rest.partition(b' ')
+                value_offset = line_offset + indent + 5 + len(key)
+                value_length = len(value)
+                if b'"' in value and _open_quote(value):
+                    # Quoted value spanning multiple lines (scripts, certificates, etc)
+                    while True:
+                        more = readline()
+                        if not more:
+                            break
+                        offset += len(more)
+                        value += more
+                        if not _open_quote(value):
+                            break
+                    value_length = offset - value_offset - (len(more) - len(more.rstrip()))
+
+                key_id = key_ids.get(key)
+                if key_id is None:
+                    key_id = key_ids[key] = intern(key.decode('utf-8', 'replace'))
+                parent = stack[-1]
+                node = len(kind)
+                kind_append(SET)
+                parent_append(parent)
+                name_append(key_id)
+                first_child_append(-1)
+                last_child_append(-1)
+                next_sibling_append(-1)
+                value_offset_append(value_offset)
+                value_length_append(value_length)
+                if last_child[parent] < 0:
+                    first_child[parent] = node
+                else:
+                    next_sibling[last_child[parent]] = node
+                last_child[parent] = node
+            elif word == b'edit':
+                stack.append(container(stack[-1], EDIT, unquote(rest.decode('utf-8', 'replace')), line_offset))
+            elif word == b'config':
+                stack.append(container(stack[-1], CONFIG, rest.decode('utf-8', 'replace'), line_offset))
+            elif word == b'next':
+                if kind[stack[-1]] == EDIT:
+                    stack.pop()
+            elif word == b'end':
+                # Tolerate a missing "next" before "end"
+                if kind[stack[-1]] == EDIT:
+                    stack.pop()
+                if len(stack) > 1:
+                    stack.pop()
+            elif word == b'unset':
+                self._add_node(stack[-1], UNSET, rest.decode('utf-8', 'replace'), 0, 0)
+
+    # Tree access
+    def children(self, node: int = 0):
+        """ Iterate child node ids of node """
+        child = self.first_child[node]
+        next_sibling = self.next_sibling
+        while child >= 0:
+            yield child
+            child = next_sibling[child]
+
+    def node_name(self, node: int):
+        return self.names[self.name[node]]
+
+    def node_kind(self, node: int):
+        return KIND_NAMES[self.kind[node]]
+
+    def node_value(self, node: int):
+        """ Raw value of a set node as in the file (quotes included), None for other nodes """
+        if self.kind[node] != SET:
+            return None
+        offset = self.value_offset[node]
+        return self._mm[offset:offset + self.value_length[node]].decode('utf-8', 'replace')
+
+    def node_path(self, node: int):
+        """ Tuple of names from the top of the config down to node """
+        path = []
+        while node > 0:
+            path.append(self.names[self.name[node]])
+            node = self.parent[node]
+        return tuple(reversed(path))
+
+    def _child(self, node: int, name: str):
+        """ Child of node called name, config/edit children via the index, set/unset by scanning """
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            return None
+        child = self._child_index.get((node, name_id))
+        if child is not None:
+            return child
+        for child in self.children(node):
+            if self.name[child] == name_id:
+                return child
+        return None
+
+    def find(self, path):
+        """
+        Node id for path, or None if not found.  path is either a tuple/list of names or a
+        "/" separated string.  With a string, names which themselves contain "/" (such as
+        address objects "10.0.0.0/8") are still found, the longest matching name is used.
+        """
+        if isinstance(path, str):
+            parts = [p for p in path.split('/') if p]
+            return self._find_parts(0, parts, 0)
+        node = 0
+        for name in path:
+            node = self._child(node, name)
+            if node is None:
+                return None
+        return node
+
+    def _find_parts(self, node: int, parts: list, i: int):
+        if i == len(parts):
+            return node
+        for j in range(len(parts), i, -1):
+            child = self._child(node, '/'.join(parts[i:j]))
+            if child is not None:
+                found = self._find_parts(child, parts, j)
+                if found is not None:
+                    return found
+        return None
+
+    def get(self, path, default=None):
+        """ Value of the set at path with quotes removed (such as "system interface/port1/ip") """
+        node = self.find(path)
+        if node is None or self.kind[node] != SET:
+            return default
+        return unquote(self.node_value(node))
+
+    def iter_nodes(self, node: int = 0):
+        """ Iterate (node id, path tuple) depth first for every node below node """
+        stack = [(node, self.node_path(node))]
+        while stack:
+            parent, parent_path = stack.pop()
+            kids = list(self.children(parent))
+            for child in reversed(kids):
+                stack.append((child, parent_path + (self.names[self.name[child]],)))
+            if parent != node:
+                yield parent, parent_path
+
+    def iter_sets(self, node: int = 0):
+        """ Iterate (path tuple, raw value) for every set below node, unset lines give a value of None """
+        kind = self.kind
+        for child, path in self.iter_nodes(node):
+            if kind[child] == SET:
+                yield path, self.node_value(child)
+            elif kind[child] == UNSET:
+                yield path, None
+
+    def sections(self):
+        """ Names of the top level config sections (and "global"/"vdom" in multi-VDOM configs) """
+        return [self.node_name(child) for child in self.children(0)]
+
+    def vdoms(self):
+        """ Names of the VDOMs in a multi-VDOM config, [] for a config without VDOMs """
+        node = self._child(0, 'vdom')
+        if node is None:
+            return []
+        return [self.node_name(child) for child in self.children(node)]
@@ -0,0 +1,181 @@
+from modules.file_utils import AtomicFileWriter
+from contextlib import contextmanager
+import atexit
+import datetime
+import json
+import math
+import threading
+import time
+
+# Quantiles of the call durations in the Prometheus summary
+QUANTILES = (0.5, 0.9, 0.99)
+METRIC_PREFIX = 'fgt_operation'
+
+
+class Span:
+    """ One timed operation, the caller fills in status and bytes in/out as they become known """
+    __slots__ = ('operation', 'device', 'status', 'bytes_in', 'bytes_out', 'start_time', 'start')
+
+    def __init__(self, operation: str, device: str = None):
+        self.operation = operation
+        self.device = device
+        self.status = 'ok'
+        self.bytes_in = None
+        self.bytes_out = None
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+
+
+class Recorder:
+    """
+    Records the duration, bytes in/out and status of every api call and file operation of a run,
+    and hands each record to the exporters.  With no exporter added nothing is recorded.
+
+    A record is a dict of time (start, iso format), operation (such as "GET monitor/system/status"
+    or "file write"), device, duration (seconds), bytes_in, bytes_out (None when not known) and
+    status (the api status code, "ok", or the name of the exception raised).
+    """
+    def __init__(self):
+        self.exporters = []
+        self.records = []
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.exporters)
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    @contextmanager
+    def span(self, operation: str, device: str = None):
+        """ Time the with block as operation, an exception leaving it is recorded as the status """
+        span = Span(operation, device)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = type(e).__name__
+            raise
+        finally:
+            if self.exporters:
+                self.add(span.operation, span.device, time.perf_counter() - span.start, bytes_in=span.bytes_in,
+                         bytes_out=span.bytes_out, status=span.status, start_time=span.start_time)
+
+    def add(self, operation: str, device: str, duration: float, bytes_in: int = None, bytes_out: int = None,
+            status='ok', start_time: float = None):
+        """ Record an operation timed by the caller, such as the disk writes spread over a download """
+        if not self.exporters:
+            return
+        start_time = time.time() - duration if start_time is None else start_time
+        record = {'time': datetime.datetime.fromtimestamp(start_time).isoformat(timespec='milliseconds'),
+                  'operation': operation, 'device': device, 'duration': round(duration, 6),
+                  'bytes_in': bytes_in, 'bytes_out': bytes_out, 'status': status}
+        with self.lock:
+            self.records.append(record)
+            for exporter in self.exporters:
+                exporter.export(record)
+
+    def close(self):
+        """ Let the exporters write out what they hold, called once at the end of the run """
+        with self.lock:
+            exporters, self.exporters = self.exporters, []
+            records, self.records = self.records, []
+        for exporter in exporters:
+            exporter.close(records)
+
+
+class JsonLinesExporter:
+    """ Appends each record to path as one json line, as it is recorded """
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'a')
+
+    def export(self, record: dict):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self, records: list):
+        self.file.close()
+
+
+def quantile(sorted_values: list, q: float):
+    """ Nearest rank quantile of a sorted list """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(max(math.ceil(q * len(sorted_values)) - 1, 0), len(sorted_values) - 1)]
+
+
+def is_error(status):
+    """ False for "ok", the api's "success" and http codes below 400, True for anything else """
+    if isinstance(status, int):
+        return status >= 400
+    return status not in ('ok', 'success')
+
+
+class PrometheusTextfileExporter:
+    """
+    Writes a summary per operation (duration quantiles, count, sum, bytes in/out and errors) to path
+    at the end of the run, in the Prometheus text format read by the node_exporter textfile collector.
+    The file is replaced atomically, so the collector never reads a partly written file.
+    """
+    def __init__(self, path: str, script: str = None):
+        self.path = path
+        self.script = script
+
+    def export(self, record: dict):
+        pass
+
+    def _labels(self, operation: str, **extra):
+        labels = {'operation': operation, **extra}
+        if self.script:
+            labels = {'script': self.script, **labels}
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+    def close(self, records: list):
+        operations = {}
+        for record in records:
+            operations.setdefault(record['operation'], []).append(record)
+
+        lines = [f'# HELP {METRIC_PREFIX}_duration_seconds Duration of api calls and file operations',
+                 f'# TYPE {METRIC_PREFIX}_duration_seconds summary']
+        for operation, op_records in sorted(operations.items()):
+            durations = sorted(r['duration'] for r in op_records)
+            for q in QUANTILES:
+                lines.append(f'{METRIC_PREFIX}_duration_seconds{self._labels(operation, quantile=q)} '
+                             f'{quantile(durations, q):.6f}')
+            lines.append(f'{METRIC_PREFIX}_duration_seconds_sum{self._labels(operation)} {sum(durations):.6f}')
+            lines.append(f'{METRIC_PREFIX}_duration_seconds_count{self._labels(operation)} {len(durations)}')
+
+        for key, help_text in (('bytes_in', 'Bytes received or read'), ('bytes_out', 'Bytes sent or written')):
+            lines.append(f'# HELP {METRIC_PREFIX}_{key}_total {help_text}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{key}_total counter')
+            for operation, op_records in sorted(operations.items()):
+                lines.append(f'{METRIC_PREFIX}_{key}_total{self._labels(operation)} '
+                             f'{sum(r[key] or 0 for r in op_records)}')
+
+        lines.append(f'# HELP {METRIC_PREFIX}_errors_total Operations which raised an error or got an error status')
+        lines.append(f'# TYPE {METRIC_PREFIX}_errors_total counter')
+        for operation, op_records in sorted(operations.items()):
+            errors = sum(1 for r in op_records if is_error(r['status']))
+            lines.append(f'{METRIC_PREFIX}_errors_total{self._labels(operation)} {errors}')
+
+        try:
+            with AtomicFileWriter(self.path) as writer:
+                writer.write(('\n'.join(lines) + '\n').encode())
+                writer.commit()
+        except OSError as e:
+            print(f'Warning, unable to write metrics file {self.path}: {e}')
+
+
+def configure(trace_file: str = None, metrics_file: str = None, script: str = None):
+    """ Add the exporters for --trace_file/--metrics_file, written out when the script exits """
+    if trace_file:
+        recorder.add_exporter(JsonLinesExporter(trace_file))
+    if metrics_file:
+        recorder.add_exporter(PrometheusTextfileExporter(metrics_file, script=script))
+    if recorder.enabled:
+        atexit.register(recorder.close)
+
+
+# Shared by every device (thread or task) of a run
+recorder = Recorder()
@@ -0,0 +1,128 @@
+from modules.file_utils import AtomicFileWriter
+import marshal
+import os
+import yaml
+
+# The C (libyaml) loader is many times faster on large device files, fall back to pure python without it
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Bump when the cached data changes meaning, older caches are then ignored
+CACHE_VERSION = 1
+
+
+def cache_file_for(device_file: str):
+    """ Cache of a parsed device file, a hidden file next to it """
+    return os.path.join(os.path.dirname(device_file), f'.{os.path.basename(device_file)}.cache')
+
+
+class DeviceRecord:
+    """
+    One valid device under "fortigates" of a device file, name is its key there.  file_name is the name
+    its backups are saved under, the entry's own "name" if it has one.
+    """
+    __slots__ = ('name', 'file_name', 'ip', 'login', 'password', 'apikey', 'use_ssl', 'ssh_port')
+
+    def __init__(self, name, entry: dict):
+        """ Raises ValueError if entry is not a valid device """
+        if not isinstance(entry, dict):
+            raise ValueError('not a mapping of device attributes')
+        if not isinstance(entry.get('ip'), str) or not entry['ip']:
+            raise ValueError('"ip" missing or not a string')
+        for key in ('login', 'password', 'apikey', 'name'):
+            if entry.get(key) is not None and not isinstance(entry[key], (str, int)):
+                raise ValueError(f'"{key}" is not a string')
+        if not isinstance(entry.get('use_ssl', True), bool):
+            raise ValueError('"use_ssl" is not true/false')
+        ssh_port = entry.get('ssh_port', 22)
+        if isinstance(ssh_port, bool) or not isinstance(ssh_port, int) or not 0 < ssh_port < 65536:
+            raise ValueError('"ssh_port" is not a port number')
+        self.name = str(name)
+        self.file_name = str(entry.get('name') or name)
+        self.ip = entry['ip']
+        # yaml reads an all digit password as a number
+        self.login = None if entry.get('login') is None else str(entry['login'])
+        self.password = None if entry.get('password') is None else str(entry['password'])
+        self.apikey = None if entry.get('apikey') is None else str(entry['apikey'])
+        self.use_ssl = entry.get('use_ssl', True)
+        self.ssh_port = ssh_port
+
+    def as_device(self):
+        """ The device dict the api clients (FortiGateApiUtils, FortiGateAsyncApiUtils) take """
+        device = {'name': self.name, 'ip': self.ip, 'use_ssl': self.use_ssl}
+        for key in ('login', 'password', 'apikey'):
+            if getattr(self, key) is not None:
+                device[key] = getattr(self, key)
+        return device
+
+
+class Inventory:
+    """
+    A loaded device file.  devices is the DeviceRecord of each valid device, in file order, invalid is
+    the reason for each device that is not valid (left out of devices).  data is the file as a dict,
+    for the settings outside "fortigates" and for writing the file back.
+    """
+    def __init__(self, data: dict):
+        """ Raises ValueError if data has no devices at all """
+        if not isinstance(data, dict) or not isinstance(data.get('fortigates'), dict):
+            raise ValueError('no "fortigates" mapping of devices')
+        self.data = data
+        self.devices = {}
+        self.invalid = {}
+        for name, entry in data['fortigates'].items():
+            try:
+                self.devices[name] = DeviceRecord(name, entry)
+            except ValueError as e:
+                self.invalid[name] = str(e)
+
+    def set_apikey(self, name, apikey: str):
+        """ Set the apikey of device name, in its record and in data """
+        self.devices[name].apikey = apikey
+        self.data['fortigates'][name]['apikey'] = apikey
+
+
+def _cache_key(device_file: str, stat: os.stat_result):
+    return CACHE_VERSION, os.path.abspath(device_file), stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def _read_cache(cache_file: str, key: tuple):
+    """ Data from cache_file if it was made from the same device file (key), otherwise None """
+    try:
+        # One read and loads, marshal.load on a file object is several times slower
+        with open(cache_file, 'rb') as f:
+            cached_key, data = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return data if cached_key == key else None
+
+
+def _write_cache(cache_file: str, key: tuple, data: dict):
+    """ Best effort, a device file marshal can't store (such as one with dates) or a read only directory is not cached """
+    try:
+        content = marshal.dumps((key, data))
+        # Owner only, the device file holds passwords and api keys
+        with AtomicFileWriter(cache_file, mode=0o600) as writer:
+            writer.write(content)
+            writer.commit()
+    except (OSError, ValueError):
+        pass
+
+
+def load_inventory(device_file: str, cache: bool = True):
+    """
+    Load device_file into an Inventory.  The parsed file is cached (see cache_file_for) and reused as long
+    as the device file's path, modification time and size are unchanged, so only the first run after a
+    change pays for parsing the yaml.  Raises OSError, yaml.YAMLError or ValueError (not a device file).
+    """
+    stat = os.stat(device_file)
+    key = _cache_key(device_file, stat)
+    cache_file = cache_file_for(device_file)
+    data = _read_cache(cache_file, key) if cache else None
+    if data is not None:
+        return Inventory(data)
+
+    with open(device_file, 'rb') as f:
+        data = yaml.load(f, Loader=SafeLoader)
+    inventory = Inventory(data)
+    if cache:
+        _write_cache(cache_file, key, data)
+    return inventory
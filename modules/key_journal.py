@@ -0,0 +1,76 @@
+import datetime
+import json
+import os
+import threading
+
+
+def journal_file_for(device_file: str):
+    """ Default key journal of a device file, a hidden file next to it """
+    return os.path.join(os.path.dirname(device_file), f'.{os.path.basename(device_file)}.keygen.jsonl')
+
+
+class KeyJournal:
+    """
+    Append only journal of the api key each device ended up with in a fg_api_key_gen.py run, one
+    json line per device, written and synced to disk as soon as the key is known.
+
+    A FG only accepts its new key once it is generated, so a run that dies before the device file
+    is written must not lose the keys it got so far: the next run replays the journal into the
+    device file.  The journal is removed once a device file holding all of its keys is written.
+    A line cut short by a crash is ignored.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def replay(self):
+        """ dict of device name -> its last record in the journal, {} if there is no journal """
+        records = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        records[record['device']] = record
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _open(self):
+        # Owner only, the journal holds api keys
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.file = os.fdopen(fd, 'a')
+        # Start on a new line if the last run died part way through writing one
+        if os.fstat(fd).st_size:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write('\n')
+
+    def append(self, device: str, apikey: str, status: str):
+        """ Record apikey of device (status "generated" or "kept") and sync it to disk before returning """
+        line = json.dumps({'time': datetime.datetime.now().isoformat(timespec='seconds'), 'device': device,
+                           'apikey': apikey, 'status': status}) + '\n'
+        with self.lock:
+            if self.file is None:
+                self._open()
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def remove(self):
+        """ Delete the journal, once its keys are safely in the device file """
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,191 @@
+import asyncio
+import contextvars
+import functools
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class ThreadOutputRouter:
+    """
+    Stand-in for sys.stdout.  Threads (or asyncio tasks) that have started a
+    capture get their output collected into their own buffer, everything else
+    is passed straight through to the real stdout.  This lets each device
+    worker print exactly like the sequential code did while keeping lines from
+    different devices from interleaving on the console.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        # A context variable is private to each thread and to each asyncio task
+        self._buffer = contextvars.ContextVar('output_buffer', default=None)
+        self.lock = threading.Lock()
+
+    def start_capture(self):
+        self._buffer.set([])
+
+    def stop_capture(self):
+        buffer = self._buffer.get()
+        self._buffer.set(None)
+        return ''.join(buffer) if buffer else ''
+
+    def write(self, text):
+        buffer = self._buffer.get()
+        if buffer is None:
+            return self.stream.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        if self._buffer.get() is None:
+            self.stream.flush()
+
+    def emit(self, text):
+        """ Write a block of text to the real stdout without interleaving with other threads """
+        with self.lock:
+            self.stream.write(text)
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def _install_router():
+    """ Install a ThreadOutputRouter as sys.stdout (once) and return it """
+    if not isinstance(sys.stdout, ThreadOutputRouter):
+        sys.stdout = ThreadOutputRouter(sys.stdout)
+    return sys.stdout
+
+
+def run_parallel(func, items: list, workers: int = 1):
+    """
+    Run func(item) for each entry in items using a pool of "workers" threads.
+
+    Output printed by each call is buffered and written to stdout as one block
+    when that call completes, so per-device output stays readable.  Results are
+    returned as a list of (result, elapsed_seconds) in the same order as items,
+    regardless of the order in which the calls complete.  An exception raised by
+    func is returned as the result tuple (False, 'Unhandled error: ...') so one bad
+    device cannot take down the rest of the run.
+
+    With workers <= 1 calls are run inline, in order, with live output (same as
+    the original sequential scripts).
+    """
+    def timed_call(item):
+        start = time.monotonic()
+        try:
+            result = func(item)
+        except Exception as e:
+            print(f'Unhandled error: {e}')
+            result = (False, f'Unhandled error: {e}')
+        return result, time.monotonic() - start
+
+    if workers <= 1 or len(items) <= 1:
+        return [timed_call(item) for item in items]
+
+    router = _install_router()
+
+    def captured_call(item):
+        router.start_capture()
+        try:
+            return timed_call(item)
+        finally:
+            router.emit(router.stop_capture())
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # executor.map yields results in submission (inventory) order
+        return list(executor.map(captured_call, items))
+
+
+def run_parallel_async(coro_func, items: list, workers: int = 1, setup=None, teardown=None):
+    """
+    asyncio version of run_parallel, coro_func(item) is a coroutine function and at
+    most "workers" of them are run at the same time.  Output and results are handled
+    the same as run_parallel.  Optional setup/teardown coroutine functions are awaited
+    (inside the event loop) before the first and after the last item, such as to open
+    and close a shared http session.
+    """
+    router = _install_router()
+
+    async def captured_call(item, semaphore):
+        async with semaphore:
+            router.start_capture()
+            start = time.monotonic()
+            try:
+                result = await coro_func(item)
+            except Exception as e:
+                print(f'Unhandled error: {e}')
+                result = (False, f'Unhandled error: {e}')
+            elapsed = time.monotonic() - start
+            router.emit(router.stop_capture())
+            return result, elapsed
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max(workers, 1))
+        if setup:
+            await setup()
+        try:
+            # gather returns results in the same order as items
+            return await asyncio.gather(*(captured_call(item, semaphore) for item in items))
+        finally:
+            if teardown:
+                await teardown()
+
+    return asyncio.run(run_all())
+
+
+def _timed_process_call(func, item):
+    """ run_parallel_processes worker, module level so it can be pickled """
+    start = time.monotonic()
+    try:
+        result = func(item)
+    except Exception as e:
+        result = (False, f'Unhandled error: {e}')
+    return result, time.monotonic() - start
+
+
+def run_parallel_processes(func, items: list, workers: int = 1, chunksize: int = 1):
+    """
+    Process pool version of run_parallel for CPU bound work (such as parsing and diffing
+    configs), so it is spread across cores instead of being serialized by the GIL.
+    func must be a module level function and items/results must be picklable.  Results
+    are returned the same as run_parallel.  Output printed by func is not captured, so
+    func should return what it has to report rather than print it.
+    """
+    call = functools.partial(_timed_process_call, func)
+    if workers <= 1 or len(items) <= 1:
+        return [call(item) for item in items]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(call, items, chunksize=chunksize))
+
+
+def plan_waves(items: list, sizes: list):
+    """ Split items into waves of the given sizes, the last size repeating until all items are in a wave """
+    waves = []
+    i = 0
+    while i < len(items):
+        size = sizes[min(len(waves), len(sizes) - 1)]
+        waves.append(items[i:i + size])
+        i += size
+    return waves
+
+
+def print_result_table(rows: list, headers: list):
+    """
+    Print a simple fixed width table. rows is a list of lists/tuples of values
+    in the same order as headers.
+    """
+    rows = [[str(col) for col in row] for row in rows]
+    widths = [len(h) for h in headers]
+    for row in rows:
+        for i, col in enumerate(row):
+            widths[i] = max(widths[i], len(col))
+
+    line = '  '.join('-' * w for w in widths)
+    print(line)
+    print('  '.join(h.ljust(widths[i]) for i, h in enumerate(headers)))
+    print(line)
+    for row in rows:
+        print('  '.join(col.ljust(widths[i]) for i, col in enumerate(row)))
+    print(line)
@@ -0,0 +1,165 @@
+from modules.file_utils import AtomicFileWriter
+from modules.inventory import DeviceRecord
+import asyncio
+import datetime
+import json
+import threading
+import time
+
+PROBE_TIMEOUT = 3
+PROBE_WORKERS = 256
+
+# Circuit breaker: after FAILURE_THRESHOLD failed checks in a row a device is not checked again for
+# BASE_COOLDOWN seconds, doubled for every further failed check up to MAX_COOLDOWN
+FAILURE_THRESHOLD = 2
+BASE_COOLDOWN = 3600
+MAX_COOLDOWN = 7 * 24 * 3600
+
+
+def device_address(device: DeviceRecord, port: int = None):
+    """
+    (host, port) to connect to for device.  Its ip may include a port (such as 10.1.1.1:8443 or
+    [2001:db8::1]:8443), otherwise port, or 443/80 for https/http (use_ssl).
+    """
+    host = device.ip
+    device_port = None
+    if host.startswith('['):
+        host, _, rest = host[1:].partition(']')
+        if rest.startswith(':'):
+            device_port = int(rest[1:])
+    elif host.count(':') == 1:
+        host, device_port = host.split(':')
+        device_port = int(device_port)
+    if port is None:
+        port = device_port or (443 if device.use_ssl else 80)
+    return host, port
+
+
+async def probe(host: str, port: int, timeout: float = PROBE_TIMEOUT):
+    """ Open (and close) a TCP connection to host:port, returns None if it connected, otherwise the error """
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except asyncio.TimeoutError:
+        return f'No connection to {host}:{port} within {timeout}s'
+    except OSError as e:
+        return f'Connection to {host}:{port} failed: {e.strerror or e}'
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return None
+
+
+def probe_all(addresses: dict, timeout: float = PROBE_TIMEOUT, workers: int = PROBE_WORKERS):
+    """ Probe the (host, port) of each name in addresses concurrently, returns dict of name -> probe() result """
+    async def run_all():
+        semaphore = asyncio.Semaphore(workers)
+
+        async def limited(address):
+            async with semaphore:
+                return await probe(*address, timeout=timeout)
+
+        results = await asyncio.gather(*(limited(address) for address in addresses.values()))
+        return dict(zip(addresses, results))
+
+    return asyncio.run(run_all())
+
+
+class DeviceHealth:
+    """
+    Circuit breaker per device, persisted between runs (of any of the scripts) in a json file.
+
+    Each reachability check of a device is recorded.  After FAILURE_THRESHOLD failed checks in a
+    row the breaker of the device opens: later runs skip the device without connecting to it until
+    its cooldown (BASE_COOLDOWN, doubled for each further failure, up to MAX_COOLDOWN) has passed.
+    Then it is checked once more, a successful check closes the breaker.  A device whose address
+    changed in the device file starts over.
+    """
+    def __init__(self, health_file: str):
+        self.health_file = health_file
+        self.lock = threading.Lock()
+        try:
+            with open(health_file) as f:
+                self.devices = json.load(f).get('devices', {})
+        except FileNotFoundError:
+            self.devices = {}
+        except ValueError as e:
+            print(f'Warning, ignoring unreadable device health file {health_file}: {e}')
+            self.devices = {}
+
+    def open_detail(self, name: str, address: str):
+        """ Why name is skipped while its breaker is open, None if it should be checked """
+        entry = self.devices.get(name)
+        if not entry or entry.get('address') != address or not entry.get('retry_after'):
+            return None
+        if time.time() >= entry['retry_after']:
+            return None
+        retry_at = datetime.datetime.fromtimestamp(entry['retry_after']).isoformat(sep=' ', timespec='minutes')
+        return f'Known unreachable, {entry["failures"]} failed checks since {entry["first_failure"]}, ' \
+               f'next check after {retry_at}'
+
+    def record(self, name: str, address: str, error: str = None):
+        """ Record a check of name at address, error is None if it succeeded """
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        with self.lock:
+            if error is None:
+                self.devices[name] = {'address': address, 'failures': 0, 'last_success': now}
+                return
+            entry = self.devices.get(name)
+            if not entry or entry.get('address') != address:
+                entry = self.devices[name] = {'address': address, 'failures': 0}
+            entry['failures'] += 1
+            if entry['failures'] == 1:
+                entry['first_failure'] = now
+            entry['last_failure'] = now
+            entry['last_error'] = error
+            if entry['failures'] >= FAILURE_THRESHOLD:
+                cooldown = min(BASE_COOLDOWN * 2 ** (entry['failures'] - FAILURE_THRESHOLD), MAX_COOLDOWN)
+                entry['retry_after'] = time.time() + cooldown
+
+    def save(self):
+        try:
+            with AtomicFileWriter(self.health_file) as writer:
+                writer.write(json.dumps({'devices': self.devices}, indent=2).encode())
+                writer.commit()
+        except OSError as e:
+            print(f'Warning, unable to save device health file {self.health_file}: {e}')
+
+
+def check_reachability(devices: dict, names: list, timeout: float = PROBE_TIMEOUT, health: DeviceHealth = None,
+                       recheck: bool = False, port: int = None, workers: int = PROBE_WORKERS):
+    """
+    Reachability pre-pass of names (keys of devices, the DeviceRecords of a device file): a TCP connect
+    to the https port (or port) of each, all at once (workers at a time) with a timeout.  Devices
+    whose breaker in health is open are skipped without connecting, unless recheck.  Prints a summary
+    line and returns dict of name -> reason for each device that is not reachable.
+    """
+    start = time.monotonic()
+    unreachable = {}
+    addresses = {}
+    skipped = 0
+    for name in names:
+        try:
+            addresses[name] = device_address(devices[name], port)
+        except (KeyError, ValueError) as e:
+            unreachable[name] = f'Invalid address: {e}'
+            continue
+        detail = health.open_detail(name, '{}:{}'.format(*addresses[name])) if health and not recheck else None
+        if detail:
+            unreachable[name] = detail
+            del addresses[name]
+            skipped += 1
+
+    for name, error in probe_all(addresses, timeout=timeout, workers=workers).items():
+        if error:
+            unreachable[name] = f'Unreachable: {error}'
+        if health:
+            health.record(name, '{}:{}'.format(*addresses[name]), error)
+    if health:
+        health.save()
+
+    print(f'Reachability check: {len(names) - len(unreachable)} of {len(names)} device(s) reachable, '
+          f'{len(unreachable) - skipped} failed to connect, {skipped} skipped as known unreachable '
+          f'({time.monotonic() - start:.1f}s)')
+    return unreachable
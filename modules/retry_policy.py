@@ -0,0 +1,134 @@
+from pyFGT.fortigate import FGTConnectionError
+import asyncio
+import random
+import threading
+import time
+
+# Defaults, see DevicePolicy
+CONNECT_TIMEOUT = 5
+RETRIES = 2
+MIN_TIMEOUT = 5
+MAX_TIMEOUT_FACTOR = 4
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+
+# Transfer rate assumed (bytes/s) until one is observed, and the share of the observed rate relied on
+DEFAULT_THROUGHPUT = 256 * 1024
+THROUGHPUT_MARGIN = 0.5
+# Responses smaller than this are latency samples, larger ones throughput samples
+THROUGHPUT_MIN_BYTES = 64 * 1024
+
+
+class DevicePolicy:
+    """
+    Timeouts and retries for the api calls to one device, adapted to how the device has answered so far.
+
+    The read timeout of a call follows the observed response times (smoothed time plus 4 times their
+    variation, the way TCP derives its retransmission timeout), at least MIN_TIMEOUT and at most
+    MAX_TIMEOUT_FACTOR times the configured timeout, which is used as is until the device has answered.
+    Calls sending or receiving a payload get the time to transfer it on top, from the observed transfer
+    rate.  The connect timeout is short, an unreachable device fails within seconds rather than holding a
+    worker for the whole read timeout.
+
+    Only idempotent calls (status checks, backups) are retried, up to retries times on connection errors
+    and timeouts, after a random (full jitter) backoff delay.  The read timeout doubles on each retry, up
+    to the configured timeout, so a device that stopped answering doesn't hold a worker for longer than it
+    did before it was known.  Calls that can't be retried (upgrade, restore) get at least the configured
+    timeout.
+    """
+    def __init__(self, timeout: float, retries: int = RETRIES, connect_timeout: float = CONNECT_TIMEOUT):
+        self.timeout = timeout
+        self.retries = retries
+        self.connect_timeout = connect_timeout
+        self.srtt = None
+        self.rttvar = None
+        self.throughput = None
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float, payload_bytes: int = 0):
+        """ Record a completed call, taking seconds and transferring payload_bytes """
+        with self.lock:
+            if payload_bytes >= THROUGHPUT_MIN_BYTES:
+                rate = payload_bytes / max(seconds, 0.001)
+                self.throughput = rate if self.throughput is None else 0.75 * self.throughput + 0.25 * rate
+            elif self.srtt is None:
+                self.srtt = seconds
+                self.rttvar = seconds / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - seconds)
+                self.srtt = 0.875 * self.srtt + 0.125 * seconds
+
+    def timeouts(self, payload_bytes: int = 0, minimum: float = 0):
+        """ (connect, read) timeouts in seconds for a call transferring payload_bytes """
+        if self.srtt is None:
+            read = self.timeout
+        else:
+            read = min(max(self.srtt + 4 * self.rttvar, MIN_TIMEOUT), self.timeout * MAX_TIMEOUT_FACTOR)
+        if payload_bytes:
+            rate = self.throughput * THROUGHPUT_MARGIN if self.throughput else DEFAULT_THROUGHPUT
+            read += payload_bytes / rate
+        return min(self.connect_timeout, read), max(read, minimum)
+
+    def _attempts(self, idempotent: bool, payload_bytes: int, minimum: float):
+        """ Timeouts of each attempt of a call """
+        if not idempotent:
+            return [self.timeouts(payload_bytes, max(minimum, self.timeout))]
+        connect, read = self.timeouts(payload_bytes, minimum)
+        return [(connect, min(read * 2 ** n, max(read, self.timeout))) for n in range(self.retries + 1)]
+
+    @staticmethod
+    def backoff(retry: int):
+        """ Delay before retry number retry (0 for the first), random up to BACKOFF_BASE doubled each retry """
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** retry))
+
+    def call(self, attempt, idempotent: bool = True, payload_bytes: int = 0, minimum: float = 0,
+             observe: bool = True):
+        """
+        Return attempt((connect, read)), retrying it on FGTConnectionError if idempotent.  The time it
+        took is recorded unless observe is False (such as a download whose size is only known after).
+        """
+        attempts = self._attempts(idempotent, payload_bytes, minimum)
+        for retry, timeouts in enumerate(attempts):
+            start = time.monotonic()
+            try:
+                result = attempt(timeouts)
+            except FGTConnectionError:
+                if retry == len(attempts) - 1:
+                    raise
+                time.sleep(self.backoff(retry))
+                continue
+            if observe:
+                self.observe(time.monotonic() - start, payload_bytes)
+            return result
+
+    async def call_async(self, attempt, idempotent: bool = True, payload_bytes: int = 0, minimum: float = 0,
+                         observe: bool = True):
+        """ Same as call, attempt is a coroutine function """
+        attempts = self._attempts(idempotent, payload_bytes, minimum)
+        for retry, timeouts in enumerate(attempts):
+            start = time.monotonic()
+            try:
+                result = await attempt(timeouts)
+            except FGTConnectionError:
+                if retry == len(attempts) - 1:
+                    raise
+                await asyncio.sleep(self.backoff(retry))
+                continue
+            if observe:
+                self.observe(time.monotonic() - start, payload_bytes)
+            return result
+
+
+class PolicyRegistry:
+    """ DevicePolicy of each device (base url) for the run, shared by the sync and async api clients """
+    def __init__(self):
+        self.policies = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, timeout: float, retries: int = RETRIES, connect_timeout: float = CONNECT_TIMEOUT):
+        """ Policy for key, created with timeout/retries/connect_timeout on first use """
+        with self.lock:
+            policy = self.policies.get(key)
+            if policy is None:
+                policy = self.policies[key] = DevicePolicy(timeout, retries=retries, connect_timeout=connect_timeout)
+            return policy
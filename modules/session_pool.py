@@ -0,0 +1,64 @@
+from collections import OrderedDict
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+
+# Defaults, see SessionPool
+MAX_SESSIONS = 512
+POOL_MAXSIZE = 4
+
+
+class SessionPool:
+    """
+    Registry of keep-alive requests sessions, one per device (per url and credential), so every api
+    call to a device during a run (login check, backup, upgrade, restore) reuses the same pooled
+    connection instead of connecting, and doing the TLS handshake, again for each new api client.
+
+    Each session keeps up to pool_maxsize idle connections to its device.  At most max_sessions
+    sessions are kept, the least recently used one is closed when another is needed, so a run over
+    thousands of devices doesn't keep a socket open to each of them.  Set max_sessions to at least
+    the number of devices worked on concurrently.
+    """
+    def __init__(self, max_sessions: int = MAX_SESSIONS, pool_maxsize: int = POOL_MAXSIZE):
+        self.max_sessions = max_sessions
+        self.pool_maxsize = pool_maxsize
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        # One host per session, retries are left to the caller
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get(self, key):
+        """ Session for key (such as (base url, credential)), created on first use """
+        evicted = []
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = self.sessions[key] = self._new_session()
+                while len(self.sessions) > max(self.max_sessions, 1):
+                    evicted.append(self.sessions.popitem(last=False)[1])
+            else:
+                self.sessions.move_to_end(key)
+        # A request still running on an evicted session completes, its connection is just not reused
+        for old in evicted:
+            old.close()
+        return session
+
+    def discard(self, key):
+        """ Close and forget the session for key, such as after logging out of a password session """
+        with self.lock:
+            session = self.sessions.pop(key, None)
+        if session is not None:
+            session.close()
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
@@ -0,0 +1,247 @@
+from modules.firmware_catalog import parse_version
+from modules.firmware_repo import FirmwareRepository
+from modules.fortigate_api_utils import upgrade_succeeded
+from modules.fortigate_async_api_utils import FortiGateAsyncApiUtils
+from modules.parallel_utils import _install_router, plan_waves
+from pyFGT.fortigate import FGTBaseException, FGTValueError, FGTConnectionError
+import asyncio
+import datetime
+import math
+import os
+import time
+
+# Upgrade states, in the order a device goes through them
+QUEUED = 'queued'
+UPLOADING = 'uploading'
+REBOOTING = 'rebooting'
+VERIFYING = 'verifying'
+DONE = 'done'
+FAILED = 'failed'
+
+# Timeout of each status poll while waiting for a device to come back, a rebooting device may not answer at all
+POLL_TIMEOUT = 10
+
+
+class DeviceUpgrade:
+    """ Upgrade progress of one device, times holds when the device entered each state it went through """
+    def __init__(self, name: str, device: dict):
+        self.name = name
+        self.device = device
+        self.state = QUEUED
+        self.detail = ''
+        self.wave = None
+        self.from_version = None
+        self.to_version = None
+        self.times = {QUEUED: time.monotonic()}
+
+    def set_state(self, state: str, detail: str = None):
+        self.state = state
+        self.times[state] = time.monotonic()
+        if detail is not None:
+            self.detail = detail
+
+    def seconds_in(self, state: str):
+        """ Seconds spent in state, until the next state was entered (or now), None if never in state """
+        if state not in self.times:
+            return None
+        later = [t for t in self.times.values() if t > self.times[state]]
+        return (min(later) if later else time.monotonic()) - self.times[state]
+
+    @property
+    def elapsed(self):
+        """ Seconds from the start of the upload to done/failed, None if the device was never started """
+        if UPLOADING not in self.times:
+            return None
+        return self.times.get(self.state, time.monotonic()) - self.times[UPLOADING]
+
+
+class RollingUpgradeScheduler:
+    """
+    Rolling firmware upgrade of many devices with the asyncio api client.
+
+    Devices are upgraded in waves (wave_sizes such as [1, 10, 50], the last size repeating), at most
+    "workers" devices of a wave at a time.  Each device goes through the states queued, uploading
+    (status check and upgrade request), rebooting (polling monitor/system/status, with backoff, until
+    the device answers again) and verifying (the reported version is the target version), ending
+    as done or failed.  If more than max_failure_rate of a wave failed no further waves are started,
+    their devices are left queued.
+
+    The target version is img_ver_rev for FortiGuard and firmware repository upgrades, or taken from the
+    image file name.
+    When it can't be (an image file not named by version) any version change counts as upgraded.
+
+    facts is an optional dict of device name -> DeviceFacts already queried in this run (by the pre-flight
+    check), a device with facts is not asked for its status again before its upload.
+    """
+    def __init__(self, devices: dict, image_source: str, img_ver_rev: str, wave_sizes: list = None,
+                 workers: int = 1, max_failure_rate: float = 0.0, reboot_timeout: int = 900,
+                 poll_interval: float = 15, max_poll_interval: float = 60, connection_limit: int = None,
+                 firmware_repo: FirmwareRepository = None, facts: dict = None, verbose: bool = False,
+                 debug: bool = False):
+        self.upgrades = {name: DeviceUpgrade(name, device) for name, device in devices.items()}
+        self.image_source = image_source
+        self.img_ver_rev = img_ver_rev
+        if image_source == 'fortiguard':
+            self.target = parse_version(img_ver_rev)
+        else:
+            self.target = parse_version(os.path.basename(img_ver_rev))
+        self.waves = plan_waves(list(self.upgrades), wave_sizes or [len(self.upgrades)])
+        self.workers = max(workers, 1)
+        self.max_failure_rate = max_failure_rate
+        self.reboot_timeout = reboot_timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.connection_limit = connection_limit
+        self.firmware_repo = firmware_repo
+        self.facts = facts or {}
+        self.verbose = verbose
+        self.debug = debug
+        self.router = _install_router()
+
+    def _set_state(self, upgrade: DeviceUpgrade, state: str, detail: str = None):
+        upgrade.set_state(state, detail)
+        now = datetime.datetime.now().strftime('%H:%M:%S')
+        line = f'{now} {upgrade.name}: {state}'
+        if detail:
+            line += f', {detail}'
+        # Written past any capture of the task, so progress is shown as it happens
+        self.router.emit(line + '\n')
+
+    def _target_str(self):
+        return 'v{}.{}.{}'.format(*self.target) if self.target else 'a new version'
+
+    async def _status_version(self, fgt: FortiGateAsyncApiUtils, timeout: int = None):
+        """ Version reported by monitor/system/status, None if the device answered but not with a status """
+        code, msg = await fgt.get('monitor/system/status', timeout=timeout)
+        if code != 'success':
+            return None
+        return msg.get('version')
+
+    async def _wait_for_upgrade(self, upgrade: DeviceUpgrade, fgt: FortiGateAsyncApiUtils):
+        """
+        Poll the device until it answers with a version other than the one it was upgraded from, or
+        answers at all after having been unreachable (it rebooted).  The poll interval doubles each
+        time, up to max_poll_interval.  Returns the reported version, None on reboot_timeout.
+        """
+        deadline = time.monotonic() + self.reboot_timeout
+        delay = self.poll_interval
+        went_down = False
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, self.max_poll_interval)
+            try:
+                version = await self._status_version(fgt, timeout=POLL_TIMEOUT)
+            except (FGTBaseException, FGTValueError, FGTConnectionError):
+                went_down = True
+                continue
+            if version is None:
+                # Answering, but the api is not ready yet
+                went_down = True
+                continue
+            if version != upgrade.from_version or went_down:
+                return version
+
+    async def _upgrade(self, upgrade: DeviceUpgrade):
+        fgt = FortiGateAsyncApiUtils(device=upgrade.device, verbose=self.verbose, debug=self.debug)
+        fgt.facts = self.facts.get(upgrade.name)
+        self._set_state(upgrade, UPLOADING)
+        try:
+            # Cached on fgt, so upgrade_image doesn't ask for the status again
+            upgrade.from_version = (await fgt.get_facts()).version
+        except FGTValueError:
+            self._set_state(upgrade, FAILED, 'Likely, the apikey was not verified/authenticated by FG')
+            return
+        except (FGTBaseException, FGTConnectionError) as e:
+            self._set_state(upgrade, FAILED, f'Connection failed: {e}')
+            return
+        if self.target and parse_version(upgrade.from_version) == self.target:
+            upgrade.to_version = upgrade.from_version
+            self._set_state(upgrade, DONE, f'Already running {upgrade.from_version}')
+            return
+
+        try:
+            code, msg = await fgt.upgrade_image(image_source=self.image_source, img_ver_rev=self.img_ver_rev,
+                                                firmware_repo=self.firmware_repo)
+        except (FGTBaseException, FGTValueError, FGTConnectionError) as e:
+            self._set_state(upgrade, FAILED, f'API Call to FGT Failed: {e}')
+            return
+        if not upgrade_succeeded(code):
+            self._set_state(upgrade, FAILED, f'Upgrade request failed: {msg}')
+            return
+
+        self._set_state(upgrade, REBOOTING, f'waiting for {self._target_str()}')
+        version = await self._wait_for_upgrade(upgrade, fgt)
+        if version is None:
+            self._set_state(upgrade, FAILED, f'No new version reported within {self.reboot_timeout}s')
+            return
+
+        upgrade.to_version = version
+        self._set_state(upgrade, VERIFYING, f'reporting {version}')
+        if self.target and parse_version(version) != self.target:
+            self._set_state(upgrade, FAILED, f'Came back running {version}, expected {self._target_str()}')
+        elif version == upgrade.from_version:
+            self._set_state(upgrade, FAILED, f'Rebooted but still running {version}')
+        else:
+            self._set_state(upgrade, DONE, f'{upgrade.from_version} -> {version}')
+
+    async def _run_device(self, upgrade: DeviceUpgrade, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            self.router.start_capture()
+            try:
+                await self._upgrade(upgrade)
+            except Exception as e:
+                self._set_state(upgrade, FAILED, f'Unhandled error: {e}')
+            finally:
+                # Output of the api calls themselves is only of interest with --verbose/--debug
+                output = self.router.stop_capture()
+                if output and (self.verbose or self.debug):
+                    self.router.emit(f'{upgrade.name}:\n{output}\n')
+
+    def _estimate(self, remaining_waves: list):
+        """ Seconds the remaining waves should take, from the average time of the devices upgraded so far """
+        times = [u.elapsed for u in self.upgrades.values() if u.state == DONE and u.from_version != u.to_version]
+        if not times:
+            return None
+        per_device = sum(times) / len(times)
+        return sum(math.ceil(len(wave) / self.workers) for wave in remaining_waves) * per_device
+
+    async def _run(self):
+        for wave_num, wave in enumerate(self.waves, 1):
+            for name in wave:
+                self.upgrades[name].wave = wave_num
+
+        await FortiGateAsyncApiUtils.open_session(self.connection_limit)
+        try:
+            for wave_num, wave in enumerate(self.waves, 1):
+                print()
+                print(f'Wave {wave_num} of {len(self.waves)}: upgrading {len(wave)} device(s), '
+                      f'{min(self.workers, len(wave))} at a time')
+                wave_start = time.monotonic()
+                semaphore = asyncio.Semaphore(self.workers)
+                await asyncio.gather(*(self._run_device(self.upgrades[name], semaphore) for name in wave))
+
+                failed = sum(1 for name in wave if self.upgrades[name].state == FAILED)
+                print(f'Wave {wave_num} complete in {time.monotonic() - wave_start:.1f}s: '
+                      f'{len(wave) - failed} done, {failed} failed ({failed / len(wave):.0%})')
+                if wave_num == len(self.waves):
+                    break
+                if failed / len(wave) > self.max_failure_rate:
+                    print(f'Failure rate above --max_failure_rate {self.max_failure_rate:.0%}, '
+                          f'stopping before wave {wave_num + 1}')
+                    for later_wave in self.waves[wave_num:]:
+                        for name in later_wave:
+                            self.upgrades[name].detail = f'Not attempted, stopped after wave {wave_num}'
+                    break
+                estimate = self._estimate(self.waves[wave_num:])
+                if estimate is not None:
+                    print(f'Estimated time for the remaining {len(self.waves) - wave_num} wave(s): {estimate:.0f}s')
+        finally:
+            await FortiGateAsyncApiUtils.close_session()
+
+    def run(self):
+        """ Run the rolling upgrade, returns the DeviceUpgrade of each device in the order of devices """
+        asyncio.run(self._run())
+        return list(self.upgrades.values())
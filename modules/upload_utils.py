@@ -0,0 +1,173 @@
+from modules.instrumentation import recorder
+import atexit
+import base64
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+
+# Multiple of 3 bytes, so base64 of consecutive chunks joins into one valid base64 string (no padding between)
+B64_CHUNK_SIZE = 3 * 256 * 1024
+
+
+def b64_encode_file(src_path: str, dest):
+    """
+    Write base64 (without newlines) of src_path to the binary file object dest, a chunk at a time,
+    returns the sha256 (hex) of the bytes that were encoded
+    """
+    sha256 = hashlib.sha256()
+    with open(src_path, 'rb') as src:
+        while True:
+            chunk = src.read(B64_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            dest.write(base64.b64encode(chunk))
+    return sha256.hexdigest()
+
+
+class StreamingB64File:
+    """
+    base64 encoding (no newlines) of a file, produced a chunk at a time while it is being uploaded,
+    so at most one chunk of the file and its encoding is in memory at once.  Used for one-off
+    uploads such as a config restore, see EncodedFile for content uploaded to many devices.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.file_size = os.path.getsize(path)
+
+    def __len__(self):
+        # 4 output characters per 3 input bytes, the last group padded
+        return 4 * ((self.file_size + 2) // 3)
+
+    def chunks(self, chunk_size: int = B64_CHUNK_SIZE):
+        """ Iterate the encoded content, chunk_size is the number of file bytes encoded per chunk """
+        chunk_size -= chunk_size % 3
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield base64.b64encode(chunk)
+
+
+class EncodedFile:
+    """
+    base64 encoding (no newlines) of a file, as uploaded in the "file_content" field of the
+    firmware upgrade and config restore api calls.
+
+    The file is encoded once, a chunk at a time, into a hidden temp file which is then memory
+    mapped read only.  Uploads read slices of the mapping, so any number of concurrent uploads
+    share one encoded copy (in the page cache) instead of each holding its own in memory.
+    sha256 is the hash of the file content that was encoded, which is what gets uploaded.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        fd, self.encoded_path = tempfile.mkstemp(prefix='.fgt-b64-', suffix='.tmp')
+        try:
+            with recorder.span('file encode') as span:
+                with os.fdopen(fd, 'wb') as f:
+                    self.sha256 = b64_encode_file(path, f)
+                span.bytes_in = os.path.getsize(path)
+                span.bytes_out = self.size = os.path.getsize(self.encoded_path)
+            with open(self.encoded_path, 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        except Exception:
+            os.unlink(self.encoded_path)
+            raise
+
+    def __len__(self):
+        return self.size
+
+    def chunks(self, chunk_size: int = B64_CHUNK_SIZE):
+        """ Iterate the encoded content as memoryview slices of the mapping (no copies) """
+        view = memoryview(self.data)
+        for start in range(0, self.size, chunk_size):
+            yield view[start:start + chunk_size]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                # An upload still holds a slice, the mapping goes away with the process instead
+                pass
+        try:
+            os.unlink(self.encoded_path)
+        except OSError:
+            pass
+
+
+class _SharedEncoding:
+    """ Slot for the EncodedFile of one image, its own lock is held while the image is encoded """
+    __slots__ = ('lock', 'encoded')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.encoded = None
+
+
+# _SharedEncoding per (path, size, mtime), shared by all threads/tasks of a run
+_encoded_files = {}
+_encoded_files_lock = threading.Lock()
+
+
+def shared_encoded_file(path: str):
+    """
+    EncodedFile for path, encoded on first use and shared by every later caller, such as every
+    device of a firmware upgrade run uploading the same image.  Callers arriving while the file is
+    being encoded wait for it rather than encoding it again, callers of other files (such as the
+    image of another model) don't wait.  A changed file is encoded again.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    # The shared lock only guards the dict, the encoding happens under the lock of the file's own slot
+    with _encoded_files_lock:
+        shared = _encoded_files.get(key)
+        if shared is None:
+            shared = _encoded_files[key] = _SharedEncoding()
+    with shared.lock:
+        # Left None if encoding failed, the next caller tries again
+        if shared.encoded is None:
+            shared.encoded = EncodedFile(path)
+        return shared.encoded
+
+
+@atexit.register
+def _close_encoded_files():
+    with _encoded_files_lock:
+        for shared in _encoded_files.values():
+            if shared.encoded is not None:
+                shared.encoded.close()
+        _encoded_files.clear()
+
+
+class JsonUploadBody:
+    """
+    JSON request body {<fields>, "<content_field>": "<content>"} for upload api calls, produced a
+    chunk at a time so the (possibly very large) encoded content is never copied into a json string.
+    content is anything with chunks() and len() giving the encoded content, such as an EncodedFile.
+    len() of the body is known up front, so requests/aiohttp send a normal Content-Length rather
+    than a chunked body.  Iterate it for requests, or pass async_chunks() to aiohttp.
+    """
+    def __init__(self, fields: dict, content_field: str, content):
+        prefix = json.dumps(fields)[:-1]
+        if fields:
+            prefix += ', '
+        self.prefix = f'{prefix}{json.dumps(content_field)}: "'.encode()
+        self.suffix = b'"}'
+        self.content = content
+
+    def __len__(self):
+        return len(self.prefix) + len(self.content) + len(self.suffix)
+
+    def __iter__(self):
+        yield self.prefix
+        yield from self.content.chunks()
+        yield self.suffix
+
+    async def async_chunks(self):
+        for chunk in self:
+            yield chunk
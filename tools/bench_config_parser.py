@@ -0,0 +1,161 @@
+"""
+Benchmark for modules/fos_config_parser.py on large synthetic multi-VDOM FortiOS configs.
+
+Generates a config of roughly --size_mb megabytes (global settings plus --vdoms VDOMs of
+interfaces, addresses, policies and a multi-line script), then times parsing it and path
+lookups, and reports peak Python memory used by the parsed tree.  With --baseline the same
+file is also parsed into nested Python dicts of strings for comparison, for example:
+
+  python tools/bench_config_parser.py --size_mb 100 --vdoms 10 --baseline
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from modules.fos_config_parser import FortiOSConfig  # noqa: E402
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size_mb', type=float, default=20, help='Approximate size of the generated config in MB')
+parser.add_argument('--vdoms', type=int, default=4, help='Number of VDOMs in the generated config')
+parser.add_argument('--lookups', type=int, default=100000, help='Number of random path lookups to time')
+parser.add_argument('--config_file', default=None,
+                    help='Benchmark this existing config file instead of generating one')
+parser.add_argument('--keep', action='store_true', help='Keep the generated config file')
+parser.add_argument('--baseline', action='store_true',
+                    help='Also parse into nested dicts of strings for comparison (uses a lot more memory)')
+
+
+def write_synthetic_config(path: str, size_mb: float, vdoms: int):
+    """ Write a multi-VDOM config of about size_mb MB to path, returns sample set paths for lookups """
+    target = int(size_mb * 1024 * 1024)
+    vdom_names = ['root'] + [f'vdom{i}' for i in range(1, vdoms)]
+    samples = []
+    with open(path, 'w', newline='\n') as f:
+        f.write('#config-version=FGT1K1-7.2.5-FW-build1517-230606:opmode=0:vdom=1:user=admin\n'
+                '#conf_file_ver=1234567890\n#buildno=1517\n#global_vdom=1\n')
+        f.write('config vdom\n' + ''.join(f'edit {v}\nnext\n' for v in vdom_names) + 'end\n')
+        f.write('config global\nconfig system global\n    set hostname "bench-fgt"\n    set vdom-mode multi-vdom\nend\n'
+                'config system interface\n')
+        port = 1
+        for v in vdom_names:
+            for _ in range(8):
+                f.write(f'    edit "port{port}"\n        set vdom "{v}"\n'
+                        f'        set ip 10.{port // 250}.{port % 250}.1 255.255.255.0\n'
+                        '        set allowaccess ping https ssh\n    next\n')
+                samples.append(f'global/system interface/port{port}/ip')
+                port += 1
+        f.write('end\n')
+        f.write('config system auto-script\n    edit "backup"\n        set script "config system global\n'
+                'set admintimeout 480\nend\n"\n    next\nend\nend\n')
+
+        # Fill the VDOMs round robin until the target size is reached
+        per_vdom = 2000
+        rounds = 0
+        while f.tell() < target:
+            for v in vdom_names:
+                f.write(f'config vdom\nedit {v}\nconfig firewall address\n')
+                base = rounds * per_vdom
+                for i in range(base, base + per_vdom):
+                    f.write(f'    edit "net-{i}/24"\n        set uuid {random.getrandbits(128):032x}\n'
+                            f'        set subnet 10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256} 255.255.255.0\n'
+                            f'        set comment "address {i} in {v}"\n    next\n')
+                f.write('end\nconfig firewall policy\n')
+                for i in range(base, base + per_vdom):
+                    f.write(f'    edit {i + 1}\n        set name "policy-{i}"\n        set srcintf "port1"\n'
+                            '        set dstintf "port2"\n        set action accept\n'
+                            f'        set srcaddr "net-{i}/24"\n        set dstaddr "all"\n'
+                            '        set schedule "always"\n        set service "ALL"\n        set logtraffic all\n'
+                            '    next\n')
+                f.write('end\nnext\nend\n')
+                samples.append(f'vdom/{v}/firewall policy/{base + 1}/name')
+                samples.append(f'vdom/{v}/firewall address/net-{base + per_vdom - 1}/24/subnet')
+            rounds += 1
+    return samples
+
+
+def parse_to_dicts(path: str):
+    """ Naive baseline, nested dicts of strings built with a stack """
+    root = {}
+    stack = [root]
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            word, _, rest = line.partition(' ')
+            if word in ('config', 'edit'):
+                stack.append(stack[-1].setdefault(rest.strip('"'), {}))
+            elif word == 'set':
+                key, _, value = rest.partition(' ')
+                stack[-1][key] = value
+            elif word in ('next', 'end') and len(stack) > 1:
+                stack.pop()
+    return root
+
+
+def measure(func, *args):
+    """
+    Run func(*args) twice, once timed and once under tracemalloc (which slows it down a lot),
+    returns (result, seconds, peak traced bytes)
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    del result
+
+    tracemalloc.start()
+    result = func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+#######################
+# Main
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    mb = 1024 * 1024
+
+    if args.config_file:
+        config_file = args.config_file
+        samples = None
+    else:
+        fd, config_file = tempfile.mkstemp(prefix='bench-fos-', suffix='.conf')
+        os.close(fd)
+        print(f'Generating ~{args.size_mb}MB config with {args.vdoms} VDOMs in {config_file}')
+        samples = write_synthetic_config(config_file, args.size_mb, args.vdoms)
+
+    try:
+        size = os.path.getsize(config_file)
+        config, elapsed, peak = measure(FortiOSConfig, config_file)
+        print(f'Parsed {size / mb:.1f}MB, {len(config)} nodes, {len(config.names)} distinct names')
+        print(f'  parse time:   {elapsed:.2f}s ({size / mb / elapsed:.1f}MB/s)')
+        print(f'  peak memory:  {peak / mb:.1f}MB ({peak / max(len(config), 1):.0f} bytes/node)')
+        print(f'  vdoms:        {", ".join(config.vdoms()) or "none"}')
+
+        if samples is None:
+            # Sample lookups from the file itself
+            samples = ['/'.join(path) for path, value in config.iter_sets() if value is not None][:1000]
+        if samples:
+            lookups = [random.choice(samples) for _ in range(args.lookups)]
+            start = time.perf_counter()
+            missing = sum(1 for path in lookups if config.get(path) is None)
+            elapsed = time.perf_counter() - start
+            print(f'  lookups:      {len(lookups)} in {elapsed:.2f}s ({len(lookups) / elapsed:.0f}/s), {missing} missing')
+        config.close()
+
+        if args.baseline:
+            tree, elapsed, peak = measure(parse_to_dicts, config_file)
+            print('Baseline nested dict parse')
+            print(f'  parse time:   {elapsed:.2f}s ({size / mb / elapsed:.1f}MB/s)')
+            print(f'  peak memory:  {peak / mb:.1f}MB')
+    finally:
+        if not args.config_file and not args.keep:
+            os.unlink(config_file)
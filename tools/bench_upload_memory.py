@@ -0,0 +1,125 @@
+"""
+Memory benchmark for upload request bodies (firmware upgrade and config restore), comparing the
+original approach with the streaming base64 pipeline in modules/upload_utils.py.
+
+Each mode builds the json request body for a --size_mb test file and writes it to a null sink the
+way requests sends it, in a fresh subprocess so its peak RSS can be reported on its own:
+  old        base64.encodebytes of the whole file, decoded to str, newlines replaced, then the
+             request json.dumps'd into one string (what file_to_b64 + pyFGT post did)
+  streaming  StreamingB64File, encoded a chunk at a time while the body is sent (config restore)
+  shared     EncodedFile, encoded once to a memory mapped temp file and sent --uploads times from
+             concurrent threads (firmware image upgrade of many devices)
+
+  python tools/bench_upload_memory.py --size_mb 200 --uploads 8
+"""
+
+import argparse
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from modules.upload_utils import EncodedFile, JsonUploadBody, StreamingB64File  # noqa: E402
+
+FIELDS = {'vdom': 'root', 'source': 'upload', 'scope': 'global', 'ignore_invalid_sinature': 'true'}
+MODES = ['old', 'streaming', 'shared']
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size_mb', type=int, default=100, help='Size of the generated test file in MB')
+parser.add_argument('--uploads', type=int, default=4, help='Concurrent uploads of the same file per mode')
+parser.add_argument('--file', default=None, help='Use this file instead of generating one')
+parser.add_argument('--mode', choices=MODES, default=None, help='Run a single mode (used internally)')
+
+
+def sink(chunks):
+    """ Stand in for the socket, reads every byte of the body chunks and returns the number of bytes sent """
+    sent = 0
+    crc = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        sent += len(chunk)
+    return sent
+
+
+def upload_old(path):
+    with open(path, 'rb') as f:
+        f64 = base64.encodebytes(f.read())
+    f64_clean = f64.decode('ASCII').replace('\n', '')
+    # pyFGT json.dumps the request, http.client then encodes the str body to bytes
+    body = json.dumps(dict(FIELDS, file_content=f64_clean))
+    return sink([body.encode('latin-1')])
+
+
+def upload_streaming(path):
+    return sink(JsonUploadBody(FIELDS, 'file_content', StreamingB64File(path)))
+
+
+def run_mode(mode: str, path: str, uploads: int):
+    """ Run uploads concurrent uploads of path using mode, returns bytes sent per upload """
+    if mode == 'shared':
+        encoded = EncodedFile(path)
+
+        def upload(p):
+            return sink(JsonUploadBody(FIELDS, 'file_content', encoded))
+    else:
+        upload = upload_old if mode == 'old' else upload_streaming
+
+    results = [None] * uploads
+
+    def worker(i):
+        results[i] = upload(path)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(uploads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if mode == 'shared':
+        encoded.close()
+    return results[0]
+
+
+#######################
+# Main
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.mode:
+        start = time.perf_counter()
+        sent = run_mode(args.mode, args.file, args.uploads)
+        elapsed = time.perf_counter() - start
+        # ru_maxrss is kilobytes on Linux, bytes on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        print(json.dumps({'sent': sent, 'seconds': elapsed,
+                          'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale}))
+        raise SystemExit
+
+    path = args.file
+    if not path:
+        fd, path = tempfile.mkstemp(prefix='bench-upload-', suffix='.bin')
+        with os.fdopen(fd, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+    mb = 1024 * 1024
+    print(f'Test file {os.path.getsize(path) / mb:.0f}MB, {args.uploads} concurrent upload(s) per mode')
+    try:
+        for mode in MODES:
+            out = subprocess.run([sys.executable, __file__, '--mode', mode, '--file', path,
+                                  '--uploads', str(args.uploads)], capture_output=True, text=True)
+            if out.returncode:
+                print(f'  {mode:10} failed: {out.stderr.strip().splitlines()[-1:]}')
+                continue
+            result = json.loads(out.stdout)
+            print(f'  {mode:10} peak RSS {result["peak_rss"] / mb:8.1f}MB  time {result["seconds"]:6.2f}s  '
+                  f'body {result["sent"] / mb:.1f}MB')
+    finally:
+        if not args.file:
+            os.unlink(path)
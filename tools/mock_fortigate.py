@@ -0,0 +1,570 @@
+"""
+Minimal mock of the FortiGate REST API for exercising and timing the fleet scripts locally.
+
+A single plain http server answers for any number of "devices".  Each device is identified by
+its apikey (Bearer token) or login name, so one server can stand in for a whole inventory.
+Use --write_device_file to generate a matching device yaml file, for example:
+
+  python tools/mock_fortigate.py --port 8080 --devices 500 --latency 0.2 \\
+      --write_device_file /tmp/mock_fgts.yml
+  python fg_backup_from_list.py --device_file /tmp/mock_fgts.yml --backup_dir /tmp/backups \\
+      --lab_name_from none --workers 64
+
+Devices named "*-slow" (see --slow_every) add --slow_latency to each response and devices named
+"*-dead" (see --dead_every) point at a non-routable address so they time out like an unreachable FG.
+A firmware upgrade makes the device "reboot": for --reboot_time seconds its connections are dropped
+without a response, after which it reports the upgraded version (the FortiGuard image version, or
+the next patch version for an uploaded image).  --drop_rate drops that share of requests without a
+response, like transient network errors.
+
+With --ssh_port the mock also runs an SSH server with a minimal FortiOS cli (config/edit/set/next/end
+of the accprofile and api-user tables, and "execute api-user generate-key"), for fg_api_key_gen.py.
+Over SSH and with a password api login the device is identified by its login name, --write_device_file
+with --ssh_port adds login, password and ssh_port to each device.  Devices named "*-vdom" (see
+--vdom_every) are in multi-vdom mode and need "config global" first.  Generated api keys authenticate
+their device, the previous key of the api-user no longer does.  Other keys than those and the
+"mock-<device>" keys of generated device files are rejected (401).
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import secrets
+import socket
+import string
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import paramiko
+import yaml
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every response')
+parser.add_argument('--slow_latency', type=float, default=5.0, help='Extra seconds added for "-slow" devices')
+parser.add_argument('--config_lines', type=int, default=2000, help='Approximate lines in generated backup configs')
+parser.add_argument('--backup_seconds', type=float, default=0.0,
+                    help='Send each backup config a piece at a time over this many seconds, like a large config '
+                         'on a busy FG')
+parser.add_argument('--version', default='v7.2.5', help='FOS version reported by mock devices')
+parser.add_argument('--generation', type=int, default=1,
+                    help='Config generation of mock devices, change it to simulate config changes on all devices')
+parser.add_argument('--models', default='FGVM64',
+                    help='Comma separated models reported by mock devices (such as "FGVM64,FG100F,FGT60F"), '
+                         'each device reports one of them (fixed by its name)')
+parser.add_argument('--reboot_time', type=float, default=3.0,
+                    help='Seconds a device is unreachable after a firmware upgrade before reporting the new version')
+parser.add_argument('--drop_rate', type=float, default=0.0,
+                    help='Share (0-1) of requests whose connection is dropped without a response')
+parser.add_argument('--ssh_port', type=int, default=0, help='Also run the mock SSH cli on this port')
+parser.add_argument('--devices', type=int, default=10, help='Number of devices for --write_device_file')
+parser.add_argument('--vdom_every', type=int, default=0, help='Make every Nth generated device a multi-vdom device')
+parser.add_argument('--slow_every', type=int, default=0, help='Make every Nth generated device a slow device')
+parser.add_argument('--dead_every', type=int, default=0, help='Make every Nth generated device unreachable')
+parser.add_argument('--write_device_file', default=None, help='Write a device yaml file for the mock fleet and exit')
+
+
+def make_config(device_name: str, version: str, lines: int, generation: int = 1):
+    """ Build a synthetic FortiOS style config for device_name """
+    build = 1517
+    out = [f'#config-version=FGVM64-{version.lstrip("v")}-FW-build{build}-230606:opmode=0:vdom=0:user=admin',
+           '#conf_file_ver=1234567890', f'#buildno={build}', '#global_vdom=1',
+           'config system global', f'    set hostname "{device_name}"', '    set timezone 04',
+           f'    set alias "config generation {generation}"', 'end',
+           'config system interface']
+    port = 1
+    while len(out) < lines:
+        out += [f'    edit "port{port}"', '        set vdom "root"',
+                f'        set ip 10.{port // 250}.{port % 250}.1 255.255.255.0',
+                '        set allowaccess ping https ssh', '        set type physical',
+                f'        set description "mock interface {port} for {device_name}"', '    next']
+        port += 1
+    out.append('end')
+    return ('\n'.join(out) + '\n').encode()
+
+
+class MockFortiGateHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'MockFortiGate/1.0'
+
+    def log_message(self, format, *args):
+        # Keep the console quiet, a large run would otherwise print a line per request
+        pass
+
+    def setup(self):
+        super().setup()
+        # One handler per connection, so this counts connections (keep-alive reuse keeps it low)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _device_name(self):
+        auth = self.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            token = auth.split(' ', 1)[1]
+            with self.server.lock:
+                if token in self.server.apikeys:
+                    return self.server.apikeys[token]
+            # Keys of generated device files, anything else is not a valid key
+            return token.replace('mock-', '', 1) if token.startswith('mock-') else None
+        # Password login, the session cookie set by /logincheck holds the login name
+        match = re.search(r'APSCOOKIE_mock="?([^";]+)', self.headers.get('Cookie', ''))
+        if match:
+            return match.group(1)
+        return self.headers.get('X-Mock-Device', 'mock-fg')
+
+    def _device_version(self, device_name):
+        """ Version the device reports, None while it is rebooting after an upgrade """
+        with self.server.lock:
+            pending = self.server.rebooting.get(device_name)
+            if pending:
+                until, version = pending
+                if time.time() < until:
+                    return None
+                del self.server.rebooting[device_name]
+                self.server.device_versions[device_name] = version
+            return self.server.device_versions.get(device_name, self.server.version)
+
+    def _start_reboot(self, device_name, version):
+        with self.server.lock:
+            self.server.rebooting[device_name] = (time.time() + self.server.reboot_time, version)
+        sys.stderr.write(f'{device_name}: rebooting into {version}\n')
+
+    def _delay(self, device_name):
+        delay = self.server.latency
+        if device_name.endswith('-slow'):
+            delay += self.server.slow_latency
+        time.sleep(delay * random.uniform(0.8, 1.2))
+
+    def _dropped(self):
+        """ Randomly (--drop_rate) drop the connection without a response, True if dropped """
+        if random.random() >= self.server.drop_rate:
+            return False
+        with self.server.lock:
+            self.server.dropped += 1
+        self.close_connection = True
+        return True
+
+    def _send(self, code: int, body: bytes, content_type: str = 'application/json', headers: dict = None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_slowly(self, body: bytes, seconds: float, pieces: int = 20):
+        """ Send body (a 200 response) in pieces, spread over seconds """
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        size = -(-len(body) // pieces)
+        for start in range(0, len(body), size):
+            time.sleep(seconds / pieces)
+            self.wfile.write(body[start:start + size])
+            self.wfile.flush()
+
+    def _send_json(self, payload: dict, code: int = 200):
+        self._send(code, json.dumps(payload).encode())
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        if length:
+            return self.rfile.read(length)
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return b''
+
+    def _model(self, device_name):
+        return self.server.models[zlib.crc32(device_name.encode()) % len(self.server.models)]
+
+    def _status(self, device_name, version):
+        model = self._model(device_name)
+        return {'http_method': 'GET', 'results': {'model_name': 'FortiGate', 'model_number': model.lstrip('FGT'),
+                                                  'model': model, 'hostname': device_name,
+                                                  'log_disk_status': 'available'},
+                'vdom': 'root', 'path': 'system', 'name': 'status', 'status': 'success',
+                'serial': f'FGVM0000{abs(hash(device_name)) % 100000000:08d}', 'version': version,
+                'build': 1517}
+
+    def do_GET(self):
+        if self.path == '/mock/stats':
+            # Counters of the mock itself, not a FortiGate api
+            self._send_json({'connections': self.server.connections, 'status_calls': self.server.status_calls,
+                             'backups_served': self.server.backups_served, 'dropped': self.server.dropped,
+                             'upload_bytes': self.server.upload_bytes, 'ssh_sessions': self.server.ssh_sessions,
+                             'ssh_channels': self.server.ssh_channels})
+            return
+        device_name = self._device_name()
+        if device_name is None:
+            self._send_json({'status': 'error', 'http_status': 401}, code=401)
+            return
+        self._delay(device_name)
+        version = self._device_version(device_name)
+        if version is None:
+            # Rebooting, drop the connection like a device that is going down
+            self.close_connection = True
+            return
+        if self._dropped():
+            return
+        path = urlparse(self.path).path
+        if path == '/api/v2/monitor/system/status':
+            with self.server.lock:
+                self.server.status_calls += 1
+            self._send_json(self._status(device_name, version))
+        elif path == '/api/v2/monitor/system/firmware':
+            major, minor, patch = (int(x) for x in version.lstrip('v').split('.'))
+            available = [{'id': f'06000000FIMG0012{major}0{minor}0{p:02d}', 'version': f'v{major}.{minor}.{p}',
+                          'major': major, 'minor': minor, 'patch': p, 'build': 1500 + p,
+                          'platform-id': self._model(device_name)}
+                         for p in range(patch + 3, patch, -1)]
+            self._send_json({'results': {'current': {'version': version, 'major': major,
+                                                     'minor': minor, 'patch': patch,
+                                                     'platform-id': self._model(device_name)},
+                                         'available': available}, 'status': 'success'})
+        elif path == '/api/v2/cmdb/system/global':
+            self._send_json({'results': {'hostname': device_name,
+                                         'vdom-mode': 'multi-vdom' if '-vdom' in device_name else 'no-vdom'},
+                             'http_status': 200, 'status': 'success'})
+        elif path.startswith(('/api/v2/cmdb/system/accprofile/', '/api/v2/cmdb/system/api-user/')):
+            table, name = path.split('/')[-2:]
+            with self.server.lock:
+                entry = cli_tables(self.server, device_name)[table].get(name)
+                entry = dict(entry, name=name) if entry is not None else None
+            if entry is None:
+                self._send_json({'status': 'error', 'http_status': 404}, code=404)
+            else:
+                self._send_json({'results': [entry], 'http_status': 200, 'status': 'success'})
+        elif path == '/api/v2/monitor/system/ha-checksums':
+            checksum = hashlib.md5(f'{device_name}{self.server.generation}'.encode()).hexdigest()
+            status = self._status(device_name, version)
+            self._send_json({'results': [{'is_manage_master': 1, 'is_root_master': 1, 'serial_no': status['serial'],
+                                          'checksum': {'global': checksum, 'root': checksum, 'all': checksum}}],
+                             'serial': status['serial'], 'version': version, 'build': 1517,
+                             'status': 'success'})
+        else:
+            self._send_json({'status': 'error', 'http_status': 404}, code=404)
+
+    def do_POST(self):
+        device_name = self._device_name()
+        body = self._read_body()
+        if device_name is None:
+            self._send_json({'status': 'error', 'http_status': 401}, code=401)
+            return
+        self._delay(device_name)
+        version = self._device_version(device_name)
+        if version is None or self._dropped():
+            self.close_connection = True
+            return
+        path = urlparse(self.path).path
+        if path == '/logincheck':
+            name = body.decode(errors='replace').split('username=', 1)[-1].split('&', 1)[0]
+            self._send(200, b'1', 'text/plain', {'Set-Cookie': f'APSCOOKIE_mock="{name}"; Path=/'})
+        elif path == '/logout':
+            self._send(200, b'', 'text/plain')
+        elif path == '/api/v2/monitor/system/config/backup':
+            self.server.backups_served += 1
+            config = make_config(device_name, version, self.server.config_lines, self.server.generation)
+            if self.server.backup_seconds:
+                self._send_slowly(config, self.server.backup_seconds)
+            else:
+                self._send(200, config, 'application/octet-stream')
+        elif path == '/api/v2/monitor/system/firmware/upgrade' and b'"fortiguard"' in body[:200]:
+            match = re.search(r'FIMG0012(\d)0(\d)0(\d\d)', json.loads(body).get('filename', ''))
+            if not match:
+                self._send_json({'status': 'error', 'http_status': 400}, code=400)
+                return
+            self._start_reboot(device_name, 'v{}.{}.{}'.format(*(int(x) for x in match.groups())))
+            self._send_json({'results': {'status': 'success'}, 'status': 'success'})
+        elif path in ('/api/v2/monitor/system/config/restore', '/api/v2/monitor/system/firmware/upgrade'):
+            self.server.upload_bytes += len(body)
+            # Check the upload is valid json with valid (newline free) base64 content, as the FG would
+            try:
+                content = base64.b64decode(json.loads(body)['file_content'], validate=True)
+            except (ValueError, KeyError, TypeError) as e:
+                sys.stderr.write(f'{device_name}: invalid upload to {path}: {e}\n')
+                self._send_json({'status': 'error', 'http_status': 400}, code=400)
+                return
+            # One write per line, so lines from concurrent requests don't interleave
+            sys.stderr.write(f'{device_name}: upload to {path} {len(content)} bytes sha256 '
+                             f'{hashlib.sha256(content).hexdigest()}\n')
+            if path.endswith('/upgrade'):
+                major, minor, patch = version.lstrip('v').split('.')
+                self._start_reboot(device_name, f'v{major}.{minor}.{int(patch) + 1}')
+            self._send_json({'results': {'status': 'success'}, 'status': 'success'})
+        else:
+            self._send_json({'status': 'error', 'http_status': 404}, code=404)
+
+
+def cli_tables(server, device_name):
+    """ The cli tables of device_name (call with server.lock held) """
+    return server.cli_state.setdefault(device_name, {'accprofile': {'super_admin': {}}, 'api-user': {}})
+
+
+class MockCli:
+    """ Just enough of the FortiOS cli of one device for provisioning api users """
+    TABLES = ('accprofile', 'api-user')
+
+    def __init__(self, server, device_name):
+        self.server = server
+        self.device_name = device_name
+        self.vdom_mode = '-vdom' in device_name
+        # Stack of ('global', None), ('config', table) and ('edit', name)
+        self.path = []
+
+    def prompt(self):
+        if not self.path:
+            return f'{self.device_name} # '
+        kind, name = self.path[-1]
+        return f'{self.device_name} ({"global" if kind == "global" else name}) # '
+
+    def _in_global(self):
+        return not self.vdom_mode or ('global', None) in self.path
+
+    def run(self, line: str):
+        """ Run one cli line, returns its output """
+        words = line.split()
+        fail = 'Command fail. Return code -61\r\n'
+        if words == ['config', 'global']:
+            if not self.vdom_mode or self.path:
+                return fail
+            self.path.append(('global', None))
+            return ''
+        if words[0] == 'config' and len(words) == 3 and words[1] == 'system':
+            table = next((t for t in self.TABLES if t.startswith(words[2])), None)
+            if table is None or not self._in_global():
+                return fail
+            self.path.append(('config', table))
+            return ''
+        if words[0] == 'edit' and len(words) == 2 and self.path and self.path[-1][0] == 'config':
+            with self.server.lock:
+                cli_tables(self.server, self.device_name)[self.path[-1][1]].setdefault(words[1], {})
+            self.path.append(('edit', words[1]))
+            return ''
+        if words[0] == 'set' and len(words) >= 3 and self.path and self.path[-1][0] == 'edit':
+            table = self.path[-2][1]
+            with self.server.lock:
+                cli_tables(self.server, self.device_name)[table][self.path[-1][1]][words[1]] = ' '.join(words[2:])
+            return ''
+        if words == ['next'] and self.path and self.path[-1][0] == 'edit':
+            self.path.pop()
+            return ''
+        if words == ['end'] and self.path:
+            if self.path[-1][0] == 'edit':
+                self.path.pop()
+            self.path.pop()
+            return ''
+        if words[:3] == ['execute', 'api-user', 'generate-key'] and len(words) == 4:
+            with self.server.lock:
+                users = cli_tables(self.server, self.device_name)['api-user']
+                if not self._in_global() or words[3] not in users:
+                    return fail
+                apikey = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(30))
+                old = users[words[3]].get('api-key')
+                self.server.apikeys.pop(old, None)
+                self.server.apikeys[apikey] = self.device_name
+                users[words[3]]['api-key'] = apikey
+            return (f'New API key: {apikey}\r\n\r\nNOTE: The bearer of this API key will be granted all access '
+                    f'privileges assigned to the api-user {words[3]}.\r\n\r\n')
+        return 'Unknown action 0\r\nCommand fail. Return code -1\r\n'
+
+
+class MockSshServer(paramiko.ServerInterface):
+    """ One SSH connection, any password is accepted and the login name is the device name """
+    def __init__(self, server):
+        self.server = server
+        self.device_name = None
+        self.requests = {}
+        self.condition = threading.Condition()
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        self.device_name = username
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind != 'session':
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        with self.server.lock:
+            self.server.ssh_channels += 1
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def _request(self, channel, request):
+        with self.condition:
+            self.requests[channel.get_id()] = request
+            self.condition.notify_all()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        return self._request(channel, ('exec', command.decode()))
+
+    def check_channel_shell_request(self, channel):
+        return self._request(channel, ('shell', None))
+
+    def _delay(self):
+        delay = self.server.latency
+        if self.device_name.endswith('-slow'):
+            delay += self.server.slow_latency
+        time.sleep(delay * random.uniform(0.8, 1.2))
+
+    def serve_channel(self, channel):
+        with self.condition:
+            self.condition.wait_for(lambda: channel.get_id() in self.requests, timeout=30)
+            kind, command = self.requests.pop(channel.get_id(), (None, None))
+        cli = MockCli(self.server, self.device_name)
+        try:
+            if kind == 'exec':
+                # Each line is echoed after the prompt, followed by its output, as the FG does
+                output = ''
+                for line in command.splitlines():
+                    if line.strip():
+                        self._delay()
+                        output += cli.prompt() + line.strip() + '\r\n' + cli.run(line)
+                channel.sendall(output.encode())
+                channel.send_exit_status(0)
+            elif kind == 'shell':
+                channel.sendall(cli.prompt().encode())
+                buffer = b''
+                while True:
+                    data = channel.recv(4096)
+                    if not data:
+                        break
+                    buffer += data
+                    while b'\n' in buffer:
+                        line, buffer = buffer.split(b'\n', 1)
+                        line = line.decode().strip()
+                        if line == 'exit':
+                            return
+                        output = line + '\r\n'
+                        if line:
+                            self._delay()
+                            output += cli.run(line)
+                        channel.sendall((output + cli.prompt()).encode())
+        except (OSError, EOFError):
+            pass
+        finally:
+            channel.close()
+
+
+def serve_ssh(server, host: str, port: int):
+    """ Accept SSH connections to the mock cli, each in its own thread """
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+
+    def handle(conn):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        ssh_server = MockSshServer(server)
+        try:
+            transport.start_server(server=ssh_server)
+        except (paramiko.SSHException, EOFError, OSError):
+            return
+        with server.lock:
+            server.ssh_sessions += 1
+        while transport.is_active():
+            channel = transport.accept(timeout=1)
+            if channel is not None:
+                threading.Thread(target=ssh_server.serve_channel, args=(channel,), daemon=True).start()
+
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+class MockFortiGateServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on slow devices (timeouts) are expected, don't print a traceback for them
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def write_device_file(path, args):
+    """ Write a device yaml file describing the mock fleet """
+    fortigates = {}
+    for i in range(1, args.devices + 1):
+        name = f'mock-fg{i}'
+        ip = f'{args.host}:{args.port}'
+        if args.vdom_every and i % args.vdom_every == 0:
+            name += '-vdom'
+        if args.dead_every and i % args.dead_every == 0:
+            name += '-dead'
+            # TEST-NET-1 address, connections to it will not be answered
+            ip = '192.0.2.1'
+        elif args.slow_every and i % args.slow_every == 0:
+            name += '-slow'
+        fortigates[name] = {'ip': ip, 'apikey': f'mock-{name}', 'use_ssl': False}
+        if args.ssh_port:
+            fortigates[name].update({'login': name, 'password': 'mock', 'ssh_port': args.ssh_port})
+    with open(path, 'w') as f:
+        yaml.dump({'fortigates': fortigates, 'lab_name': 'mock'}, f)
+
+
+#######################
+# Main
+#######################
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.write_device_file:
+        write_device_file(args.write_device_file, args)
+        print(f'Wrote {args.devices} mock devices to {args.write_device_file}')
+        raise SystemExit
+
+    server = MockFortiGateServer((args.host, args.port), MockFortiGateHandler)
+    server.latency = args.latency
+    server.slow_latency = args.slow_latency
+    server.config_lines = args.config_lines
+    server.backup_seconds = args.backup_seconds
+    server.version = args.version
+    server.reboot_time = args.reboot_time
+    server.models = args.models.split(',')
+    server.device_versions = {}
+    server.rebooting = {}
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.generation = args.generation
+    server.upload_bytes = 0
+    server.backups_served = 0
+    server.status_calls = 0
+    server.dropped = 0
+    server.drop_rate = args.drop_rate
+    server.cli_state = {}
+    server.apikeys = {}
+    server.ssh_sessions = 0
+    server.ssh_channels = 0
+    if args.ssh_port:
+        threading.Thread(target=serve_ssh, args=(server, args.host, args.ssh_port), daemon=True).start()
+        print(f'Mock FortiGate cli listening on ssh://{args.host}:{args.ssh_port}')
+    print(f'Mock FortiGate listening on http://{args.host}:{args.port} (Ctrl-C to stop)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f'Served {server.backups_served} config backups, received {server.upload_bytes} upload bytes '
+              f'over {server.connections} connections')
+        print('Goodbye')